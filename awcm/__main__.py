@@ -0,0 +1,164 @@
+"""
+Run AWCM from the command line, e.g.
+
+    python -m awcm components
+    python -m awcm build --jobs 4
+    python -m awcm watch
+    python -m awcm serve --port 8000
+    python -m awcm bench --pages 10000
+    python -m awcm microbench --compare baseline.json
+"""
+import argparse
+
+from awcm import awcm
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='awcm', description="AWCM static content generator")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    components = commands.add_parser(
+        'components', help="Run the component generators")
+    components.add_argument(
+        '--dir', default='components',
+        help="Folder containing the component generators "
+             "(default: %(default)s)")
+    components.add_argument(
+        '--profile', action='store_true',
+        help="Time the component generators, for the report made by "
+             "`build --profile`")
+
+    build = commands.add_parser(
+        'build', help="Templatise all pages into the output folder")
+    build.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help="Number of processes used to render pages (0 means one per "
+             "CPU). Defaults to the 'jobs' setting in config.json, or 1.")
+    build.add_argument(
+        '--profile', action='store_true', default=None,
+        help="Report where the time went (also turned on by the 'profile' "
+             "setting in config.json)")
+    build.add_argument(
+        '--slowest', type=int, default=10,
+        help="Number of slowest pages in the profile report "
+             "(default: %(default)s)")
+    build.add_argument(
+        '--precompress', action='store_true', default=None,
+        help="Also write .gz (and .br) copies of the pages, CSS and "
+             "JavaScript (also turned on by the 'precompress' setting in "
+             "config.json)")
+    build.add_argument(
+        '-o', '--output', default=None,
+        help="Folder to build the website in, or a .tar, .tar.gz, .tgz, "
+             ".tar.bz2, .tar.xz or .zip file to write it straight into "
+             "(default: output)")
+
+    watch = commands.add_parser(
+        'watch', help="Build, then rebuild whenever a file changes")
+    watch.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help="Number of processes used to render pages")
+    watch.add_argument(
+        '--poll', action='store_true',
+        help="Check the files for changes every so often, rather than "
+             "using inotify")
+    watch.add_argument(
+        '--interval', type=float, default=1.0,
+        help="Seconds between checks, with --poll (default: %(default)s)")
+
+    serve = commands.add_parser(
+        'serve', help="Preview the website, rendering pages in memory as "
+                      "they are asked for")
+    serve.add_argument('--host', default='127.0.0.1',
+                       help="Address to serve on (default: %(default)s)")
+    serve.add_argument('--port', type=int, default=8000,
+                       help="Port to serve on (default: %(default)s)")
+    serve.add_argument('--no-components', dest='components',
+                       action='store_false',
+                       help="Don't run the component generators first")
+    serve.add_argument('--render-all', action='store_true',
+                       help="Render every page before serving, and stop if "
+                            "any can't be rendered")
+
+    bench = commands.add_parser(
+        'bench', help="Time the build of a synthetic website")
+    bench.add_argument('--pages', type=int, default=1000,
+                       help="Number of pages (default: %(default)s)")
+    bench.add_argument('--tags', type=int, default=100,
+                       help="Number of different tags (default: %(default)s)")
+    bench.add_argument('--tags-per-page', type=int, default=3,
+                       help="Tags on each page (default: %(default)s)")
+    bench.add_argument('--categories', type=int, default=10,
+                       help="Number of categories (default: %(default)s)")
+    bench.add_argument('--body-kb', type=int, default=4,
+                       help="Size of each page's text in KB "
+                            "(default: %(default)s)")
+    bench.add_argument('--depth', type=int, default=2,
+                       help="Maximum depth of sub-folders "
+                            "(default: %(default)s)")
+    bench.add_argument('--media', type=int, default=0,
+                       help="Number of media files (default: %(default)s)")
+    bench.add_argument('--media-kb', type=int, default=64,
+                       help="Size of each media file in KB "
+                            "(default: %(default)s)")
+    bench.add_argument('--entries-per-page', type=int, default=10,
+                       help="The 'entries_per_page' setting "
+                            "(default: %(default)s)")
+    bench.add_argument('--incremental', action='store_true',
+                       help="Turn on the 'incremental' setting")
+    bench.add_argument('--seed', type=int, default=0,
+                       help="Seed for the random content "
+                            "(default: %(default)s)")
+    bench.add_argument('-j', '--jobs', type=int, default=None,
+                       help="Number of processes used to render pages")
+    bench.add_argument('--rebuild', action='store_true',
+                       help="Also time a second build, with nothing changed")
+    bench.add_argument('--site', default=None,
+                       help="Folder to make the website in (it mustn't exist "
+                            "yet). Defaults to a temporary folder.")
+    bench.add_argument('--keep', action='store_true',
+                       help="Don't delete the temporary website afterwards")
+    bench.add_argument('--json', default=None,
+                       help="Also save the results to this JSON file")
+
+    microbench = commands.add_parser(
+        'microbench', help="Time the functions the build spends most of "
+                           "its time in, and compare them with a baseline")
+    microbench.add_argument('--save', default=None,
+                            help="Save the results as a baseline JSON file")
+    microbench.add_argument('--compare', default=None,
+                            help="Compare the results with this baseline "
+                                 "file, and fail if any function has "
+                                 "slowed down by more than the threshold")
+    microbench.add_argument('--threshold', type=float, default=0.2,
+                            help="The slow-down allowed, as a fraction "
+                                 "(default: %(default)s)")
+    microbench.add_argument('--repeat', type=int, default=5,
+                            help="Number of runs of each function; the "
+                                 "best is used (default: %(default)s)")
+
+    args = parser.parse_args()
+    if args.command == 'components':
+        awcm.run_components(args.dir, profile=args.profile)
+    elif args.command == 'build':
+        awcm.main(jobs=args.jobs, profile=args.profile, slowest=args.slowest,
+                  output_path=args.output, precompress=args.precompress)
+    elif args.command == 'watch':
+        from awcm import watch
+        watch.watch(jobs=args.jobs, poll=args.poll, interval=args.interval)
+    elif args.command == 'serve':
+        from awcm import serve
+        serve.serve(host=args.host, port=args.port,
+                    components=args.components, render_all=args.render_all)
+    elif args.command == 'bench':
+        from awcm import bench
+        bench.main(args)
+    elif args.command == 'microbench':
+        from awcm import bench
+        bench.micro_main(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,14 +16,37 @@ What is this?
         - Jinja2 and BeautifulSoup :-)
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import copy
+import datetime
+import gzip
+import hashlib
+import io
 import json
+import multiprocessing
 import os
 import re
+import runpy
 import shutil
+import subprocess
 import sys
-
-from bs4 import BeautifulSoup
+import tarfile
+import threading
+import time
+import traceback
+import urllib.parse
+from xml.sax import saxutils
+import zipfile
+
+try:
+    import brotli  # Optional; see precompress_files()
+except ImportError:
+    brotli = None
+from bs4 import BeautifulSoup, NavigableString
+from bs4.element import PreformattedString
 import jinja2
+from lxml import etree
 
 CONFIG_FILE_NAME = 'config.json'
 
@@ -34,8 +57,44 @@ CONFIG = {
     'themes_root': './themes',
     'output_path': './output',
     'debug': True,
+    'incremental': False,
+    'jobs': 1,
+    'entries_per_page': 0,  # 0 means no pagination
+    'static_link_mode': 'copy',  # or 'hardlink' or 'reflink'
+    'content_link_mode': 'copy',  # ditto, for non-HTML files in content/
+    'profile': False,
+    'precompress': False,
+    'precompress_min_size': 1024,
+    'site_url': None,  # e.g. 'https://example.com/', for sitemap.xml
 }
 
+# Files used to remember things between builds live in here. Nothing in
+# this folder is templatised or copied into the output.
+CACHE_DIR_NAME = '_cache'
+
+# Where the build profile (see BuildProfile) is saved
+PROFILE_REPORT_FILE = os.path.join('_meta', CACHE_DIR_NAME, 'profile.json')
+COMPONENTS_PROFILE_FILE = os.path.join('_meta', CACHE_DIR_NAME,
+                                       'profile_components.json')
+
+# Size of the buffer used when writing generated pages
+WRITE_BUFFER_SIZE = 64 * 1024
+
+# How much copy_file_range() is asked to copy at a time
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+# The types of file that precompress_files() compresses, and how hard
+PRECOMPRESS_EXTENSIONS = ['html', 'htm', 'css', 'js', 'svg', 'xml']
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+# The compressed files made by precompress_files()
+PRECOMPRESS_MANIFEST = os.path.join('_meta', CACHE_DIR_NAME,
+                                    'precompressed.json')
+
+TAGS_DATA_FILE = os.path.join('_meta', '000_tags.json')
+CATEGORIES_DATA_FILE = os.path.join('_meta', '000_categories.json')
+
 
 def read_site_config(relative_dir=None):
 
@@ -63,6 +122,28 @@ def read_site_config(relative_dir=None):
     # Optional config parameters
     if 'default_template' in local_config.keys():
         CONFIG['default_template'] = local_config['default_template']
+    if 'incremental' in local_config.keys():
+        CONFIG['incremental'] = local_config['incremental']
+    if 'jobs' in local_config.keys():
+        CONFIG['jobs'] = local_config['jobs']
+    if 'entries_per_page' in local_config.keys():
+        CONFIG['entries_per_page'] = local_config['entries_per_page']
+    if 'static_link_mode' in local_config.keys():
+        CONFIG['static_link_mode'] = local_config['static_link_mode']
+    if 'content_link_mode' in local_config.keys():
+        CONFIG['content_link_mode'] = local_config['content_link_mode']
+    if 'profile' in local_config.keys():
+        CONFIG['profile'] = local_config['profile']
+    if 'precompress' in local_config.keys():
+        CONFIG['precompress'] = local_config['precompress']
+    if 'precompress_min_size' in local_config.keys():
+        CONFIG['precompress_min_size'] = local_config['precompress_min_size']
+    if 'site_url' in local_config.keys():
+        CONFIG['site_url'] = local_config['site_url']
+
+
+class BuildError(Exception):
+    """ One or more pages could not be built """
 
 
 def html_encode(text):
@@ -101,24 +182,762 @@ def get_all_filenames(root_dir):
     file_list = []
     for root, _directories, filenames in os.walk(root_dir):
         for filename in filenames:
-            filename = re.sub(root_dir + '/', '', os.path.join(root, filename))
+            filename = os.path.relpath(os.path.join(root, filename), root_dir)
             if not re.match(r"/\.git/", filename):
                 file_list.append(filename)
     return file_list
 
 
-def copy_static_files(templates_dir, theme_name, output_dir):
-    """ Copy the static files for the specified theme """
+def copy_static_files(templates_dir, theme_name, output_dir,
+                      link_mode=None, executor=None, sink=None):
+    """ Copy the static files for the specified theme, including any
+    folders. Only files that have changed are copied, and files that are no
+    longer in the theme are removed. See sync_tree() for link_mode, which
+    defaults to the 'static_link_mode' config setting, and executor.
+
+    If sink (an output sink, e.g. an ArchiveSink) is given, output_dir is
+    the folder within it to copy them to.
+    """
+    if link_mode is None:
+        link_mode = CONFIG['static_link_mode']
+    if sink is None:
+        sink = DirectorySink(output_dir)
+        output_dir = ''
     source_dir = os.path.join(templates_dir, theme_name, 'static')
-    destination = output_dir
-    for filename in os.listdir(source_dir):
-        print("Copy %s" % filename)
-        if os.path.isfile(os.path.join(source_dir, filename)):
-            print('copying file')
-            shutil.copy(os.path.join(source_dir, filename),
-                        destination)
-        # We don't currently copy folders. If we did, shutil.copytree
-        # would be the tool to use.
+    copied, removed = sink.copy_tree(source_dir, output_dir,
+                                     link_mode=link_mode, executor=executor)
+    print("Theme %s: %d static files copied, %d removed" % (
+        theme_name, copied, removed))
+
+
+def copy_all_static_files(templates_dir, theme_names, output_path,
+                          sink=None):
+    """ Copy the static files for each of the themes to
+    <output_path>/themes/<theme>/ (or themes/<theme>/ in sink, if it's
+    given), spreading the copies over a pool of threads (copying is mostly
+    waiting for the disk).
+    """
+    if sink is None:
+        sink = DirectorySink(output_path)
+    with ThreadPoolExecutor() as executor:
+        for theme_name in sorted(set(theme_names)):
+            copy_static_files(templates_dir, theme_name,
+                              os.path.join('themes', theme_name),
+                              executor=executor, sink=sink)
+
+
+# ioctl request to make a copy-on-write clone of a file (Linux)
+FICLONE = 0x40049409
+
+
+def files_match(source, destination):
+    """ Is destination already an up to date copy of source? """
+    try:
+        source_stat = os.stat(source)
+        destination_stat = os.stat(destination)
+    except OSError:
+        return False
+    if (source_stat.st_ino == destination_stat.st_ino and
+            source_stat.st_dev == destination_stat.st_dev):
+        # It's a hard link
+        return True
+    if source_stat.st_size != destination_stat.st_size:
+        return False
+    if source_stat.st_mtime_ns == destination_stat.st_mtime_ns:
+        return True
+    # The source has been touched; has it really changed?
+    if file_digest(source) == file_digest(destination):
+        shutil.copystat(source, destination)
+        return True
+    return False
+
+
+def _reflink(source, destination):
+    import fcntl  # Not available on Windows
+    with open(source, 'rb') as source_fh:
+        with open(destination, 'wb') as destination_fh:
+            fcntl.ioctl(destination_fh.fileno(), FICLONE, source_fh.fileno())
+
+
+def _copy_data(source, destination):
+    """ Copy a file's contents (and its permissions and times), letting
+    the kernel move the data with copy_file_range() where it can, which
+    avoids copying it through this process and lets some filesystems share
+    the blocks instead.
+    """
+    if not hasattr(os, 'copy_file_range'):
+        shutil.copy2(source, destination)
+        return
+    with open(source, 'rb') as source_fh:
+        with open(destination, 'wb') as destination_fh:
+            try:
+                while os.copy_file_range(source_fh.fileno(),
+                                         destination_fh.fileno(),
+                                         COPY_CHUNK_SIZE):
+                    pass
+            except OSError:
+                # e.g. not supported between these filesystems
+                source_fh.seek(0)
+                destination_fh.seek(0)
+                destination_fh.truncate()
+                shutil.copyfileobj(source_fh, destination_fh)
+    shutil.copystat(source, destination)
+
+
+def copy_file(source, destination, link_mode='copy'):
+    """
+    Copy a file, unless destination is already a copy of it.
+
+    link_mode is one of:
+        'copy': an ordinary copy
+        'hardlink': make destination a hard link to source, so no data is
+            copied at all
+        'reflink': make a copy-on-write clone of source, on filesystems
+            that support it (e.g. Btrfs, XFS)
+    If a link can't be made (e.g. because the output folder is on a
+    different filesystem), an ordinary copy is made instead.
+
+    Returns True if the file was copied.
+    """
+    if files_match(source, destination):
+        return False
+
+    # Write to a temporary file then rename it, so that we never write
+    # through an old hard link into the source file.
+    tmp_path = '%s.%d.tmp' % (destination, os.getpid())
+    try:
+        if link_mode == 'hardlink':
+            os.link(source, tmp_path)
+        elif link_mode == 'reflink':
+            _reflink(source, tmp_path)
+            shutil.copystat(source, tmp_path)
+        else:
+            _copy_data(source, tmp_path)
+    except (OSError, ImportError):
+        if link_mode == 'copy':
+            raise
+        _copy_data(source, tmp_path)
+    os.replace(tmp_path, destination)
+    if link_mode == 'copy':
+        size = os.path.getsize(destination)
+        count_bytes(read=size, written=size)
+    return True
+
+
+def sync_tree(source_dir, destination_dir, link_mode='copy', executor=None):
+    """
+    Make destination_dir a copy of source_dir, including sub-folders,
+    copying only the files that have changed (see copy_file() for
+    link_mode), and removing anything that isn't in source_dir (apart from
+    the compressed copies of its files; see is_precompressed_copy()).
+
+    If executor (a concurrent.futures.Executor) is given, the files are
+    copied by it.
+
+    Returns the number of files copied and the number removed.
+    """
+    source_files = sorted(get_all_filenames(source_dir))
+    for filename in source_files:
+        destination = os.path.join(destination_dir, filename)
+        if not os.path.exists(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+
+    def copy_one(filename):
+        return copy_file(os.path.join(source_dir, filename),
+                         os.path.join(destination_dir, filename),
+                         link_mode=link_mode)
+
+    if executor is not None:
+        results = list(executor.map(copy_one, source_files))
+    else:
+        results = [copy_one(filename) for filename in source_files]
+    copied = 0
+    for filename, was_copied in zip(source_files, results):
+        if was_copied:
+            if CONFIG['debug']:
+                print("Copy %s" % filename)
+            copied += 1
+    source_files = set(source_files)
+
+    removed = 0
+    for filename in get_all_filenames(destination_dir):
+        if filename not in source_files and \
+                not is_precompressed_copy(filename, source_files):
+            os.remove(os.path.join(destination_dir, filename))
+            removed += 1
+    for root, _directories, _filenames in os.walk(destination_dir,
+                                                  topdown=False):
+        if root != destination_dir and not os.listdir(root):
+            os.rmdir(root)
+    return copied, removed
+
+
+# Output sinks: where the built website is written. A sink has
+#   write_page(path, stream): write a page from the pieces of text in stream
+#   copy_files(copies, link_mode): copy (path, source) pairs in, returning
+#       whether each was copied
+#   copy_tree(source_dir, path, link_mode, executor): copy a folder in,
+#       returning the number of files copied and the number removed
+#   remove(path), close() and discard()
+# and `incremental`, which is True if the files from the last build are
+# still there, so that incremental builds are possible.
+
+class DirectorySink:
+    """ Writes the website into a folder """
+    incremental = True
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+
+    def _full_path(self, path):
+        full_path = os.path.join(self.output_dir, path)
+        os.makedirs(os.path.dirname(full_path) or '.', exist_ok=True)
+        return full_path
+
+    def write_page(self, path, stream):
+        full_path = self._full_path(path)
+
+        # Write the page a piece at a time as the template generates it,
+        # rather than building the whole page in memory first. It goes into
+        # a temporary file, so that if the template fails part way through,
+        # the last good page is left alone.
+        tmp_path = '%s.%d.tmp' % (full_path, os.getpid())
+        try:
+            profile = get_profile()
+            if profile is not None and hasattr(stream, 'dump'):
+                profile.write_stream(stream, tmp_path)
+            else:
+                with open(tmp_path, 'w',
+                          buffering=WRITE_BUFFER_SIZE) as output_fh:
+                    output_fh.writelines(stream)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, full_path)
+
+    def copy_files(self, copies, link_mode='copy'):
+        """ Copy the files over a pool of threads (copying is mostly
+        waiting for the disk) """
+        def copy_one(copy):
+            path, source = copy
+            return copy_file(source, self._full_path(path),
+                             link_mode=link_mode)
+
+        with ThreadPoolExecutor() as executor:
+            return list(executor.map(copy_one, copies))
+
+    def copy_tree(self, source_dir, path, link_mode='copy', executor=None):
+        destination_dir = os.path.join(self.output_dir, path) if path else \
+            self.output_dir
+        os.makedirs(destination_dir, exist_ok=True)
+        return sync_tree(source_dir, destination_dir, link_mode=link_mode,
+                         executor=executor)
+
+    def remove(self, path):
+        full_path = os.path.join(self.output_dir, path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+
+    def close(self):
+        pass
+
+    def discard(self):
+        pass
+
+
+# The archive formats ArchiveSink can write, by file name extension
+ARCHIVE_FORMATS = [('.tar.gz', 'gz'), ('.tgz', 'gz'), ('.tar.bz2', 'bz2'),
+                   ('.tar.xz', 'xz'), ('.tar', ''), ('.zip', 'zip')]
+
+# The earliest time a zip file can hold
+ZIP_EPOCH = 315532800  # 1980-01-01
+
+
+def archive_format(path):
+    """ The compression ('gz', 'bz2', 'xz' or '' for none) of the tar file,
+    or 'zip', that path names; or None if it isn't an archive """
+    for extension, compression in ARCHIVE_FORMATS:
+        if path.lower().endswith(extension):
+            return compression
+    return None
+
+
+class ArchiveSink:
+    """
+    Writes the website straight into a tar or zip file, rather than into
+    a folder (the format comes from the file name; see ARCHIVE_FORMATS).
+
+    Files are added in the order they are written, so the build writes them
+    in a fixed order: the pages, sorted by path, then the other content
+    files, then the themes' static files. Every file gets the same owner,
+    permissions and time (the SOURCE_DATE_EPOCH environment variable if it's
+    set, or else the time the build started), so building the same website
+    twice with the same SOURCE_DATE_EPOCH makes the same archive.
+
+    The archive is written to a temporary file, which replaces archive_path
+    on close(), so a failed build leaves the last archive alone.
+    """
+    incremental = False
+
+    def __init__(self, archive_path, mtime=None):
+        self.archive_path = archive_path
+        self.format = archive_format(archive_path)
+        if self.format is None:
+            raise BuildError("Not a .tar, .tar.gz, .tgz, .tar.bz2, .tar.xz "
+                             "or .zip file: %s" % archive_path)
+        if mtime is None:
+            mtime = int(os.environ.get('SOURCE_DATE_EPOCH', time.time()))
+        self.mtime = mtime
+        self._lock = threading.Lock()
+        self._tmp_path = '%s.%d.tmp' % (archive_path, os.getpid())
+        archive_dir = os.path.dirname(archive_path)
+        if archive_dir:
+            os.makedirs(archive_dir, exist_ok=True)
+        self._fh = open(self._tmp_path, 'wb')
+        self._gzip = None
+        if self.format == 'zip':
+            self._archive = zipfile.ZipFile(self._fh, 'w',
+                                            zipfile.ZIP_DEFLATED)
+        elif self.format == 'gz':
+            # Not tarfile's own gzip support, which puts the time and the
+            # (temporary) file name in the gzip header
+            self._gzip = gzip.GzipFile(filename='', mode='wb',
+                                       fileobj=self._fh, mtime=mtime)
+            self._archive = tarfile.open(fileobj=self._gzip, mode='w')
+        else:
+            self._archive = tarfile.open(fileobj=self._fh,
+                                         mode='w:' + self.format)
+
+    def _add(self, path, fileobj, size):
+        name = path.replace(os.sep, '/')
+        with self._lock:
+            if self.format == 'zip':
+                info = zipfile.ZipInfo(name, time.gmtime(
+                    max(self.mtime, ZIP_EPOCH))[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                # zipfile decides from this, before anything is written,
+                # whether the entry needs zip64 (for files over 2 GiB)
+                info.file_size = size
+                with self._archive.open(info, 'w') as entry_fh:
+                    shutil.copyfileobj(fileobj, entry_fh)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = size
+                info.mtime = self.mtime
+                info.mode = 0o644
+                self._archive.addfile(info, fileobj)
+
+    def write_page(self, path, stream):
+        with profile_phase('render'):
+            text = ''.join(stream)
+        self.add_page(path, text)
+
+    def add_page(self, path, text):
+        """ Add a page that has already been rendered """
+        with profile_phase('write'):
+            data = text.encode('utf-8')
+            self._add(path, io.BytesIO(data), len(data))
+            count_bytes(written=len(data))
+
+    def copy_files(self, copies, link_mode=None):
+        """ Copy the files in, one at a time, in order. The link mode
+        doesn't apply to archives. """
+        for path, source in copies:
+            with open(source, 'rb') as source_fh:
+                size = os.fstat(source_fh.fileno()).st_size
+                self._add(path, source_fh, size)
+            count_bytes(read=size, written=size)
+        return [True] * len(copies)
+
+    def copy_tree(self, source_dir, path, link_mode=None, executor=None):
+        """ Copy a folder in, sorted by path (so not using the executor) """
+        copies = [(os.path.join(path, filename),
+                   os.path.join(source_dir, filename))
+                  for filename in sorted(get_all_filenames(source_dir))]
+        return len(self.copy_files(copies)), 0
+
+    def remove(self, path):
+        # Only what this build wrote is in the archive
+        pass
+
+    def _close_archive(self):
+        self._archive.close()
+        if self._gzip is not None:
+            self._gzip.close()
+        self._fh.close()
+
+    def close(self):
+        self._close_archive()
+        os.replace(self._tmp_path, self.archive_path)
+
+    def discard(self):
+        self._close_archive()
+        os.remove(self._tmp_path)
+
+
+class MemorySink:
+    """ Keeps the pages written to it, e.g. to send them from a worker
+    process to an ArchiveSink in the main one """
+    incremental = False
+
+    def __init__(self):
+        self.pages = {}
+
+    def write_page(self, path, stream):
+        with profile_phase('render'):
+            self.pages[path] = ''.join(stream)
+
+
+def get_output_sink(output_path):
+    """ An ArchiveSink if output_path is an archive's file name, otherwise
+    a DirectorySink """
+    if archive_format(output_path) is not None:
+        return ArchiveSink(output_path)
+    return DirectorySink(output_path)
+
+
+def is_precompressed_copy(filename, filenames):
+    """ Is filename a compressed copy, made by precompress_files(), of one
+    of filenames? """
+    base, extension = os.path.splitext(filename)
+    return extension in ['.gz', '.br'] and base in filenames and \
+        base.split('.')[-1] in PRECOMPRESS_EXTENSIONS
+
+
+def _compress(data, extension):
+    if extension == '.br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    # No time in the header, so the same file always compresses the same
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _precompress_file(path):
+    """
+    Write the compressed copies of a file that are out of date (or
+    missing). They are given the file's modification time, so one whose
+    time differs from the file's is out of date, even if it's newer (e.g.
+    an older version of the file has been put back). A compressed copy that
+    wouldn't be smaller than the file isn't kept.
+
+    Returns the compressed copies there are now, and how many were written.
+    """
+    source_stat = os.stat(path)
+    extensions = ['.gz'] + (['.br'] if brotli is not None else [])
+    data = None
+    compressed_paths = []
+    written = 0
+    for extension in extensions:
+        compressed_path = path + extension
+        try:
+            if os.stat(compressed_path).st_mtime_ns == \
+                    source_stat.st_mtime_ns:
+                compressed_paths.append(compressed_path)
+                continue
+        except OSError:
+            pass
+        if data is None:
+            with open(path, 'rb') as source_fh:
+                data = source_fh.read()
+        compressed = _compress(data, extension)
+        if len(compressed) >= len(data):
+            if os.path.exists(compressed_path):
+                os.remove(compressed_path)
+            continue
+        tmp_path = '%s.%d.tmp' % (compressed_path, os.getpid())
+        with open(tmp_path, 'wb') as compressed_fh:
+            compressed_fh.write(compressed)
+        os.utime(tmp_path, ns=(source_stat.st_atime_ns,
+                               source_stat.st_mtime_ns))
+        os.replace(tmp_path, compressed_path)
+        compressed_paths.append(compressed_path)
+        written += 1
+    return compressed_paths, written
+
+
+def precompress_files(output_dir, min_size=None, jobs=None):
+    """
+    Write compressed copies of the HTML, CSS, JavaScript (etc.; see
+    PRECOMPRESS_EXTENSIONS) files in output_dir next to them, for web
+    servers that can send precompressed files: x.html.gz, and x.html.br if
+    the brotli module is installed. Files smaller than min_size bytes
+    (default: the 'precompress_min_size' config setting) are left alone.
+
+    Only files that have changed are compressed: a file is skipped if its
+    compressed copy has the same modification time (see
+    _precompress_file()). Compressed copies made before whose
+    file has gone, or is now too small, are removed.
+
+    The files are compressed by a pool of jobs processes (see
+    make_pages_from_template()).
+
+    Returns the number of compressed copies written and the number removed.
+    """
+    if min_size is None:
+        min_size = CONFIG['precompress_min_size']
+    if jobs is None:
+        jobs = CONFIG['jobs']
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+
+    paths = []
+    for filename in sorted(get_all_filenames(output_dir)):
+        path = os.path.join(output_dir, filename)
+        if filename.split('.')[-1] in PRECOMPRESS_EXTENSIONS and \
+                os.path.getsize(path) >= min_size:
+            paths.append(path)
+
+    if jobs > 1 and len(paths) > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_precompress_file, paths,
+                               chunksize=max(1, len(paths) // (jobs * 8)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_precompress_file(path) for path in paths]
+
+    compressed_paths = set()
+    written = 0
+    for file_compressed_paths, file_written in results:
+        compressed_paths.update(os.path.relpath(path, output_dir)
+                                for path in file_compressed_paths)
+        written += file_written
+
+    # Remove what we made last time, but haven't this time
+    try:
+        with open(PRECOMPRESS_MANIFEST, 'r') as manifest_fh:
+            manifest = json.load(manifest_fh)
+    except (OSError, ValueError):
+        manifest = {}
+    removed = 0
+    if manifest.get('output_dir') == output_dir:
+        for filename in set(manifest['files']) - compressed_paths:
+            path = os.path.join(output_dir, filename)
+            if os.path.exists(path):
+                os.remove(path)
+                removed += 1
+    os.makedirs(os.path.dirname(PRECOMPRESS_MANIFEST), exist_ok=True)
+    write_json_atomic(PRECOMPRESS_MANIFEST, {
+        'output_dir': output_dir, 'files': sorted(compressed_paths)})
+
+    print("Precompressed %d files, removed %d" % (written, removed))
+    return written, removed
+
+
+def file_stamp(path):
+    """ A cheap fingerprint of a file: its size and modification time.
+    Returns None if the file does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def file_digest(path):
+    """ The SHA-1 hex digest of a file's contents """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file_fh:
+        for chunk in iter(lambda: file_fh.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_json_atomic(path, data):
+    """ Save data as JSON, replacing the file in one step so that an
+    interrupted build never leaves a half-written file behind.
+    """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as json_fh:
+        json.dump(data, json_fh, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+class BuildProfile:
+    """
+    Records where the time goes in a build: the wall time, CPU time and
+    bytes read and written in each phase (e.g. 'parse', 'render'), and how
+    long each page took.
+
+    Phases can be nested; count_bytes() adds to the innermost one.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.pages = {}
+        self._open_phases = []
+        self._lock = threading.Lock()
+
+    def add(self, name, wall=0.0, cpu=0.0, bytes_read=0, bytes_written=0,
+            calls=1):
+        """ Add to the totals for a phase """
+        with self._lock:
+            totals = self.phases.setdefault(name, {
+                'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'bytes_read': 0,
+                'bytes_written': 0})
+            totals['calls'] += calls
+            totals['wall'] += wall
+            totals['cpu'] += cpu
+            totals['bytes_read'] += bytes_read
+            totals['bytes_written'] += bytes_written
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time the code in a `with` block as (part of) a phase """
+        counts = {'bytes_read': 0, 'bytes_written': 0}
+        self._open_phases.append(counts)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            # Phases nest, so this is the innermost one. (Not remove(), as
+            # that would find the first one with the same counts.)
+            self._open_phases.pop()
+            self.add(name, time.perf_counter() - wall,
+                     time.process_time() - cpu, **counts)
+
+    def count_bytes(self, read=0, written=0):
+        """ Count bytes read or written in the current phase """
+        with self._lock:
+            if self._open_phases:
+                self._open_phases[-1]['bytes_read'] += read
+                self._open_phases[-1]['bytes_written'] += written
+
+    def add_page(self, file_path, seconds):
+        self.pages[file_path] = self.pages.get(file_path, 0.0) + seconds
+
+    def write_stream(self, stream, path):
+        """ Write a jinja2 TemplateStream to a file, timing the rendering
+        ('render') separately from the writing ('write') """
+        wall, cpu = time.perf_counter(), time.process_time()
+        output_fh = _TimedFile(path)
+        try:
+            stream.dump(output_fh)
+        finally:
+            output_fh.close()
+        self.add('render', time.perf_counter() - wall - output_fh.wall,
+                 time.process_time() - cpu - output_fh.cpu)
+        self.add('write', output_fh.wall, output_fh.cpu,
+                 bytes_written=output_fh.bytes_written)
+
+    def take(self):
+        """ Everything recorded so far, which is then forgotten. Used to
+        send the profile of a worker process back to the main one. """
+        data = {'phases': self.phases, 'pages': self.pages}
+        self.phases = {}
+        self.pages = {}
+        return data
+
+    def merge(self, data):
+        """ Add in the phases and pages from take() or a saved report """
+        for name, totals in data.get('phases', {}).items():
+            self.add(name, totals['wall'], totals['cpu'],
+                     totals['bytes_read'], totals['bytes_written'],
+                     totals['calls'])
+        for file_path, seconds in data.get('pages', {}).items():
+            self.add_page(file_path, seconds)
+
+    def slowest_pages(self, count):
+        return sorted(self.pages.items(), key=lambda page: -page[1])[:count]
+
+    def report(self, slowest=10):
+        """ The profile as a dict, for saving as JSON """
+        return {'phases': self.phases,
+                'slowest_pages': [{'page': file_path, 'seconds': seconds}
+                                  for file_path, seconds in
+                                  self.slowest_pages(slowest)],
+                'pages': self.pages}
+
+    def summary(self, slowest=10):
+        """ A short table of the phases and the slowest pages """
+        lines = ['%-32s %7s %9s %9s %11s %12s' % (
+            'phase', 'calls', 'wall (s)', 'cpu (s)', 'read (KB)',
+            'written (KB)')]
+        for name, totals in sorted(self.phases.items(),
+                                   key=lambda phase: -phase[1]['wall']):
+            lines.append('%-32s %7d %9.3f %9.3f %11.1f %12.1f' % (
+                name, totals['calls'], totals['wall'], totals['cpu'],
+                totals['bytes_read'] / 1024.0,
+                totals['bytes_written'] / 1024.0))
+        if self.pages:
+            lines.append('Slowest pages:')
+            for file_path, seconds in self.slowest_pages(slowest):
+                lines.append('  %8.3fs  %s' % (seconds, file_path))
+        return '\n'.join(lines)
+
+
+class _TimedFile:
+    """ A text file for writing, which keeps count of the time spent
+    opening, writing and closing it """
+    def __init__(self, path):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes_written = 0
+        self._fh = self._timed(open, path, 'w', buffering=WRITE_BUFFER_SIZE)
+
+    def _timed(self, function, *args, **kwargs):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.wall += time.perf_counter() - wall
+            self.cpu += time.process_time() - cpu
+
+    def write(self, text):
+        self.bytes_written += len(text)
+        return self._timed(self._fh.write, text)
+
+    def writelines(self, lines):
+        for text in lines:
+            self.write(text)
+
+    def close(self):
+        self._timed(self._fh.close)
+
+
+# The BuildProfile for this process, if profiling is turned on
+_PROFILES = []
+
+
+def get_profile():
+    """ The active BuildProfile, or None if we're not profiling """
+    return _PROFILES[0] if _PROFILES else None
+
+
+def start_profile():
+    """ Turn on profiling (if it isn't already) and return the
+    BuildProfile """
+    if not _PROFILES:
+        _PROFILES.append(BuildProfile())
+    return _PROFILES[0]
+
+
+def stop_profile():
+    del _PROFILES[:]
+
+
+def profile_phase(name):
+    """
+    Time the code in a `with` block as a phase of the build profile, if
+    profiling is turned on; e.g. in a component generator:
+
+        with awcm.profile_phase('make photo gallery'):
+            ...
+    """
+    profile = get_profile()
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.phase(name)
+
+
+def count_bytes(read=0, written=0):
+    """ Count bytes read or written in the current profile phase """
+    profile = get_profile()
+    if profile is not None:
+        profile.count_bytes(read, written)
 
 
 def get_back_path(path_to_file):
@@ -163,23 +982,337 @@ def fix_incomplete_html(in_html):
     return inner_body
 
 
+def make_preview(in_html, max_length, truncate_at):
+    """
+    Make a preview of a block of HTML (e.g. a page's content) for the
+    homepage or a navigation page.
+
+    If the HTML contains more than max_length characters of text, the
+    preview is cut down to the first truncate_at characters of text. By
+    having a difference between these two, we never see a preview with
+    only the final word truncated.
+
+    The HTML is parsed once, then the parsed tree is cut short, so the
+    preview is always well-formed: open tags are closed, and it never stops
+    part way through a tag or an entity.
+
+    returns: (preview_html, is_truncated)
+    """
+    soup = BeautifulSoup(in_html, 'lxml')
+    body = soup.find('body')
+    if body is None:
+        return '', False
+
+    # Comments, CDATA etc. don't count as text.
+    strings = [string for string in body.descendants
+               if isinstance(string, NavigableString) and
+               not isinstance(string, PreformattedString)]
+
+    is_truncated = sum(len(string) for string in strings) > max_length
+    if is_truncated:
+        remaining = truncate_at
+        for string in strings:
+            if len(string) >= remaining:
+                node = NavigableString(string[:remaining])
+                string.replace_with(node)
+                # Remove everything after the cut
+                while node is not body:
+                    for sibling in list(node.next_siblings):
+                        sibling.extract()
+                    node = node.parent
+                break
+            remaining -= len(string)
+
+    # Same as fix_incomplete_html() would give
+    return body.decode_contents().lstrip(), is_truncated
+
+
+def storable_page_data(page_data):
+    """ Page data (as returned by HtmlFileReader.parse_html()) in a form
+    that can be saved as JSON: the '_raw_metas' Tags become HTML strings.
+    Returns a new dict, leaving page_data alone. """
+    meta = dict(page_data['meta'])
+    meta['_raw_metas'] = [str(tag) for tag in meta.get('_raw_metas', [])]
+    page = dict(page_data)
+    page['meta'] = meta
+    return page
+
+
+class PageCache:
+    """
+    An on-disk cache of HtmlFileReader.read() results, so that each page is
+    parsed once per change rather than once per build stage.
+
+    There is one small JSON file per page, named after a hash of the page's
+    path. An entry is only used if the size and modification time of the
+    page still match those recorded when it was parsed. Anything else
+    worked out from the page later on (see put_extra()) goes in a second
+    file beside it, so that the page data isn't written out again each time.
+
+    Pages are identified by their path relative to the cache folder, so the
+    components (which run in components/) and awcm.main() (which runs in the
+    top level folder) share the same entries.
+
+    N.B. BeautifulSoup objects can't be stored, so the '_raw_metas' of a
+    cached page is a list of HTML strings rather than a list of Tags (see
+    storable_page_data()). Everything returned is a copy, so changing it
+    doesn't change what later readers get.
+    """
+    VERSION = 1
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        # In case we change directory later on (e.g. to run a component)
+        self._abs_cache_dir = os.path.abspath(cache_dir)
+        self._memory = {}
+
+    def _key(self, filename):
+        return os.path.relpath(os.path.abspath(filename),
+                               self._abs_cache_dir)
+
+    def _entry_path(self, key, suffix='.json'):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._abs_cache_dir, digest + suffix)
+
+    def _read_entry_file(self, path, key, stamp):
+        """ The JSON in path, or None if it can't be read or it isn't for
+        this version of the page """
+        try:
+            with open(path, 'r') as entry_fh:
+                entry = json.load(entry_fh)
+        except (OSError, ValueError):
+            return None
+        if (entry.get('version') != self.VERSION or
+                entry.get('path') != key or entry.get('stamp') != stamp):
+            return None
+        return entry
+
+    def _load_entry(self, filename):
+        """ Return the cache entry for filename, or None if there isn't
+        one, or it is out of date.
+        """
+        key = self._key(filename)
+        stamp = file_stamp(filename)
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry['stamp'] == stamp:
+                return entry
+            del self._memory[key]
+            return None
+        entry = self._read_entry_file(self._entry_path(key), key, stamp)
+        if entry is None:
+            return None
+        extras = self._read_entry_file(self._entry_path(key, '.extra.json'),
+                                       key, stamp)
+        if extras is not None:
+            entry.setdefault('extra', {}).update(extras['extra'])
+        self._memory[key] = entry
+        return entry
+
+    def _write_entry_file(self, entry, suffix='.json'):
+        # exist_ok, as pool processes may be saving entries at the same time
+        os.makedirs(self._abs_cache_dir, exist_ok=True)
+        write_json_atomic(self._entry_path(entry['path'], suffix), entry)
+
+    def get(self, filename):
+        """ Return the cached page data for filename, or None """
+        entry = self._load_entry(filename)
+        if entry is None:
+            return None
+        return copy.deepcopy(entry['page'])
+
+    def put(self, filename, page_data, extra=None):
+        """ Store the page data (as returned by HtmlFileReader.read())
+        for filename, and any extras (a dict of name: value, as for
+        put_extra()) that are already known """
+        entry = {'version': self.VERSION,
+                 'path': self._key(filename),
+                 'stamp': file_stamp(filename),
+                 'page': copy.deepcopy(storable_page_data(page_data)),
+                 'extra': copy.deepcopy(extra or {})}
+        self._memory[entry['path']] = entry
+        self._write_entry_file(entry)
+
+    def get_extra(self, filename, name):
+        """ Return something else worked out from the page (e.g. a
+        summary) that was stored with put_extra(), or None """
+        entry = self._load_entry(filename)
+        if entry is None:
+            return None
+        return copy.deepcopy(entry.get('extra', {}).get(name))
+
+    def put_extra(self, filename, name, value):
+        """ Store something worked out from the page alongside the page
+        data. It is thrown away when the page changes. Nothing is stored
+        unless the page itself is in the cache. """
+        entry = self._load_entry(filename)
+        if entry is not None:
+            entry.setdefault('extra', {})[name] = copy.deepcopy(value)
+            # Just the extras, which are small next to the page
+            self._write_entry_file({'version': self.VERSION,
+                                    'path': entry['path'],
+                                    'stamp': entry['stamp'],
+                                    'extra': entry['extra']},
+                                   suffix='.extra.json')
+
+
+def get_page_cache(meta_dir='_meta'):
+    """ The parsed-page cache stored in the given _meta folder """
+    return PageCache(os.path.join(meta_dir, CACHE_DIR_NAME, 'pages'))
+
+
+class DependencyGraph:
+    """
+    Remembers, for each file written to the output folder, which files it
+    was made from: the source file, the theme's templates and the tag and
+    category data. This allows an incremental build to skip any output
+    whose inputs haven't changed since the last build.
+
+    Each input is recorded as [size, mtime, sha1]. If the size and mtime
+    differ, the sha1 is checked as well, so a file that has been rewritten
+    with the same contents (as the components do on every build) does not
+    count as a change.
+
+    If the settings (the default theme and template) change, everything is
+    rebuilt.
+    """
+    VERSION = 2
+
+    def __init__(self, state_file, settings):
+        self.state_file = state_file
+        self.settings = settings
+        self.outputs = {}
+        self._seen = set()
+        self._fingerprints = {}
+        try:
+            with open(state_file, 'r') as state_fh:
+                state = json.load(state_fh)
+        except (OSError, ValueError):
+            return
+        if (state.get('version') == self.VERSION and
+                state.get('settings') == settings):
+            self.outputs = state['outputs']
+
+    def _fingerprint(self, path, stamp):
+        """ [size, mtime, sha1] of a file, hashed at most once per build """
+        if path not in self._fingerprints:
+            self._fingerprints[path] = stamp + [file_digest(path)]
+        return self._fingerprints[path]
+
+    def _unchanged(self, path, recorded):
+        stamp = file_stamp(path)
+        if stamp is None:
+            return False
+        if stamp == recorded[:2]:
+            return True
+        if self._fingerprint(path, stamp)[2] != recorded[2]:
+            return False
+        # Same contents; remember the new stamp to save hashing next time
+        recorded[:2] = stamp
+        return True
+
+    def is_fresh(self, output_file_path, source, output_dir):
+        """ Is the output up to date with everything it was made from, and
+        was it made from this source? (A page in _meta/ replaces the one in
+        the content folder.) """
+        record = self.outputs.get(output_file_path)
+        if record is None or record.get('failed') or \
+                record['source'] != source:
+            return False
+        if not os.path.exists(os.path.join(output_dir, output_file_path)):
+            return False
+        for path, recorded in record['deps'].items():
+            if not self._unchanged(path, recorded):
+                return False
+        self._seen.add(output_file_path)
+        return True
+
+    def record(self, output_file_path, source, dependencies, theme=None):
+        """ Note which files an output has just been made from, and the
+        theme it was rendered with (if it's a page)
+        """
+        deps = {}
+        for path in [source] + list(dependencies):
+            stamp = file_stamp(path)
+            if stamp is not None:
+                deps[path] = self._fingerprint(path, stamp)
+        self.outputs[output_file_path] = {'source': source, 'deps': deps,
+                                          'theme': theme}
+        self._seen.add(output_file_path)
+
+    def failed(self, output_file_path):
+        """ Note that an output couldn't be rebuilt. The last good one is
+        kept (it isn't treated as unseen), but it's made again by the next
+        build. """
+        record = self.outputs.get(output_file_path)
+        if record is not None:
+            record['failed'] = True
+        self._seen.add(output_file_path)
+
+    def theme(self, output_file_path):
+        """ The theme an output was last rendered with, or None """
+        return self.outputs.get(output_file_path, {}).get('theme')
+
+    def forget_unseen(self):
+        """ Drop the outputs that weren't fresh or rebuilt in this
+        build (i.e. their source has gone away).
+        Returns the list of output file paths that were dropped.
+        """
+        unseen = sorted(set(self.outputs) - self._seen)
+        for output_file_path in unseen:
+            del self.outputs[output_file_path]
+        return unseen
+
+    def save(self):
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir and not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        write_json_atomic(self.state_file, {'version': self.VERSION,
+                                            'settings': self.settings,
+                                            'outputs': self.outputs})
+
+
 class HtmlFileReader:
-    def __init__(self, filename):
+    # The name of the page cache extra holding the result of read_meta()
+    HEAD_EXTRA = '_head'
+
+    def __init__(self, filename, cache=None):
         """ filename is the full relative path to the file
         and probably contains at least one '/' character.
+
+        cache is an optional PageCache.
         """
         self.filename = filename
+        self.cache = cache
 
     def load(self):
         """ Load the HTML from file into memory """
         full_path = self.filename
         with open(full_path, 'r') as content_fh:
             raw_html = content_fh.read()
+        count_bytes(read=len(raw_html))
         return raw_html
 
     def read(self):
+        """ Read the title, content and meta-data of the page (see
+        parse_html()), from the cache if it's there.
+
+        N.B. the '_raw_metas' are HTML strings rather than Tags.
+        """
+        if self.cache is not None:
+            page_data = self.cache.get(self.filename)
+            if page_data is not None:
+                return page_data
+
         raw_html = self.load()
-        return self.parse_html(raw_html)
+        # The same as we'd get from the cache next time
+        page_data = storable_page_data(self.parse_html(raw_html))
+
+        if self.cache is not None:
+            # With the <head> on its own, for read_meta()
+            self.cache.put(self.filename, page_data, extra={
+                self.HEAD_EXTRA: self.parse_head([raw_html])})
+        return page_data
 
     def _get_title(self, soup):
         """ Given a 'Soup' Object, find the title."""
@@ -208,8 +1341,14 @@ class HtmlFileReader:
 
     def _get_meta_data(self, soup):
         """ Given a 'Soup' Object, find the page meta-data"""
-        meta_data = {}
         all_meta_tags = soup.find_all('meta')
+        return self._meta_data_from_tags(
+            all_meta_tags, [meta_tag.attrs for meta_tag in all_meta_tags])
+
+    def _meta_data_from_tags(self, all_meta_tags, all_meta_attrs):
+        """ Find the page meta-data, given the <meta> tags and a dict of
+        the attributes of each of them """
+        meta_data = {}
         meta_data['_raw_metas'] = all_meta_tags
         # Valid meta-tags are based on the tags supported by Pelican, with a
         # few extra ones that I consider useful (e.g. a page can be in
@@ -218,12 +1357,12 @@ class HtmlFileReader:
         valid_metatag_names = ['authors', 'categories', 'category', 'date',
                                'modified', 'summary', 'tags', 'theme',
                                'template']
-        for meta_tag in all_meta_tags:
+        for meta_tag in all_meta_attrs:
             # e.g <meta name="category" content="misc" />
             for attr in valid_metatag_names:
-                if 'name' in meta_tag.attrs.keys():
+                if 'name' in meta_tag.keys():
                     if (meta_tag['name'] == attr and
-                            'content' in meta_tag.attrs.keys()):
+                            'content' in meta_tag.keys()):
 
                         # Special case: merge category and categories
                         if attr == 'category':
@@ -246,18 +1385,411 @@ class HtmlFileReader:
         meta_data['title'] = title
         return {'content': page_content, 'title': title, 'meta': meta_data}
 
+    def read_meta(self):
+        """ Read just the title and meta-data of the page.
+
+        Returns a 'title' and 'meta' like read(), but no 'content'. Only
+        the <head> of the file is read and parsed, so this is much quicker
+        than read() for long pages; but it means that any <title> or <meta>
+        tags after the <head> are left out (whereas read() includes them).
+        The result is the same whether or not the page is in the cache.
+
+        N.B. the '_raw_metas' are HTML strings rather than Tags.
+        """
+        if self.cache is not None:
+            head = self.cache.get_extra(self.filename, self.HEAD_EXTRA)
+            if head is not None:
+                return head
+
+        with open(self.filename, 'r') as content_fh:
+            head = self.parse_head(iter(lambda: content_fh.read(8192), ''))
+        if self.cache is not None:
+            # Only kept if the whole page is in the cache too
+            self.cache.put_extra(self.filename, self.HEAD_EXTRA, head)
+        return head
+
+    def parse_head(self, html_chunks):
+        """ Parse the title and <meta> tags from an HTML document, given
+        as an iterable of strings. Stops at the end of the <head>. """
+        parser = etree.HTMLPullParser(events=('start', 'end'))
+        titles = []
+        all_meta_tags = []
+
+        def handle_events():
+            """ returns True once we've got to the end of the head """
+            for event, element in parser.read_events():
+                if event == 'start':
+                    if element.tag == 'body':
+                        return True
+                elif element.tag == 'title':
+                    titles.append(element.text or '')
+                elif element.tag == 'meta':
+                    all_meta_tags.append(element)
+                elif element.tag == 'head':
+                    return True
+            return False
+
+        finished = False
+        for chunk in html_chunks:
+            parser.feed(chunk)
+            finished = handle_events()
+            if finished:
+                break
+        if not finished:
+            try:
+                parser.close()
+            except etree.XMLSyntaxError:
+                # e.g. an empty document
+                pass
+            handle_events()
+
+        if titles:
+            title = titles[0]
+        else:
+            title = '[[NO TITLE FOUND]]'
+        meta_data = self._meta_data_from_tags(
+            [etree.tostring(meta_tag, encoding='unicode', method='html',
+                            with_tail=False) for meta_tag in all_meta_tags],
+            [dict(meta_tag.attrib) for meta_tag in all_meta_tags])
+        meta_data['title'] = title
+        return {'title': title, 'meta': meta_data}
+
+
+def paginated_file_name(file_name, page_number):
+    """ The name of a page of a paginated file, e.g. index.html,
+    index_2.html, index_3.html... """
+    if page_number == 1:
+        return file_name
+    base, extension = os.path.splitext(file_name)
+    return '%s_%d%s' % (base, page_number, extension)
+
+
+class PaginatedWriter:
+    """
+    Writes a list of entries (e.g. the previews on the homepage) to a
+    series of HTML files, with at most entries_per_page entries in each;
+    e.g. index.html, index_2.html, index_3.html...
+
+    Each entry is written out as soon as it is added, so only one entry
+    needs to be held in memory at a time.
+
+    Args:
+        file_path: the path of the first file, e.g. ../_meta/index.html
+        num_entries: the number of entries that will be added
+        entries_per_page: 0 means put all the entries in one file
+        header: a function which, given the page number, returns the HTML
+            at the start of that page
+        footer: HTML at the end of each page
+        separator: HTML between the header, entries and footer
+    """
+    def __init__(self, file_path, num_entries, entries_per_page, header,
+                 footer=None, separator=''):
+        self.file_path = file_path
+        self.entries_per_page = entries_per_page or max(num_entries, 1)
+        self.num_pages = max(1, -(-num_entries // self.entries_per_page))
+        self.header = header
+        self.footer = footer
+        self.separator = separator
+        self._page_number = 0
+        self._entries_on_page = 0
+        self._output_fh = None
+
+    def page_path(self, page_number):
+        return paginated_file_name(self.file_path, page_number)
+
+    def pagination_html(self, page_number):
+        """ Links to the previous and next pages """
+        links = []
+        if page_number > 1:
+            links.append('<a href="%s">&laquo; Previous</a>' % (
+                os.path.basename(self.page_path(page_number - 1))))
+        links.append('Page %d of %d' % (page_number, self.num_pages))
+        if page_number < self.num_pages:
+            links.append('<a href="%s">Next &raquo;</a>' % (
+                os.path.basename(self.page_path(page_number + 1))))
+        return '<div class="awcm-pagination">%s</div>' % ' | '.join(links)
+
+    def _start_page(self):
+        self._page_number += 1
+        self._entries_on_page = 0
+        self._output_fh = open(self.page_path(self._page_number), 'w',
+                               buffering=WRITE_BUFFER_SIZE)
+        self._output_fh.write(self.header(self._page_number))
+
+    def _finish_page(self):
+        if self.num_pages > 1:
+            self._output_fh.write(self.separator)
+            self._output_fh.write(self.pagination_html(self._page_number))
+        if self.footer is not None:
+            self._output_fh.write(self.separator)
+            self._output_fh.write(self.footer)
+        self._output_fh.close()
+        self._output_fh = None
+
+    def add(self, html_bits):
+        """ Add an entry, given as a list of bits of HTML """
+        if self._output_fh is None:
+            self._start_page()
+        elif self._entries_on_page == self.entries_per_page:
+            self._finish_page()
+            self._start_page()
+        self._output_fh.write(self.separator)
+        self._output_fh.write(self.separator.join(html_bits))
+        self._entries_on_page += 1
+
+    def close(self):
+        if self._output_fh is None:
+            # No entries, but there should still be a page
+            self._start_page()
+        self._finish_page()
+
+        # Remove any pages left over from a time when there were more
+        page_number = self._page_number + 1
+        while os.path.exists(self.page_path(page_number)):
+            os.remove(self.page_path(page_number))
+            page_number += 1
+
+
+# The limits on each sitemap file, from https://www.sitemaps.org/protocol.html
+SITEMAP_MAX_URLS = 50000
+SITEMAP_MAX_BYTES = 50 * 1024 * 1024
+
+SITEMAP_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<%s xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+
+
+def w3c_datetime(text):
+    """ A date from a page's meta-data (e.g. "2015-04-24 10:00") as a W3C
+    date for a sitemap, or None if it isn't one. Times without a time zone
+    are left out, as the sitemap would need the time zone. """
+    try:
+        parsed = datetime.datetime.fromisoformat(text.strip())
+    except (AttributeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        return parsed.date().isoformat()
+    return parsed.isoformat()
+
+
+class SitemapWriter:
+    """
+    Writes an XML sitemap (see https://www.sitemaps.org/protocol.html) of
+    the pages in the website.
+
+    Each URL is written out as soon as it is added. If there are more than
+    max_urls, or the file would be bigger than max_bytes, they are split
+    over several files, e.g. sitemap-1.xml, sitemap-2.xml..., and file_path
+    becomes a sitemap index listing them.
+
+    Args:
+        file_path: the path of the sitemap, at the top of the website, e.g.
+            ../_meta/sitemap.xml
+        site_url: the URL of the website, e.g. https://example.com/
+    """
+    def __init__(self, file_path, site_url, max_urls=SITEMAP_MAX_URLS,
+                 max_bytes=SITEMAP_MAX_BYTES):
+        self.file_path = file_path
+        self.site_url = site_url.rstrip('/') + '/'
+        self.max_urls = max_urls
+        self.max_bytes = max_bytes
+        self._footer = b'</urlset>\n'
+        self._num_files = 0
+        self._urls_in_file = 0
+        self._bytes_in_file = 0
+        self._output_fh = None
+
+    def shard_path(self, number):
+        base, extension = os.path.splitext(self.file_path)
+        return '%s-%d%s' % (base, number, extension)
+
+    def url(self, path):
+        """ The URL of a file, given its path in the website """
+        return self.site_url + urllib.parse.quote(path.replace(os.sep, '/'))
+
+    def _write(self, text):
+        data = text.encode('utf-8')
+        self._output_fh.write(data)
+        self._bytes_in_file += len(data)
+
+    def _start_file(self):
+        self._num_files += 1
+        self._urls_in_file = 0
+        self._bytes_in_file = 0
+        self._output_fh = open(self.shard_path(self._num_files), 'wb',
+                               buffering=WRITE_BUFFER_SIZE)
+        self._write(SITEMAP_HEADER % 'urlset')
+
+    def _finish_file(self):
+        self._output_fh.write(self._footer)
+        self._output_fh.close()
+        self._output_fh = None
+
+    def add(self, path, lastmod=None):
+        """ Add a page, given its path in the website, and (optionally) when
+        it was last changed, as a W3C date (see w3c_datetime()) """
+        entry = '<url><loc>%s</loc>' % saxutils.escape(self.url(path))
+        if lastmod:
+            entry += '<lastmod>%s</lastmod>' % saxutils.escape(lastmod)
+        entry += '</url>\n'
+        size = len(entry.encode('utf-8'))
+        if self._output_fh is None:
+            self._start_file()
+        elif self._urls_in_file == self.max_urls or \
+                self._bytes_in_file + size + len(self._footer) > \
+                self.max_bytes:
+            self._finish_file()
+            self._start_file()
+        self._write(entry)
+        self._urls_in_file += 1
+
+    def close(self):
+        """ Finish the sitemap. Returns the number of files it was split
+        over. """
+        if self._output_fh is None:
+            # No pages, but there should still be a sitemap
+            self._start_file()
+        self._finish_file()
+
+        if self._num_files == 1:
+            os.replace(self.shard_path(1), self.file_path)
+        else:
+            with open(self.file_path, 'w', encoding='utf-8') as index_fh:
+                index_fh.write(SITEMAP_HEADER % 'sitemapindex')
+                for number in range(1, self._num_files + 1):
+                    index_fh.write('<sitemap><loc>%s</loc></sitemap>\n' % (
+                        saxutils.escape(self.url(os.path.basename(
+                            self.shard_path(number))))))
+                index_fh.write('</sitemapindex>\n')
+
+        # Remove any files left over from a time when there were more
+        number = self._num_files + 1
+        while os.path.exists(self.shard_path(number)):
+            os.remove(self.shard_path(number))
+            number += 1
+        return self._num_files
+
+
+class SiteIndex:
+    """
+    The pages in the content folder, for use by component generators.
+
+    The list of files is only collected once, and pages are read through
+    the page cache. When the components are run by run_components(), they
+    all share the same SiteIndex, so nothing is read more than once.
+
+    If keep_pages is set, the pages are also kept in memory once they have
+    been read (e.g. for `awcm watch`, which runs the components again and
+    again); use forget() when a page changes.
+    """
+    def __init__(self, content_dir, meta_dir):
+        self.content_dir = os.path.abspath(content_dir)
+        self.cache = get_page_cache(os.path.abspath(meta_dir))
+        self.keep_pages = False
+        self._filenames = None
+        self._extras = {}
+        self._pages = {}
+        self._metas = {}
+
+    def filenames(self):
+        """ All the files in the content folder, as get_all_filenames()
+        would return them """
+        if self._filenames is None:
+            self._filenames = get_all_filenames(self.content_dir)
+        return list(self._filenames)
+
+    def read(self, page):
+        """ The data for a page, as returned by HtmlFileReader.read() """
+        if page in self._pages:
+            return self._pages[page]
+        page_data = HtmlFileReader(os.path.join(self.content_dir, page),
+                                   cache=self.cache).read()
+        if self.keep_pages:
+            self._pages[page] = page_data
+        return page_data
+
+    def read_meta(self, page):
+        """ The title and meta-data for a page, as returned by
+        HtmlFileReader.read_meta() """
+        if page in self._metas:
+            return self._metas[page]
+        page_meta = HtmlFileReader(os.path.join(self.content_dir, page),
+                                   cache=self.cache).read_meta()
+        if self.keep_pages:
+            self._metas[page] = page_meta
+        return page_meta
+
+    def forget(self, page):
+        """ Forget what we know about a page, because it has changed (or
+        been added or deleted) """
+        self._filenames = None
+        self._pages.pop(page, None)
+        self._metas.pop(page, None)
+        for key in [key for key in self._extras if key[0] == page]:
+            del self._extras[key]
+
+    def extra(self, page, name, compute):
+        """ Something worked out from a page, such as a summary.
+        compute(page) is only called if the value isn't already known from
+        earlier in this run or from the page cache. The value must be
+        something that can be saved as JSON.
+        """
+        if (page, name) not in self._extras:
+            filename = os.path.join(self.content_dir, page)
+            value = self.cache.get_extra(filename, name)
+            if value is None:
+                value = compute(page)
+                self.cache.put_extra(filename, name, value)
+            self._extras[(page, name)] = value
+        return self._extras[(page, name)]
+
+
+_SITE_INDEXES = {}
+
+
+def get_site_index(content_dir='./content', meta_dir='_meta'):
+    """ The SiteIndex for the content folder, shared by everything in
+    this process """
+    key = (os.path.abspath(content_dir), os.path.abspath(meta_dir))
+    if key not in _SITE_INDEXES:
+        _SITE_INDEXES[key] = SiteIndex(content_dir, meta_dir)
+    return _SITE_INDEXES[key]
+
+
+def reset_site_index():
+    """ Forget the shared SiteIndex, e.g. because the content has
+    changed """
+    _SITE_INDEXES.clear()
+
 
 class TemplateWriter:
-    def __init__(self, templates_dir):
+    def __init__(self, templates_dir, bytecode_cache_dir=None):
+        """ templates_dir is the folder containing the themes.
+
+        If bytecode_cache_dir is given, compiled templates are saved there
+        so that later builds don't need to compile them again.
+
+        Templates are only read, and themes only validated, once for each
+        TemplateWriter, so use a new TemplateWriter if they may have changed.
+        """
         template_loader = jinja2.FileSystemLoader(searchpath=templates_dir)
-        self.template_env = jinja2.Environment(loader=template_loader)
+        bytecode_cache = None
+        if bytecode_cache_dir is not None:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+        self.template_env = jinja2.Environment(loader=template_loader,
+                                               bytecode_cache=bytecode_cache)
         self._templates_dir = templates_dir
+        self._template_files = {}
+        self._templates = {}
+        self._validated_themes = {}
 
     def read(self, template_file):
         """ Read a template file.
         template_file is the full path to the template"""
-        tmpl = self.template_env.get_template(template_file)
-        return tmpl
+        if template_file not in self._templates:
+            self._templates[template_file] = self.template_env.get_template(
+                template_file)
+        return self._templates[template_file]
 
     def write(self, output_dir, output_file_path, theme_name, template_name,
               tokens):
@@ -270,7 +1802,13 @@ class TemplateWriter:
             template_name: name of the template
             tokens: Template tokens
         """
+        DirectorySink(output_dir).write_page(
+            output_file_path, self.stream(output_file_path, theme_name,
+                                          template_name, tokens))
 
+    def stream(self, output_file_path, theme_name, template_name, tokens):
+        """ A jinja2 TemplateStream for a page, for write() (which
+        explains the arguments) """
         if template_name[-6:] != '.thtml':
             template_name = template_name + '.thtml'
 
@@ -280,20 +1818,32 @@ class TemplateWriter:
                                               template_name))
         except jinja2.exceptions.TemplateNotFound as exc:
             # str(exc) gives us the path to the missing template
-            print("\nERROR: Could not read template file: %s\n" %
-                  os.path.join(self._templates_dir, str(exc)))
-            print("Terminating")
-            sys.exit()
+            raise BuildError("Could not read template file: %s" %
+                             os.path.join(self._templates_dir, str(exc)))
 
         tokens['back_path'] = get_back_path(output_file_path)
         tokens['theme_path'] = tokens['back_path'] + 'themes/' + \
             theme_name + '/'
-        full_save_path = os.path.join(output_dir, output_file_path)
-
-        with open(full_save_path, 'w') as output_fh:
-            output_fh.write(template.render(tokens))
+        return template.stream(tokens)
+
+    def template_files(self, theme_name):
+        """ All the template files for a theme. Any of them might be
+        used by a page (e.g. via {% extends %} or {% include %}) """
+        if theme_name not in self._template_files:
+            templates_path = os.path.join(self._templates_dir, theme_name,
+                                          'templates')
+            self._template_files[theme_name] = sorted(
+                os.path.join(templates_path, filename)
+                for filename in get_all_filenames(templates_path))
+        return self._template_files[theme_name]
 
     def validate_template(self, theme_name):
+        if theme_name not in self._validated_themes:
+            self._validated_themes[theme_name] = self._validate_template(
+                theme_name)
+        return self._validated_themes[theme_name]
+
+    def _validate_template(self, theme_name):
         expected_files = [
             'templates/common.thtml',
             'templates/navigation.thtml',
@@ -312,9 +1862,8 @@ def get_tag_list_as_html(back_path=''):
     """
     Generate a <UL> list of tags to be injected into the template
     """
-    tags_file = os.path.join('_meta', '000_tags.json')
     nav_page_fmt = back_path + '000_nav_tag_%s.html'
-    return get_tag_or_category_as_html(tags_file, nav_page_fmt,
+    return get_tag_or_category_as_html(TAGS_DATA_FILE, nav_page_fmt,
                                        'awcm-tag')
 
 
@@ -322,9 +1871,8 @@ def get_category_list_as_html(back_path=''):
     """
     Generate a <UL> list of categories to be injected into the template
     """
-    categories_file = os.path.join('_meta', '000_categories.json')
     nav_page_fmt = back_path + '000_nav_category_%s.html'
-    return get_tag_or_category_as_html(categories_file, nav_page_fmt,
+    return get_tag_or_category_as_html(CATEGORIES_DATA_FILE, nav_page_fmt,
                                        'awcm-category')
 
 
@@ -333,16 +1881,61 @@ def get_tag_or_category_as_html(data_file, nav_page_fmt, css_class):
     if os.path.exists(data_file):
         with open(data_file) as data_fh:
             all_tags = json.load(data_fh)
-            html = ['<ul class="{}">'.format(css_class)]
-            for tag in all_tags.keys():
-                url = nav_page_fmt % tag
-                html.append('<li><a href="%s">%s</a>&nbsp;(%d)</li> ' %
-                            (url, tag, len(all_tags[tag])))
-            html.append('</ul>')
-            # print(html)
-            return ''.join(html)
+            return tag_or_category_data_as_html(all_tags, nav_page_fmt,
+                                                css_class)
     return ''
-    
+
+
+def tag_or_category_data_as_html(all_tags, nav_page_fmt, css_class):
+    """ Generate a <UL> list from the tag or category data """
+    html = ['<ul class="{}">'.format(css_class)]
+    for tag in all_tags.keys():
+        url = nav_page_fmt % tag
+        html.append('<li><a href="%s">%s</a>&nbsp;(%d)</li> ' %
+                    (url, tag, len(all_tags[tag])))
+    html.append('</ul>')
+    return ''.join(html)
+
+
+class NavLists:
+    """
+    The lists of tags and categories injected into every page, as made by
+    get_tag_list_as_html() and get_category_list_as_html().
+
+    The tag and category data is only read once, and each list is only
+    made once for each back_path, however many pages use it. Use a new
+    NavLists for each build.
+    """
+    def __init__(self):
+        self._data = {}
+        self._html = {}
+
+    def _as_html(self, data_file, nav_page_fmt, css_class):
+        if data_file not in self._data:
+            if os.path.exists(data_file):
+                with open(data_file) as data_fh:
+                    self._data[data_file] = json.load(data_fh)
+            else:
+                self._data[data_file] = None
+
+        key = (data_file, nav_page_fmt)
+        if key not in self._html:
+            if self._data[data_file] is None:
+                self._html[key] = ''
+            else:
+                self._html[key] = tag_or_category_data_as_html(
+                    self._data[data_file], nav_page_fmt, css_class)
+        return self._html[key]
+
+    def tags_html(self, back_path=''):
+        return self._as_html(TAGS_DATA_FILE,
+                             back_path + '000_nav_tag_%s.html', 'awcm-tag')
+
+    def categories_html(self, back_path=''):
+        return self._as_html(CATEGORIES_DATA_FILE,
+                             back_path + '000_nav_category_%s.html',
+                             'awcm-category')
+
 
 def get_template_name(article_data):
     """
@@ -380,84 +1973,476 @@ def get_theme_name(article_data):
     return theme
 
 
-def make_pages_from_template(templates_dir, output_dir):
-    t = TemplateWriter(templates_dir)
-
-    for input_source in [CONFIG['content_dir'], '_meta']:
-        for file_path in get_all_filenames(input_source):
-            if file_path.split('.')[-1] in ['html', 'htm']:
-               
-                if CONFIG['debug']:
-                    print("Writing %s from %s" % (file_path, input_source))
-
-                article_data = HtmlFileReader(
-                    os.path.join(input_source, file_path)).read()
-
-                template = get_template_name(article_data)
-                theme_name = get_theme_name(article_data)
-
-                t.validate_template(theme_name)
-
-                back_path = get_back_path(file_path)
-                tokens = {'title': article_data['title'],
-                          'article': article_data['content'],
-                          'tags_html': get_tag_list_as_html(
-                              back_path=back_path),
-                          'categories_html': get_category_list_as_html(
-                              back_path=back_path),
-                          }
-
-                # everything about a page:
-                #   - file_path (source file)
-                #   - theme_name (from config, could be overridden in
-                #                 the metadata)
-                #   - article_data
-                #   - template (name of the template to use)
-                #   - output_file_path (currently same as source path; could be
-                #           overridden in metadata)
-
-                full_output_path = os.path.join(output_dir, file_path)
-
-                # Make the folder
-                full_output_dir = os.path.dirname(full_output_path)
-                if not os.path.exists(full_output_dir):
-                    os.makedirs(full_output_dir)
-
-                t.write(output_dir=output_dir,
-                        output_file_path=file_path,
-                        theme_name=theme_name,
-                        template_name=template,
-                        tokens=tokens)
-                # TODO: Collect the theme names as we go.
-
-            elif input_source == '_meta' and\
-                    file_path.split('.')[-1] in ['json', 'yml', 'yaml']:
-                # Ignore data files in _meta/
-                pass
+def render_page(writer, input_source, file_path, sink, cache=None,
+                nav_lists=None):
+    """
+    Render a single page from input_source through its template into the
+    output sink (e.g. a DirectorySink for the output folder).
+
+    nav_lists is the NavLists for this build (a new one is used if it's not
+    given).
+
+    Returns the name of the theme used for the page.
+    """
+    if CONFIG['debug']:
+        print("Writing %s from %s" % (file_path, input_source))
+    theme_name, template, tokens = prepare_page(
+        writer, input_source, file_path, cache=cache, nav_lists=nav_lists)
+    sink.write_page(file_path, writer.stream(file_path, theme_name, template,
+                                             tokens))
+    return theme_name
+
+
+def prepare_page(writer, input_source, file_path, cache=None,
+                 nav_lists=None):
+    """
+    Read a page from input_source, and work out how to render it (see
+    render_page() for the arguments).
+
+    Returns the theme name, the template name and the template tokens.
+    """
+    if nav_lists is None:
+        nav_lists = NavLists()
+
+    with profile_phase('parse'):
+        article_data = HtmlFileReader(os.path.join(input_source, file_path),
+                                      cache=cache).read()
+
+    with profile_phase('token build'):
+        template = get_template_name(article_data)
+        theme_name = get_theme_name(article_data)
+
+        writer.validate_template(theme_name)
+
+        back_path = get_back_path(file_path)
+        tokens = {'title': article_data['title'],
+                  'article': article_data['content'],
+                  'tags_html': nav_lists.tags_html(back_path=back_path),
+                  'categories_html': nav_lists.categories_html(
+                      back_path=back_path),
+                  }
+
+    # everything about a page:
+    #   - file_path (source file)
+    #   - theme_name (from config, could be overridden in
+    #                 the metadata)
+    #   - article_data
+    #   - template (name of the template to use)
+    #   - output_file_path (currently same as source path; could be
+    #           overridden in metadata)
+    return theme_name, template, tokens
+
+
+def get_template_writer(templates_dir):
+    """ A TemplateWriter that keeps compiled templates in _meta/_cache/ """
+    return TemplateWriter(templates_dir, bytecode_cache_dir=os.path.join(
+        '_meta', CACHE_DIR_NAME, 'templates'))
+
+
+# Each process in the rendering pool has its own TemplateWriter, set up by
+# _init_render_worker()
+_WORKER = {}
+
+
+def _init_render_worker(templates_dir, config, profile):
+    CONFIG.update(config)
+    # Forget anything the parent process had profiled before forking
+    stop_profile()
+    if profile:
+        start_profile()
+    _WORKER['writer'] = get_template_writer(templates_dir)
+    _WORKER['cache'] = get_page_cache('_meta')
+    _WORKER['nav_lists'] = NavLists()
+
+
+def _render_page_in_worker(job):
+    """ Render a page in a pool process. Errors are sent back to the parent
+    process rather than raised, so that they can be reported per page.
+
+    The job's sink is None if the page can't be written from this process
+    (e.g. it goes into an ArchiveSink); the page is then sent back.
+
+    Returns (theme_name, error_message, profile, page); one of the first
+    two will be None, profile is the BuildProfile data for the page, if
+    profiling, and page is the page, if it's been sent back.
+    """
+    input_source, file_path, sink = job
+    memory_sink = None
+    if sink is None:
+        sink = memory_sink = MemorySink()
+    cache = _WORKER['cache'] if input_source != '_meta' else None
+    result = _render_page_timed(_WORKER['writer'], input_source, file_path,
+                                sink, cache=cache,
+                                nav_lists=_WORKER['nav_lists'],
+                                catch_errors=True)
+    profile = get_profile()
+    page = memory_sink.pages.pop(file_path, None) if memory_sink else None
+    return result + (profile.take() if profile is not None else None, page)
+
+
+def _render_page_timed(writer, input_source, file_path, sink, cache,
+                       nav_lists, catch_errors=False):
+    """ render_page(), noting how long the page took if we're profiling.
+    If catch_errors is set, errors are returned rather than raised.
+
+    Returns (theme_name, error_message).
+    """
+    start = time.perf_counter()
+    try:
+        result = render_page(writer, input_source, file_path, sink,
+                             cache=cache, nav_lists=nav_lists), None
+    except Exception:
+        if not catch_errors:
+            raise
+        exc_type, exc_value = sys.exc_info()[:2]
+        result = None, ''.join(
+            traceback.format_exception_only(exc_type, exc_value)).strip()
+    profile = get_profile()
+    if profile is not None:
+        profile.add_page(os.path.normpath(os.path.join(input_source,
+                                                       file_path)),
+                         time.perf_counter() - start)
+    return result
+
+
+def _write_pages(sink, results):
+    """ Write any pages sent back by the rendering pool into sink, as the
+    (job, result) pairs go by """
+    for job, result in results:
+        theme_name, error, profile, page = result
+        if page is not None:
+            sink.add_page(job[1], page)
+        yield job, (theme_name, error, profile)
+
+
+def make_pages_from_template(templates_dir, output_dir, incremental=None,
+                             jobs=None, writer=None, sink=None):
+    """
+    Render every page in the content folder and _meta/ through its template,
+    and copy everything else to the output folder.
+
+    sink is where the files are written (see DirectorySink and ArchiveSink);
+    by default, into output_dir. The pages are written in order of their
+    paths, followed by the other files.
+
+    In an incremental build (see DependencyGraph), outputs whose inputs
+    haven't changed since the last build are left alone, and outputs whose
+    source has been deleted are removed. Builds into a sink that doesn't
+    keep the last build's files (e.g. an archive) are never incremental.
+
+    If jobs is more than 1, the pages are rendered by a pool of that many
+    processes. (0 means one process per CPU.)
+
+    Any pages that can't be rendered are reported, and a BuildError raised,
+    once the other pages have been written. In an incremental build, their
+    last good outputs are kept, and they are tried again next time.
+
+    writer is the TemplateWriter to use when rendering in this process; by
+    default a new one is made.
+
+    Returns the set of theme names the pages use, including any pages that
+    were up to date.
+    """
+    if incremental is None:
+        incremental = CONFIG['incremental']
+    if jobs is None:
+        jobs = CONFIG['jobs']
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    if sink is None:
+        sink = DirectorySink(output_dir)
+    if not sink.incremental:
+        incremental = False
+
+    t = writer if writer is not None else get_template_writer(templates_dir)
+    page_cache = get_page_cache('_meta')
+    nav_lists = NavLists()
+    graph = None
+    if incremental:
+        graph = DependencyGraph(
+            os.path.join('_meta', CACHE_DIR_NAME, 'build_state.json'),
+            settings={'theme': CONFIG['theme'],
+                      'default_template': CONFIG['default_template'],
+                      'output_path': output_dir})
+
+    # Pages to render and files to copy, keyed by the output file. If the
+    # same file is in both the content folder and _meta/, the one in _meta/
+    # wins.
+    pages = {}
+    copies = {}
+    themes = set()
+    with profile_phase('discovery'):
+        for input_source in [CONFIG['content_dir'], '_meta']:
+            for file_path in get_all_filenames(input_source):
+                if input_source == '_meta' and \
+                        file_path.startswith(CACHE_DIR_NAME + '/'):
+                    # Ignore our own cache files
+                    continue
+
+                source_path = os.path.join(input_source, file_path)
+
+                if file_path.split('.')[-1] in ['html', 'htm']:
+                    if graph is not None and graph.is_fresh(
+                            file_path, source_path, output_dir):
+                        # Don't render the content folder's copy over an
+                        # up to date one from _meta/
+                        pages.pop(file_path, None)
+                        themes.add(graph.theme(file_path))
+                        continue
+                    pages.pop(file_path, None)
+                    pages[file_path] = input_source
+
+                elif input_source == '_meta' and\
+                        file_path.split('.')[-1] in ['json', 'yml', 'yaml']:
+                    # Ignore data files in _meta/
+                    pass
+                else:
+                    if graph is not None and graph.is_fresh(
+                            file_path, source_path, output_dir):
+                        copies.pop(file_path, None)
+                        continue
+                    copies[file_path] = source_path
+
+    jobs_list = [(input_source, file_path)
+                 for file_path, input_source in sorted(pages.items())]
+    pool = None
+    if jobs > 1 and len(jobs_list) > 1:
+        pool = multiprocessing.Pool(
+            jobs, initializer=_init_render_worker,
+            initargs=(templates_dir, dict(CONFIG),
+                      get_profile() is not None))
+        # Workers can write into the output folder themselves, but anything
+        # else gets the pages sent back, in order, to write here
+        worker_sink = sink if isinstance(sink, DirectorySink) else None
+        results = pool.imap(_render_page_in_worker,
+                            [(input_source, file_path, worker_sink)
+                             for input_source, file_path in jobs_list],
+                            chunksize=max(1, len(jobs_list) // (jobs * 8)))
+    else:
+        results = []
+        for input_source, file_path in jobs_list:
+            cache = page_cache if input_source != '_meta' else None
+            results.append(_render_page_timed(
+                t, input_source, file_path, sink, cache=cache,
+                nav_lists=nav_lists, catch_errors=True) + (None, None))
+
+    failed = []
+    try:
+        results = list(_write_pages(sink, zip(jobs_list, results)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for (input_source, file_path), (theme_name, error,
+                                    worker_profile) in results:
+        if worker_profile is not None:
+            get_profile().merge(worker_profile)
+        if error is not None:
+            print("\nERROR: Could not build %s from %s: %s" % (
+                file_path, input_source, error))
+            failed.append(file_path)
+            if graph is not None:
+                graph.failed(file_path)
+            continue
+        themes.add(theme_name)
+        if graph is not None:
+            graph.record(file_path, os.path.join(input_source, file_path),
+                         t.template_files(theme_name) +
+                         [TAGS_DATA_FILE, CATEGORIES_DATA_FILE],
+                         theme=theme_name)
+
+    # Everything else is copied unmodified, unless the output folder
+    # already has a copy
+    copies = sorted(copies.items())
+    with profile_phase('content copy'):
+        copied = sink.copy_files(copies, link_mode=CONFIG['content_link_mode'])
+    for (file_path, source_path), was_copied in zip(copies, copied):
+        if CONFIG['debug']:
+            print("%s %s" % ("Copy" if was_copied else "Unchanged",
+                             file_path))
+        if graph is not None:
+            graph.record(file_path, source_path, [])
+
+    if graph is not None:
+        for file_path in graph.forget_unseen():
+            if CONFIG['debug']:
+                print("Removing %s (its source has gone)" % file_path)
+            sink.remove(file_path)
+        graph.save()
+
+    if failed:
+        raise BuildError("Could not build %d page(s): %s" % (
+            len(failed), ', '.join(failed)))
+    themes.discard(None)
+    return themes
+
+
+def is_python_component(path):
+    """ Is the component generator a Python script? """
+    if path.endswith('.py'):
+        return True
+    with open(path, 'rb') as component_fh:
+        first_line = component_fh.readline()
+    return first_line.startswith(b'#!') and b'python' in first_line
+
+
+def run_python_component(components_dir, name):
+    """ Run a Python component generator in this process, as if it had
+    been run as ./<name> from inside components_dir.
+    Returns True if it succeeded.
+    """
+    saved_cwd = os.getcwd()
+    saved_argv = sys.argv
+    saved_path = list(sys.path)
+    os.chdir(components_dir)
+    sys.argv = ['./' + name]
+    sys.path.insert(0, os.getcwd())
+    try:
+        runpy.run_path(name, run_name='__main__')
+        return True
+    except SystemExit as exc:
+        return exc.code in [None, 0]
+    except Exception:
+        traceback.print_exc()
+        return False
+    finally:
+        os.chdir(saved_cwd)
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+
+
+def run_components(components_dir='components', profile=False,
+                   reset_index=True, start_at=None):
+    """
+    Run the component generators in components_dir, in numerical order.
+
+    A component generator is any executable file whose name starts with
+    three digits followed by '_' or '-'. Python ones are run inside this
+    process, so they share the imported modules and the SiteIndex; anything
+    else is run as a separate program.
+
+    If profile is set, each component is timed (as are any phases the
+    components add with profile_phase()), and the timings are saved for
+    the build profile report made by main().
+
+    If reset_index is False, the shared SiteIndex is kept from the last run
+    (so anything in it that has changed must have been forgotten). If
+    start_at is given, the components whose names sort before it are not
+    run.
+
+    Raises a BuildError, once all of them have been run, if any failed.
+    """
+    if reset_index:
+        # The content may have changed since the components were last run
+        reset_site_index()
+    if profile:
+        start_profile()
+
+    failed = []
+    for name in sorted(os.listdir(components_dir)):
+        path = os.path.join(components_dir, name)
+        if not re.match(r'\d\d\d[-_]', name) or not os.path.isfile(path):
+            continue
+        if start_at is not None and name < start_at:
+            continue
+        if not os.access(path, os.X_OK):
+            print("IGNORING %s (not executable)" % name)
+            continue
+
+        print(name)
+        sys.stdout.flush()
+        with profile_phase('component ' + name):
+            if is_python_component(path):
+                succeeded = run_python_component(components_dir, name)
             else:
-                if CONFIG['debug']:
-                    print("Not Templatising %s" % file_path)
-                # Just copy the file unmodified.
-                shutil.copy(os.path.join(input_source, file_path),
-                            os.path.join(output_dir, file_path))
-        
-
-def main():
+                succeeded = subprocess.call(['./' + name],
+                                            cwd=components_dir) == 0
+        if not succeeded:
+            print("\nERROR: Component %s failed\n" % name)
+            failed.append(name)
+
+    if profile:
+        mkdir_p(os.path.dirname(COMPONENTS_PROFILE_FILE))
+        write_json_atomic(COMPONENTS_PROFILE_FILE, get_profile().take())
+        stop_profile()
+
+    if failed:
+        raise BuildError("%d component(s) failed: %s" % (
+            len(failed), ', '.join(failed)))
+
+
+def main(jobs=None, profile=None, slowest=10, output_path=None,
+         precompress=None):
+    """
+    Build the website, into output_path if it's given (otherwise the output
+    folder). If that's the name of a tar or zip file (see ARCHIVE_FORMATS),
+    the website is written straight into it.
+
+    If precompress is set (it defaults to the 'precompress' config
+    setting), compressed copies of the pages, CSS and so on are then made;
+    see precompress_files(). That only applies to an output folder.
+
+    If profile is set (it defaults to the 'profile' config setting), a
+    report of where the time went, including the slowest pages and any
+    timings saved by run_components(), is saved to _meta/_cache/profile.json
+    and summarised at the end.
+    """
     read_site_config()
+    if profile is None:
+        profile = CONFIG['profile']
+    if output_path is None:
+        output_path = CONFIG['output_path']
+    if precompress is None:
+        precompress = CONFIG['precompress']
+    if profile:
+        start_profile()
     # Ensure _meta and output folders exist
-    mkdir_p(CONFIG['output_path'])
     mkdir_p('_meta')
-    mkdir_p(os.path.join(CONFIG['output_path'], 'themes'))
+    sink = get_output_sink(output_path)
+    if isinstance(sink, DirectorySink):
+        mkdir_p(output_path)
+        mkdir_p(os.path.join(output_path, 'themes'))
 
-    make_pages_from_template(templates_dir=CONFIG['themes_root'],
-                             output_dir=CONFIG['output_path'])
-
-    theme = CONFIG['theme']
-    theme_static_dir = os.path.join(CONFIG['output_path'], 'themes', theme)
-    mkdir_p(theme_static_dir)
-
-    copy_static_files(templates_dir=CONFIG['themes_root'], theme_name=theme,
-                      output_dir=theme_static_dir)
+    try:
+        try:
+            themes = make_pages_from_template(
+                templates_dir=CONFIG['themes_root'],
+                output_dir=output_path, jobs=jobs, sink=sink)
+
+            with profile_phase('static copy'):
+                copy_all_static_files(templates_dir=CONFIG['themes_root'],
+                                      theme_names=themes | {CONFIG['theme']},
+                                      output_path=output_path,
+                                      sink=sink)
+        except BaseException:
+            sink.discard()
+            raise
+        sink.close()
+
+        if precompress and isinstance(sink, DirectorySink):
+            with profile_phase('precompress'):
+                precompress_files(output_path, jobs=jobs)
+    finally:
+        if profile:
+            save_profile_report(slowest)
+
+
+def save_profile_report(slowest=10):
+    """ Save the build profile, with the components' timings if they were
+    profiled, and print a summary. Profiling is then turned off. """
+    build_profile = get_profile()
+    try:
+        with open(COMPONENTS_PROFILE_FILE, 'r') as profile_fh:
+            build_profile.merge(json.load(profile_fh))
+        # Only report the components' timings once
+        os.remove(COMPONENTS_PROFILE_FILE)
+    except (OSError, ValueError):
+        pass
+    mkdir_p(os.path.dirname(PROFILE_REPORT_FILE))
+    write_json_atomic(PROFILE_REPORT_FILE, build_profile.report(slowest))
+    print("\nBuild profile (saved to %s)" % PROFILE_REPORT_FILE)
+    print(build_profile.summary(slowest))
+    stop_profile()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,441 @@
+"""
+Build-performance benchmarks.
+
+make_corpus() writes a synthetic website of any size. It is deterministic:
+the same arguments always give the same files. run_benchmark() then times
+the component generators and the build on it, e.g.
+
+    python -m awcm bench --pages 10000 --jobs 4
+
+Each phase is run in a fresh Python process, as it is by the Makefile, so
+that the peak memory (RSS) of each phase can be measured on its own.
+
+run_micro_benchmarks() times the functions that most of the build's time is
+spent in, on fixed inputs. The results can be saved as a baseline, and later
+results compared with it to catch slow-downs, e.g.
+
+    python -m awcm microbench --save baseline.json
+    python -m awcm microbench --compare baseline.json --threshold 0.2
+"""
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+from awcm import awcm
+
+# The standard component generators, from a copy of the source code
+BITS_BOX_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'bits_box')
+COMPONENTS = ['000_collect_data.py', '001_make_homepage.py',
+              '999_mksitemap.py']
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua enim ad '
+         'minim veniam quis nostrud exercitation ullamco laboris nisi aliquip '
+         'ex ea commodo consequat duis aute irure in reprehenderit voluptate '
+         'velit esse cillum eu fugiat nulla pariatur').split()
+
+TEMPLATE = """<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <title>{{ title }}</title>
+    <link rel="stylesheet" href="{{ theme_path }}%s" media="all">
+</head>
+<body>
+    <p><a href="{{ back_path }}index.html">Home</a></p>
+    <div class="content">
+        <h1>{{ title }}</h1>
+        {{ article }}
+    </div>
+    <div class="footer-tags">{{ tags_html }}</div>
+    <div class="footer-categories">{{ categories_html }}</div>
+</body>
+</html>
+"""
+
+PAGE = """<head>
+    <title>%(title)s</title>
+    <meta name="date" content="%(date)s" />
+    <meta name="summary" content="%(summary)s" />
+    <meta name="tags" content="%(tags)s" />
+    <meta name="category" content="%(category)s" />
+</head>
+<body>
+%(body)s
+</body>
+"""
+
+
+def _sentence(rng, num_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(num_words))
+
+
+def _page_folder(rng, depth):
+    """ A folder up to depth levels deep, with ten folders at each level """
+    levels = rng.randint(0, depth)
+    return '/'.join('d%d' % rng.randrange(10) for _ in range(levels))
+
+
+def make_corpus(site_dir, pages=1000, tags=100, categories=10,
+                tags_per_page=3, body_kb=4, depth=2, media=0, media_kb=64,
+                entries_per_page=10, incremental=False, seed=0,
+                components_dir=BITS_BOX_DIR):
+    """
+    Write a synthetic website into site_dir (which must not exist yet):
+    a theme, config.json, the standard component generators, and content
+    with the given number of pages, spread over sub-folders up to depth
+    levels deep. Each page has about body_kb KB of text, tags_per_page
+    tags from a set of tags, and one category. There are also media files
+    of media_kb KB each, which some of the pages link to.
+    entries_per_page and incremental go into config.json.
+
+    Returns the list of content pages, relative to the content folder.
+    """
+    rng = random.Random(seed)
+    os.makedirs(site_dir)
+    for folder in ['content', '_meta', 'output', 'components']:
+        os.mkdir(os.path.join(site_dir, folder))
+
+    theme_dir = os.path.join(site_dir, 'themes', 'bench')
+    os.makedirs(os.path.join(theme_dir, 'templates'))
+    os.makedirs(os.path.join(theme_dir, 'static'))
+    for template, css in [('common.thtml', 'b.css'),
+                          ('navigation.thtml', 'n.css')]:
+        with open(os.path.join(theme_dir, 'templates', template), 'w') as fh:
+            fh.write(TEMPLATE % css)
+        with open(os.path.join(theme_dir, 'static', css), 'w') as fh:
+            fh.write('body {background-color: #ddd;}\n')
+
+    with open(os.path.join(site_dir, awcm.CONFIG_FILE_NAME), 'w') as fh:
+        json.dump({'theme': 'bench', 'entries_per_page': entries_per_page,
+                   'incremental': incremental}, fh, indent=4)
+
+    for name in COMPONENTS:
+        destination = os.path.join(site_dir, 'components', name)
+        shutil.copy(os.path.join(components_dir, name), destination)
+        os.chmod(destination, 0o755)
+
+    media_files = []
+    for media_number in range(media):
+        media_file = 'media/m%05d.jpg' % media_number
+        os.makedirs(os.path.join(site_dir, 'content', 'media'),
+                    exist_ok=True)
+        with open(os.path.join(site_dir, 'content', media_file), 'wb') as fh:
+            fh.write(rng.getrandbits(media_kb * 1024 * 8).to_bytes(
+                media_kb * 1024, 'little'))
+        media_files.append(media_file)
+
+    tag_names = ['tag%d' % number for number in range(max(1, tags))]
+    category_names = ['category%d' % number
+                      for number in range(max(1, categories))]
+    page_files = []
+    for page_number in range(pages):
+        folder = _page_folder(rng, depth)
+        page_file = '/'.join(filter(None, [folder,
+                                           'page%06d.html' % page_number]))
+        paragraphs = []
+        size = 0
+        while size < body_kb * 1024:
+            paragraph = '<p>%s.</p>' % _sentence(rng, rng.randint(20, 80))
+            paragraphs.append(paragraph)
+            size += len(paragraph)
+        if media_files and rng.random() < 0.5:
+            back_path = '../' * folder.count('/') + ('../' if folder else '')
+            paragraphs.insert(1, '<p><img src="%s%s"></p>' % (
+                back_path, rng.choice(media_files)))
+
+        page_path = os.path.join(site_dir, 'content', page_file)
+        os.makedirs(os.path.dirname(page_path), exist_ok=True)
+        with open(page_path, 'w') as fh:
+            fh.write(PAGE % {
+                'title': 'Page %d: %s' % (page_number, _sentence(rng, 4)),
+                'date': '20%02d-%02d-%02d 10:00' % (
+                    rng.randint(10, 25), rng.randint(1, 12),
+                    rng.randint(1, 28)),
+                'summary': _sentence(rng, 12),
+                'tags': ','.join(rng.sample(
+                    tag_names, min(tags_per_page, len(tag_names)))),
+                'category': rng.choice(category_names),
+                'body': '\n'.join(paragraphs)})
+        page_files.append(page_file)
+    return page_files
+
+
+def _peak_rss_mb():
+    """ The peak RSS of this process and of its finished children, in MB,
+    or None if it can't be measured on this OS
+    """
+    try:
+        import resource  # Not available on Windows
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)  # in bytes
+    return peak / 1024.0  # in KB
+
+
+def _run_phase(site_dir, phase, jobs, results):
+    """ Run one phase of the build in site_dir, and put its timings on the
+    results queue. This is run in a new process.
+    """
+    os.chdir(site_dir)
+    # Don't let the progress messages swamp the results
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    timings = []
+    try:
+        if phase == 'components':
+            awcm.reset_site_index()
+            for name in sorted(os.listdir('components')):
+                if not re.match(r'\d\d\d[-_]', name):
+                    continue
+                start = time.perf_counter()
+                if not awcm.run_python_component('components', name):
+                    raise awcm.BuildError("%s failed" % name)
+                timings.append((name, time.perf_counter() - start))
+        else:
+            start = time.perf_counter()
+            awcm.main(jobs=jobs)
+            timings.append((phase, time.perf_counter() - start))
+    except Exception as exc:
+        results.put({'error': '%s: %s' % (type(exc).__name__, exc)})
+        return
+    results.put({'timings': timings, 'peak_rss_mb': _peak_rss_mb()})
+
+
+def run_phase(site_dir, phase, jobs=None):
+    """
+    Run a phase ('components', 'build' or 'rebuild') of the build of the
+    website in site_dir, in a new Python process.
+
+    Returns a list of (name, seconds) and the peak RSS of the process in MB.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run_phase,
+                              args=(site_dir, phase, jobs, results))
+    process.start()
+    result = results.get()
+    process.join()
+    if 'error' in result:
+        raise awcm.BuildError("Benchmark phase %s failed: %s" % (
+            phase, result['error']))
+    return result['timings'], result['peak_rss_mb']
+
+
+def run_benchmark(site_dir, num_pages, jobs=None, rebuild=False):
+    """
+    Time the component generators and then the build of the website in
+    site_dir, and (if rebuild is True) a second build with nothing changed.
+
+    Returns a list of dicts, one per step, with the name, seconds,
+    pages_per_sec (content pages) and peak_rss_mb of the phase it was in.
+    """
+    phases = ['components', 'build']
+    if rebuild:
+        phases.append('rebuild')
+    report = []
+    for phase in phases:
+        timings, peak_rss_mb = run_phase(site_dir, phase, jobs)
+        if phase == 'components':
+            timings.append(('components', sum(secs for _, secs in timings)))
+        for name, secs in timings:
+            report.append({
+                'name': name,
+                'seconds': round(secs, 3),
+                'pages_per_sec': round(num_pages / secs, 1) if secs else None,
+                'peak_rss_mb': None if peak_rss_mb is None else
+                round(peak_rss_mb, 1)})
+    return report
+
+
+def print_report(report):
+    print("%-24s %10s %12s %14s" % ('step', 'seconds', 'pages/sec',
+                                    'peak RSS (MB)'))
+    for step in report:
+        print("%-24s %10.3f %12s %14s" % (
+            step['name'], step['seconds'],
+            '-' if step['pages_per_sec'] is None else step['pages_per_sec'],
+            '-' if step['peak_rss_mb'] is None else
+            '%.1f' % step['peak_rss_mb']))
+
+
+def main(args):
+    """ Run the benchmark for the `python -m awcm bench` command """
+    site_dir = args.site
+    if site_dir is None:
+        site_dir = os.path.join(tempfile.mkdtemp(prefix='awcm_bench_'),
+                                'site')
+    start = time.perf_counter()
+    page_files = make_corpus(
+        site_dir, pages=args.pages, tags=args.tags,
+        categories=args.categories, tags_per_page=args.tags_per_page,
+        body_kb=args.body_kb, depth=args.depth, media=args.media,
+        media_kb=args.media_kb, entries_per_page=args.entries_per_page,
+        incremental=args.incremental, seed=args.seed)
+    print("Made %d pages in %s (%.1fs)" % (
+        len(page_files), site_dir, time.perf_counter() - start))
+
+    try:
+        report = run_benchmark(site_dir, len(page_files), jobs=args.jobs,
+                               rebuild=args.rebuild)
+        print_report(report)
+        if args.json:
+            awcm.write_json_atomic(args.json, {
+                'pages': len(page_files), 'jobs': args.jobs,
+                'steps': report})
+    finally:
+        if args.site is None and not args.keep:
+            shutil.rmtree(os.path.dirname(site_dir))
+
+
+def _micro_benchmark_fixtures(work_dir):
+    """ The inputs for the micro-benchmarks, made in work_dir. They are the
+    same every time. Returns a dict of name: function to time.
+    """
+    rng = random.Random(0)
+    page_html = PAGE % {
+        'title': 'A page', 'date': '2020-01-01 10:00',
+        'summary': _sentence(rng, 12), 'tags': 'tag1,tag2',
+        'category': 'category1',
+        'body': '\n'.join('<p>%s <b>%s</b> %s.</p>' % (
+            _sentence(rng, 30), _sentence(rng, 2), _sentence(rng, 30))
+            for _ in range(20))}
+    truncated_html = page_html[page_html.index('<body>') + 6:][:2400]
+    text = ''.join('%s caf\u00e9 \u2014 ' % _sentence(rng, 10)
+                   for _ in range(50))
+
+    # A folder tree for get_all_filenames()
+    files_dir = os.path.join(work_dir, 'files')
+    for number in range(500):
+        path = os.path.join(files_dir, 'd%d' % (number % 10),
+                            'e%d' % (number % 7), 'f%d.html' % number)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+
+    # A theme for TemplateWriter.write()
+    templates_dir = os.path.join(work_dir, 'themes', 'bench', 'templates')
+    os.makedirs(templates_dir)
+    for template in ['common.thtml', 'navigation.thtml']:
+        with open(os.path.join(templates_dir, template), 'w') as fh:
+            fh.write(TEMPLATE % 'b.css')
+    writer = awcm.TemplateWriter(os.path.join(work_dir, 'themes'))
+    writer.validate_template('bench')
+    output_dir = os.path.join(work_dir, 'output')
+    os.mkdir(output_dir)
+    reader = awcm.HtmlFileReader('page.html')
+    article_data = reader.parse_html(page_html)
+    tokens = {'title': article_data['title'],
+              'article': article_data['content'],
+              'tags_html': '<ul><li>tag1</li><li>tag2</li></ul>',
+              'categories_html': '<ul><li>category1</li></ul>'}
+
+    return {
+        'HtmlFileReader.parse_html': lambda: reader.parse_html(page_html),
+        'fix_incomplete_html': lambda: awcm.fix_incomplete_html(
+            truncated_html),
+        'html_encode': lambda: awcm.html_encode(text),
+        'get_all_filenames': lambda: awcm.get_all_filenames(files_dir),
+        'TemplateWriter.write': lambda: writer.write(
+            output_dir, 'page.html', 'bench', 'common', dict(tokens)),
+    }
+
+
+def run_micro_benchmarks(repeat=5, names=None):
+    """
+    Time each of the micro-benchmarks (or just those in names): the best
+    of repeat runs, each of enough calls to take at least 0.2 seconds.
+
+    Returns a dict of name: {'seconds': seconds per call, 'number': calls
+    per run}.
+    """
+    work_dir = tempfile.mkdtemp(prefix='awcm_microbench_')
+    saved_debug = awcm.CONFIG['debug']
+    awcm.CONFIG['debug'] = False
+    try:
+        results = {}
+        for name, function in sorted(
+                _micro_benchmark_fixtures(work_dir).items()):
+            if names and name not in names:
+                continue
+            timer = timeit.Timer(function)
+            number, _ = timer.autorange()
+            best = min(timer.repeat(repeat=repeat, number=number))
+            results[name] = {'seconds': best / number, 'number': number}
+        return results
+    finally:
+        awcm.CONFIG['debug'] = saved_debug
+        shutil.rmtree(work_dir)
+
+
+def compare_micro_benchmarks(baseline, results, threshold):
+    """
+    Compare micro-benchmark results with a baseline (both as returned by
+    run_micro_benchmarks()). threshold is the fraction by which a function
+    may slow down, e.g. 0.2 for 20%.
+
+    Returns a list of (name, baseline seconds, seconds, change) for each
+    function in both, where change is the fractional slow-down, and a list
+    of the names of the functions that slowed down by more than threshold.
+    """
+    comparison = []
+    regressions = []
+    for name in sorted(set(baseline) & set(results)):
+        before = baseline[name]['seconds']
+        after = results[name]['seconds']
+        change = after / before - 1 if before else 0.0
+        comparison.append((name, before, after, change))
+        if change > threshold:
+            regressions.append(name)
+    return comparison, regressions
+
+
+def micro_main(args):
+    """ Run the micro-benchmarks for the `python -m awcm microbench`
+    command. Exits with status 1 if any function has slowed down too much.
+    """
+    results = run_micro_benchmarks(repeat=args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as baseline_fh:
+            saved = json.load(baseline_fh)
+        baseline = saved['results']
+        if saved.get('python') != platform.python_version() or \
+                saved.get('machine') != platform.node():
+            print("WARNING: the baseline was made with Python %s on %s" % (
+                saved.get('python'), saved.get('machine')))
+
+    regressions = []
+    if baseline is not None:
+        print("%-28s %14s %14s %9s" % ('function', 'usec per call',
+                                       'baseline', 'change'))
+        comparison, regressions = compare_micro_benchmarks(
+            baseline, results, args.threshold)
+        for name, before, after, change in comparison:
+            print("%-28s %14.1f %14.1f %+8.1f%%%s" % (
+                name, after * 1e6, before * 1e6, change * 100,
+                '  SLOWER' if name in regressions else ''))
+    else:
+        print("%-28s %14s" % ('function', 'usec per call'))
+        for name, result in sorted(results.items()):
+            print("%-28s %14.1f" % (name, result['seconds'] * 1e6))
+
+    if args.save:
+        awcm.write_json_atomic(args.save, {
+            'python': platform.python_version(), 'machine': platform.node(),
+            'results': results})
+        print("Saved to %s" % args.save)
+    if regressions:
+        print("\n%d function(s) slowed down by more than %d%%: %s" % (
+            len(regressions), args.threshold * 100, ', '.join(regressions)))
+        sys.exit(1)
@@ -0,0 +1,234 @@
+"""
+A local web server for previewing the website, e.g.
+
+    python -m awcm serve
+
+Nothing is written to the output folder. Each page is rendered when it is
+first asked for, and kept in memory; it is rendered again if its source,
+its theme's templates, or the tag and category data change. Other files
+(images, the theme's static files...) are served straight from where they
+are.
+"""
+import http.server
+import mimetypes
+import os
+import sys
+import threading
+import traceback
+import urllib.parse
+
+from awcm import awcm
+
+
+class PreviewSite:
+    """
+    The website, as it would be in the output folder, but kept in memory.
+    Pages are rendered the first time they are asked for.
+    """
+    def __init__(self):
+        awcm.read_site_config()
+        self._lock = threading.Lock()
+        self._writer = None
+        self._nav_lists = None
+        self._nav_stamps = None
+        self._template_stamps = {}
+        self._cache = awcm.get_page_cache('_meta')
+        # The rendered pages, by path: (the stamps of the files each one
+        # was made from, the page, its theme)
+        self.pages = {}
+
+    def _source(self, path, html):
+        """ The folder containing the file that path in the output folder
+        is made from (if it's an HTML page) or copied from, or None """
+        # As in make_pages_from_template(), the _meta/ copy wins, but data
+        # files and the cache in _meta/ aren't part of the website
+        input_sources = ['_meta', awcm.CONFIG['content_dir']]
+        if path.startswith(awcm.CACHE_DIR_NAME + os.sep) or (
+                not html and path.split('.')[-1] in ['json', 'yml', 'yaml']):
+            input_sources = [awcm.CONFIG['content_dir']]
+        for input_source in input_sources:
+            if os.path.isfile(os.path.join(input_source, path)):
+                return input_source
+        return None
+
+    def _check_templates(self):
+        """ Start again with a new TemplateWriter and NavLists if the
+        templates or the tag and category data have changed """
+        nav_stamps = [awcm.file_stamp(path) for path in
+                      [awcm.TAGS_DATA_FILE, awcm.CATEGORIES_DATA_FILE]]
+        if nav_stamps != self._nav_stamps:
+            self._nav_lists = awcm.NavLists()
+            self._nav_stamps = nav_stamps
+        for theme_name, stamps in list(self._template_stamps.items()):
+            if self._writer is not None and stamps != [
+                    awcm.file_stamp(path) for path in
+                    self._writer.template_files(theme_name)]:
+                self._writer = None
+        if self._writer is None:
+            self._writer = awcm.get_template_writer(
+                awcm.CONFIG['themes_root'])
+            self._template_stamps = {}
+
+    def render(self, input_source, path):
+        """ Render a page, as make_pages_from_template() would, but
+        returning it rather than writing it.
+        Returns the page (as bytes) and the name of its theme. """
+        self._check_templates()
+        cache = self._cache if input_source != '_meta' else None
+        theme_name, template, tokens = awcm.prepare_page(
+            self._writer, input_source, path, cache=cache,
+            nav_lists=self._nav_lists)
+        if theme_name not in self._template_stamps:
+            self._template_stamps[theme_name] = [
+                awcm.file_stamp(template_file) for template_file in
+                self._writer.template_files(theme_name)]
+        page = ''.join(self._writer.stream(path, theme_name, template,
+                                           tokens))
+        return page.encode('utf-8'), theme_name
+
+    def _dependencies(self, input_source, path, theme_name):
+        return [os.path.join(input_source, path),
+                awcm.TAGS_DATA_FILE, awcm.CATEGORIES_DATA_FILE] + \
+            self._writer.template_files(theme_name)
+
+    def get(self, path):
+        """
+        The contents of the file at path (from url_to_path()) in the
+        website, as bytes, or None if there is no such file.
+        """
+        # The theme's static files
+        parts = path.split(os.sep)
+        if len(parts) > 2 and parts[0] == 'themes':
+            static_path = os.path.join(awcm.CONFIG['themes_root'], parts[1],
+                                       'static', *parts[2:])
+            return _read(static_path)
+
+        html = path.split('.')[-1] in ['html', 'htm']
+        input_source = self._source(path, html)
+        if input_source is None:
+            return None
+        if not html:
+            return _read(os.path.join(input_source, path))
+
+        with self._lock:
+            if path in self.pages:
+                stamps, page, theme_name = self.pages[path]
+                dependencies = self._dependencies(input_source, path,
+                                                  theme_name)
+                if stamps == [awcm.file_stamp(dependency)
+                              for dependency in dependencies]:
+                    return page
+            page, theme_name = self.render(input_source, path)
+            stamps = [awcm.file_stamp(dependency) for dependency in
+                      self._dependencies(input_source, path, theme_name)]
+            self.pages[path] = (stamps, page, theme_name)
+            return page
+
+    def render_all(self):
+        """ Render every page now, rather than when it is asked for.
+        Returns the paths of any pages that couldn't be rendered. """
+        failed = []
+        for input_source in [awcm.CONFIG['content_dir'], '_meta']:
+            for path in awcm.get_all_filenames(input_source):
+                if path.split('.')[-1] not in ['html', 'htm'] or \
+                        path.startswith(awcm.CACHE_DIR_NAME + os.sep):
+                    continue
+                try:
+                    self.get(path)
+                except Exception:
+                    exc_type, exc_value = sys.exc_info()[:2]
+                    print("\nERROR: Could not build %s from %s: %s" % (
+                        path, input_source, ''.join(
+                            traceback.format_exception_only(
+                                exc_type, exc_value)).strip()))
+                    failed.append(path)
+        return failed
+
+
+def url_to_path(url_path):
+    """ The path in the output folder for the path part of a URL, or None
+    if it's outside the output folder """
+    path = url_path.split('?')[0].split('#')[0].lstrip('/')
+    if path == '' or path.endswith('/'):
+        path += 'index.html'
+    path = os.path.normpath(urllib.parse.unquote(path))
+    if path.startswith('..') or os.path.isabs(path):
+        return None
+    return path
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as file_fh:
+            return file_fh.read()
+    except OSError:
+        return None
+
+
+class PreviewRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves the PreviewSite in self.server.site """
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def _respond(self, send_body):
+        path = url_to_path(self.path)
+        status = 200
+        content_type = mimetypes.guess_type(path or '')[0] or \
+            'application/octet-stream'
+        try:
+            body = self.server.site.get(path) if path is not None else None
+        except Exception:
+            body = traceback.format_exc().encode('utf-8')
+            status, content_type = 500, 'text/plain'
+        if body is None:
+            body = b'Not found'
+            status, content_type = 404, 'text/plain'
+        if content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if awcm.CONFIG['debug']:
+            http.server.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+def make_server(host='127.0.0.1', port=8000, site=None):
+    """ An HTTP server for the website in the current folder (call its
+    serve_forever()). Use port 0 for any free port. """
+    server = http.server.ThreadingHTTPServer((host, port),
+                                             PreviewRequestHandler)
+    server.site = site if site is not None else PreviewSite()
+    return server
+
+
+def serve(host='127.0.0.1', port=8000, components=True, render_all=False):
+    """ Run the component generators (unless components is False), then
+    serve the website until interrupted (Ctrl-C). If render_all is set,
+    every page is rendered first, and a BuildError raised if any fail. """
+    if components and os.path.isdir('components'):
+        awcm.run_components('components')
+    site = PreviewSite()
+    if render_all:
+        failed = site.render_all()
+        if failed:
+            raise awcm.BuildError("Could not build %d page(s): %s" % (
+                len(failed), ', '.join(failed)))
+        print("Rendered %d pages" % len(site.pages))
+    server = make_server(host, port, site)
+    print("Serving the website at http://%s:%d/ (press Ctrl-C to stop)" % (
+        host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
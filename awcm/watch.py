@@ -0,0 +1,330 @@
+"""
+Watch the website's source files and rebuild whenever they change, e.g.
+
+    python -m awcm watch
+
+Everything stays loaded between builds: the Python interpreter, the
+templates, and the pages that the component generators have read. Each
+rebuild only does what the change needs (see SiteBuilder.build()).
+
+Changes are noticed with inotify on Linux, or by checking the files every
+second anywhere else.
+"""
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import sys
+import time
+import traceback
+
+from awcm import awcm
+
+WATCHED_PATHS = ['content', 'themes', 'components', awcm.CONFIG_FILE_NAME]
+
+# How long to wait for more changes after one is noticed, so that a file
+# saved in several steps (or a folder of files) only causes one rebuild
+SETTLE_TIME = 0.1
+
+
+def is_ignored(path):
+    """ Editors' backup, swap and temporary files don't count """
+    name = os.path.basename(path)
+    return (name.startswith('.') or name.endswith('~') or
+            name.endswith('.swp') or name.endswith('.tmp'))
+
+
+class PollingWatcher:
+    """ Notices changes by looking at every file's size and modification
+    time, every interval seconds """
+    def __init__(self, paths, interval=1.0):
+        self.paths = paths
+        self.interval = interval
+        self._stamps = self._scan()
+
+    def _scan(self):
+        stamps = {}
+        for path in self.paths:
+            if os.path.isfile(path):
+                stamps[path] = awcm.file_stamp(path)
+            for root, _directories, filenames in os.walk(path):
+                for filename in filenames:
+                    file_path = os.path.join(root, filename)
+                    stamps[file_path] = awcm.file_stamp(file_path)
+        return stamps
+
+    def wait(self, timeout=None):
+        """ Wait for files to change. Returns the set of paths that have
+        changed (or been added or deleted), which is empty if timeout
+        seconds went by first. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            stamps = self._scan()
+            changed = {path for path in set(stamps) | set(self._stamps)
+                       if stamps.get(path) != self._stamps.get(path) and
+                       not is_ignored(path)}
+            self._stamps = stamps
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """ Notices changes with Linux's inotify, called through ctypes. Raises
+    an OSError if inotify isn't available. """
+    def __init__(self, paths):
+        self.paths = paths
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("Can't find the C library")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1() failed")
+        self._folders = {}
+        self._trees = [os.path.normpath(path) for path in paths
+                       if os.path.isdir(path)]
+
+        # Single files (config.json) are watched through their folder, so
+        # that they're still watched after an editor replaces them
+        self._files = {os.path.normpath(path) for path in paths
+                       if not os.path.isdir(path)}
+        for folder in {os.path.dirname(path) or '.' for path in self._files}:
+            self._add_watch(folder)
+        for tree in self._trees:
+            self._add_tree(tree)
+
+    def _is_watched(self, path):
+        return path in self._files or any(_is_in(path, tree)
+                                          for tree in self._trees)
+
+    def _add_watch(self, folder):
+        watch = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(folder), WATCH_MASK)
+        if watch < 0:
+            # e.g. the folder has already gone again
+            return False
+        self._folders[watch] = folder
+        return True
+
+    def _add_tree(self, folder):
+        """ Watch a folder and its sub-folders. Returns the files in it. """
+        found = []
+        for root, _directories, filenames in os.walk(folder):
+            if self._add_watch(root):
+                found.extend(os.path.join(root, filename)
+                             for filename in filenames)
+        return found
+
+    def _read_events(self):
+        changed = set()
+        data = os.read(self._fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            watch, mask, _cookie, length = EVENT_HEADER.unpack_from(
+                data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Too many changes to keep track of, so treat it like a
+                # change to config.json, which means checking everything
+                changed.add(awcm.CONFIG_FILE_NAME)
+                continue
+            if mask & IN_IGNORED:
+                self._folders.pop(watch, None)
+                continue
+            folder = self._folders.get(watch)
+            if folder is None or not name:
+                continue
+            path = os.path.normpath(os.path.join(folder, name))
+            if not self._is_watched(path):
+                # Something else in the folder that a watched file is in
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.update(self._add_tree(path))
+                continue
+            changed.add(path)
+        return changed
+
+    def wait(self, timeout=None):
+        """ Wait for files to change. Returns the set of paths that have
+        changed (or been added or deleted), which is empty if timeout
+        seconds went by first. """
+        changed = set()
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        while ready:
+            changed.update(self._read_events())
+            ready, _, _ = select.select([self._fd], [], [], SETTLE_TIME)
+        return {path for path in changed if not is_ignored(path)}
+
+    def close(self):
+        os.close(self._fd)
+
+
+def make_watcher(paths, poll=False, interval=1.0):
+    """ An InotifyWatcher if possible, otherwise a PollingWatcher """
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths)
+        except OSError as exc:
+            print("Can't use inotify (%s); checking for changes every %gs "
+                  "instead" % (exc, interval))
+    return PollingWatcher(paths, interval)
+
+
+def _is_in(path, folder):
+    folder = os.path.normpath(folder)
+    return path == folder or path.startswith(folder + os.sep)
+
+
+class SiteBuilder:
+    """
+    Builds the website over and over again, keeping everything it can
+    between builds. The builds are always incremental.
+    """
+    def __init__(self, jobs=None, components_dir='components'):
+        self.jobs = jobs
+        self.components_dir = components_dir
+        self.writer = None
+        self.themes = set()
+
+    def first_component_affected(self, changed):
+        """ The name of the first component generator that has changed, or
+        whose data (in a folder named after it, e.g. "components/tvc/" for
+        001_tvc.sh) has changed; or None """
+        names = []
+        for path in changed:
+            if not _is_in(path, self.components_dir):
+                continue
+            relative_path = os.path.relpath(path, self.components_dir)
+            parts = relative_path.split(os.sep)
+            if len(parts) == 1 and re.match(r'\d\d\d[-_]', parts[0]):
+                names.append(parts[0])
+            elif len(parts) > 1 and os.path.isdir(self.components_dir):
+                names.extend(
+                    name for name in os.listdir(self.components_dir)
+                    if re.match(r'\d\d\d[-_]' + re.escape(parts[0]) +
+                                r'(\.\w+)?$', name))
+        return min(names) if names else None
+
+    def build(self, changed=None):
+        """
+        Bring the output up to date with the changed paths (relative to the
+        website's folder). If changed is None, or config.json has changed,
+        everything is checked.
+
+        - A change in the content folder runs the component generators
+          again; only the changed pages are read again.
+        - A change to a component generator runs it, and the ones after it,
+          again.
+        - A change to a theme's templates means a new TemplateWriter.
+        Pages are then rendered, and static files copied, if their inputs
+        have changed.
+        """
+        start = time.perf_counter()
+        if changed is None or awcm.CONFIG_FILE_NAME in changed:
+            awcm.read_site_config()
+            awcm.CONFIG['incremental'] = True
+            awcm.reset_site_index()
+            self.writer = None
+            run_components_from = ''
+            changed_pages = []
+            templates_changed = True
+        else:
+            content_dir = os.path.normpath(awcm.CONFIG['content_dir'])
+            changed_pages = [os.path.relpath(path, content_dir)
+                             for path in changed
+                             if _is_in(path, content_dir)]
+            run_components_from = self.first_component_affected(changed)
+            if changed_pages:
+                run_components_from = ''
+            templates_changed = any(
+                _is_in(path, awcm.CONFIG['themes_root']) and
+                '/templates/' in path for path in changed)
+            if templates_changed:
+                self.writer = None
+
+        site_index = awcm.get_site_index(awcm.CONFIG['content_dir'], '_meta')
+        site_index.keep_pages = True
+        for page in changed_pages:
+            site_index.forget(page)
+
+        if run_components_from is not None and \
+                os.path.isdir(self.components_dir):
+            awcm.run_components(self.components_dir, reset_index=False,
+                                start_at=run_components_from)
+
+        if run_components_from is not None or changed_pages or \
+                templates_changed:
+            awcm.mkdir_p(awcm.CONFIG['output_path'])
+            if self.writer is None:
+                self.writer = awcm.get_template_writer(
+                    awcm.CONFIG['themes_root'])
+            self.themes = awcm.make_pages_from_template(
+                templates_dir=awcm.CONFIG['themes_root'],
+                output_dir=awcm.CONFIG['output_path'], incremental=True,
+                jobs=self.jobs, writer=self.writer)
+
+        awcm.copy_all_static_files(
+            templates_dir=awcm.CONFIG['themes_root'],
+            theme_names=self.themes | {awcm.CONFIG['theme']},
+            output_path=awcm.CONFIG['output_path'])
+        print("Built in %.2fs" % (time.perf_counter() - start))
+
+
+def build_safely(builder, changed=None):
+    """ builder.build(), reporting rather than raising any errors, so that
+    we carry on watching """
+    try:
+        builder.build(changed)
+    except awcm.BuildError as exc:
+        print("\nERROR: %s" % exc)
+    except Exception:
+        traceback.print_exc()
+
+
+def watch(jobs=None, poll=False, interval=1.0):
+    """ Build the website, then rebuild it whenever it changes, until
+    interrupted (Ctrl-C) """
+    builder = SiteBuilder(jobs=jobs)
+    build_safely(builder)
+    watcher = make_watcher([path for path in WATCHED_PATHS
+                            if os.path.exists(path)], poll, interval)
+    print("Watching for changes (press Ctrl-C to stop)")
+    try:
+        while True:
+            changed = watcher.wait()
+            if changed:
+                print("\nChanged: %s" % ', '.join(sorted(changed)))
+                build_safely(builder, changed)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
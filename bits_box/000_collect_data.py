@@ -25,20 +25,21 @@ META_DIR = '../_meta'
 SITEMAP_DATA_FILE = os.path.join(META_DIR, '000_sitemap.json')
 CATEGORY_DATA_FILE = os.path.join(META_DIR, '000_categories.json')
 TAG_DATA_FILE = os.path.join(META_DIR, '000_tags.json')
+SITE = awcm.get_site_index(CONTENT_DIR, META_DIR)
 
 VERBOSE = True
 
 
 def collect_data():
     """
-    Collect page titles and save them to SITEMAP_DATA_FILE so that a sitemap
-    can be built by 999_mksitemap.py
+    Collect page titles (and dates) and save them to SITEMAP_DATA_FILE so that
+    a sitemap can be built by 999_mksitemap.py
 
     Collect category data from <meta> tags and save them to CATEGORY_DATA_FILE
     so that cagetories can be added to pages (via templates) and category pages
     can be constructed.
     """
-    all_content_files = awcm.get_all_filenames(CONTENT_DIR)
+    all_content_files = SITE.filenames()
 
     sitemap_entries = []
     categories = {}
@@ -48,13 +49,18 @@ def collect_data():
         if '.html' not in page:
             continue
 
-        html = awcm.HtmlFileReader(os.path.join(CONTENT_DIR, page))
-        page_data = html.read()
+        # We only need the title and meta-data, not the content
+        page_data = SITE.read_meta(page)
 
         if VERBOSE:
             print('  [info] Title of %s is %s' % (page, page_data['title']))
 
-        sitemap_entries.append({'title': page_data['title'], 'url': page})
+        sitemap_entry = {'title': page_data['title'], 'url': page}
+        # When the page was written and last changed, for sitemap.xml
+        for name in ['date', 'modified']:
+            if name in page_data['meta'].keys():
+                sitemap_entry[name] = page_data['meta'][name]
+        sitemap_entries.append(sitemap_entry)
 
         # categories and tags (both can be comma separated lists) meta data as
         # per http://docs.getpelican.com/en/3.6.3/content.html#file-metadata
@@ -4,7 +4,8 @@
 # loads all filenames and prints out some of the content.
 # Don't forget to "chmod +x <filename>"
 
-# TODO: Pagination?
+# If "entries_per_page" is set in config.json, the homepage is split into
+# index.html, index_2.html, index_3.html...
 
 
 import json
@@ -18,50 +19,55 @@ META_DIR = '../_meta'
 SITEMAP_DATA_FILE = os.path.join(META_DIR, '000_sitemap.json')
 CATEGORY_DATA_FILE = os.path.join(META_DIR, '000_categories.json')
 TAG_DATA_FILE = os.path.join(META_DIR, '000_tags.json')
+SITE = awcm.get_site_index(CONTENT_DIR, META_DIR)
 
 OUTFILE = os.path.join(META_DIR, 'index.html')
 
-# Max size of previews. "Max Preview Length" is the trigger size
-# truncate_at is the size after truncating. By having a difference
-# between these two, we never see a file with only the final word
+# Max size of previews, in characters of text. "Max Preview Length" is the
+# trigger size; truncate_at is the size after truncating. By having a
+# difference between these two, we never see a file with only the final word
 # truncated.
 MAX_PREVIEW_LENGTH = 2700
 TRUNCATE_AT = 2400
 
 
-def main():
-    all_content_files = awcm.get_all_filenames(CONTENT_DIR)
+def homepage_header(page_number):
+    if page_number == 1:
+        return '<title>Home</title>'
+    return '<title>Home (page %d)</title>' % page_number
+
 
-    output = ['<title>Home</title>']
+def main():
+    awcm.read_site_config('..')
+    all_content_files = SITE.filenames()
 
     # Ensure they're in the right order
     all_content_files.sort(reverse=True)
 
-    for page_filename in all_content_files:
-        # Ignore non-HTML files
-        if '.html' not in page_filename:
-            continue
+    # Ignore non-HTML files, and filenames that don't match a pattern
+    page_filenames = [page_filename for page_filename in all_content_files
+                      if '.html' in page_filename and
+                      re.match(r'[\w\d].*\.html', page_filename)]
 
-        # Ignore filenames that don't match a pattern
-        if not re.match(r'[\w\d].*\.html', page_filename):
-            continue
+    writer = awcm.PaginatedWriter(OUTFILE, len(page_filenames),
+                                  awcm.CONFIG['entries_per_page'],
+                                  header=homepage_header)
 
-        reader = awcm.HtmlFileReader(os.path.join(CONTENT_DIR, page_filename))
-        page_content = reader.read()
+    for page_filename in page_filenames:
+        page_content = SITE.read(page_filename)
         title = page_content['title']
-        full_content = awcm.fix_incomplete_html(page_content['content'])
+        content, is_truncated = awcm.make_preview(
+            page_content['content'], MAX_PREVIEW_LENGTH, TRUNCATE_AT)
 
-        # is_truncated = False
-        if len(full_content) > MAX_PREVIEW_LENGTH:
-            content = awcm.fix_incomplete_html(full_content[0:TRUNCATE_AT])
-            # is_truncated = True
-            opener_link_text = "more... ({} bytes)".format(len(full_content))
+        if is_truncated:
+            opener_link_text = "more... ({} bytes)".format(
+                len(page_content['content']))
         else:
-            content = full_content
             opener_link_text = "open..."
 
         content = awcm.html_encode(content).decode('UTF-8')
 
+        output = []
         output.append("<h2><a href=\"{0}\">{1}</a></h2>".format(page_filename,
                                                                 title))
         output.append("<div>")
@@ -70,9 +76,9 @@ def main():
         output.append("<a href=\"{0}\">{1}</a></h2>".format(page_filename,
                                                             opener_link_text))
         output.append("</div></div>")
+        writer.add(output)
 
-    with open(OUTFILE, 'w') as fhout:
-        fhout.write(''.join(output))
+    writer.close()
 
 
 main()
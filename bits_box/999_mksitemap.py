@@ -6,8 +6,8 @@ will be merged with templates to produce navigation pages.
 This is the second of two special component generators. The first one
 (000_collect_data.py) collects titles, categories, tags etc and generates
 some data-files from the data.
-This component generator creates a sitemap and navigation pages from the
-data-files.
+This component generator creates a sitemap (and sitemap.xml, if 'site_url'
+is set in config.json) and navigation pages from the data-files.
 
 The numbering of these scripts allows other component generators to modify the
 data as needed.
@@ -26,49 +26,83 @@ from awcm import awcm
 
 CONTENT_DIR = '../content'
 META_DIR = '../_meta'
+SITE = awcm.get_site_index(CONTENT_DIR, META_DIR)
 
+SITEMAP_DATA_FILE = os.path.join(META_DIR, '000_sitemap.json')
 SITEMAP_FILE = '000_nav_all_files.html'
+SITEMAP_XML_FILE = 'sitemap.xml'
 CATEGORY_FILE_FMT = '000_nav_%s_%s.html'
 
 # ----------
 #        Duplicated from 001_make_homepage
-# Max size of previews. "Max Preview Length" is the trigger size
-# truncate_at is the size after truncating. By having a difference
-# between these two, we never see a file with only the final word
+# Max size of previews, in characters of text. "Max Preview Length" is the
+# trigger size; truncate_at is the size after truncating. By having a
+# difference between these two, we never see a file with only the final word
 # truncated.
 MAX_PREVIEW_LENGTH = 1500
 TRUNCATE_AT = 1200
 
 
-def create_sitemap():
+def read_sitemap_data():
+    """
+    The pages for the sitemap, from SITEMAP_DATA_FILE (made by
+    000_collect_data.py, and perhaps changed by other component generators),
+    or None if there isn't one.
+    """
+    if not os.path.exists(SITEMAP_DATA_FILE):
+        print("There isn't a %s file" % SITEMAP_DATA_FILE)
+        return None
+    with open(SITEMAP_DATA_FILE, 'r') as fh:
+        return json.load(fh)
+
+
+def create_sitemap(sitemap_entries):
     """
     Construct a sitemap of all "real" pages 
     (N.B. doesn't include the generated pages)
     """
-    # TODO: read from 000_sitemap.json instead!!
-    all_pages = []
-    all_content_files = awcm.get_all_filenames(CONTENT_DIR)
-    for page in all_content_files:
-        if '.html' in page:
-            all_pages.append(page)
-
-    sitemap_html = ['<title>Sitemap</title><body><div>',
-                    'TODO: Needs to read from 000_sitemap.json instead.!!!',
-                    '<ul>']
-    for page in all_pages:
-        html = awcm.HtmlFileReader(os.path.join(CONTENT_DIR, page))
-        page_data = html.read()
-
-        # print(page_data['title'])
+    sitemap_html = ['<title>Sitemap</title><body><div>', '<ul>']
+    for entry in sitemap_entries:
         sitemap_html.append('<li><a href="%s">%s</a></li>' % (
-            page, page_data['title']))
+            entry['url'], entry['title']))
     sitemap_html.append('</ul></div></body>')
 
     with open(os.path.join(META_DIR, SITEMAP_FILE), 'w') as fhout:
         fhout.write("\n".join(sitemap_html))
 
 
+def create_sitemap_xml(sitemap_entries, site_url):
+    """
+    Write sitemap.xml, for search engines, split into several files if
+    there are a lot of pages. The pages' "modified" (or else "date")
+    meta-data is used as the date they were last changed.
+    """
+    writer = awcm.SitemapWriter(os.path.join(META_DIR, SITEMAP_XML_FILE),
+                                site_url)
+    for entry in sitemap_entries:
+        writer.add(entry['url'], awcm.w3c_datetime(
+            entry.get('modified') or entry.get('date')))
+    num_files = writer.close()
+    print("  [info] %s: %d pages in %d file(s)" % (
+        SITEMAP_XML_FILE, len(sitemap_entries), num_files))
+
+
 def get_page_summary(page, max_preview_length, truncate_at):
+    """
+    Get the summary of a page; see make_page_summary().
+
+    A page can have lots of tags and categories, so the summary is
+    only worked out once per run, and is remembered in the page cache
+    until the page changes.
+    """
+    name = 'preview_%d_%d' % (max_preview_length, truncate_at)
+    return list(SITE.extra(
+        page, name,
+        lambda page: make_page_summary(page, max_preview_length,
+                                       truncate_at)))
+
+
+def make_page_summary(page, max_preview_length, truncate_at):
     """
     Creates a summary of a page (truncated according to the truncation
     parameters.)
@@ -82,18 +116,15 @@ def get_page_summary(page, max_preview_length, truncate_at):
     to an existing list (which will be joined before rendering)
     """
     html_bits = []
-    reader = awcm.HtmlFileReader(os.path.join(CONTENT_DIR, page))
-    page_content = reader.read()
+    page_content = SITE.read(page)
     article_title = page_content['title']
-    full_content = awcm.fix_incomplete_html(page_content['content'])
+    content, is_truncated = awcm.make_preview(
+        page_content['content'], max_preview_length, truncate_at)
 
-    is_truncated = False
-    if len(full_content) > max_preview_length:
-        content = awcm.fix_incomplete_html(full_content[0:truncate_at])
-        is_truncated = True
-        opener_link_text = "more... ({} bytes)".format(len(full_content))
+    if is_truncated:
+        opener_link_text = "more... ({} bytes)".format(
+            len(page_content['content']))
     else:
-        content = full_content
         opener_link_text = "open..."
 
     html_bits.append("<h2><a href=\"{0}\">{1}</a></h2>".format(
@@ -109,6 +140,21 @@ def get_page_summary(page, max_preview_length, truncate_at):
     return html_bits
 
 
+def nav_page_header(title):
+    """
+    Returns a function giving the start of each page of a navigation page
+    """
+    def header(page_number):
+        if page_number == 1:
+            page_title = title
+        else:
+            page_title = '%s (page %d)' % (title, page_number)
+        return '\n'.join([
+            '<meta name="template" content="navigation.thtml" />',
+            '<title>%s</title><body>' % page_title])
+    return header
+
+
 def create_category_pages(data_file, keyword_name):
     """
     Create a set of navigation pages for categories or tags (using
@@ -139,19 +185,17 @@ def create_category_pages(data_file, keyword_name):
                 # or   ../_meta/000_nav_tag_saxophone.html
                 categ_filename = CATEGORY_FILE_FMT % (keyword_name.lower(),
                                                       kateg)
-                page_html = [
-                    '<meta name="template" content="navigation.thtml" />',
-                    '<title>%s</title><body>' % title,
-                ]
+                print("  [info] Saving to %s" % categ_filename)
+                writer = awcm.PaginatedWriter(
+                    os.path.join(META_DIR, categ_filename), len(pages),
+                    awcm.CONFIG['entries_per_page'],
+                    header=nav_page_header(title), footer='</body>',
+                    separator="\n")
                 for page in pages:
                     # N.B. duplicated from 001_make_homepage
-                    page_html = page_html + get_page_summary(
-                        page, MAX_PREVIEW_LENGTH, TRUNCATE_AT)
-                page_html.append('</body>')
-                print("  [info] Saving to %s" % categ_filename)
-                with open(
-                        os.path.join(META_DIR, categ_filename), 'w') as fhout:
-                    fhout.write("\n".join(page_html))
+                    writer.add(get_page_summary(
+                        page, MAX_PREVIEW_LENGTH, TRUNCATE_AT))
+                writer.close()
     else:
         print("There isn't a %s file" % data_file)
 
@@ -161,7 +205,16 @@ def create_category_pages(data_file, keyword_name):
 # #     - then get the categories injected into the template(s)
 
 
-create_sitemap()
+awcm.read_site_config('..')
+
+SITEMAP_ENTRIES = read_sitemap_data()
+if SITEMAP_ENTRIES is not None:
+    create_sitemap(SITEMAP_ENTRIES)
+    if awcm.CONFIG['site_url']:
+        create_sitemap_xml(SITEMAP_ENTRIES, awcm.CONFIG['site_url'])
+    else:
+        print("  [info] No site_url in config.json, so no %s" %
+              SITEMAP_XML_FILE)
 
 create_category_pages(
     os.path.join(META_DIR, '000_categories.json'), 
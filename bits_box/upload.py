@@ -2,14 +2,34 @@
 """
 Utility to upload files to a remote FTP server
 
+Only files that are new or have changed since the last upload are sent;
+a manifest of the size and hash of every uploaded file is kept in
+MANIFEST_FILE. Use --full to upload everything, and --delete to remove
+files from the server that no longer exist locally.
+
+Files are uploaded over several FTP connections at once. The following
+optional settings in config.json control this:
+    ftp_port         (default 21)
+    ftp_connections  the number of connections (default 4)
+    ftp_retries      the number of times to try each file (default 3)
+
 First working version: 19 Dec 2012
 Updated for AWCM (Python2): 12 Dec 2017
 """
 
+import argparse
+import ftplib
+import hashlib
 import os
 from ftplib import FTP, error_perm
 import getpass
 import json
+import posixpath
+import queue
+import threading
+import time
+
+MANIFEST_FILE = os.path.join('_meta', '_cache', 'upload_manifest.json')
 
 
 def read_from_config_file():
@@ -35,6 +55,16 @@ def read_from_config_file():
     return ftp_hostname, ftp_path, ftp_username, ftp_password
 
 
+def read_upload_settings():
+    """ Read the optional upload settings from the config.json file """
+    with open('config.json', 'r') as cfg_fh:
+        config = json.load(cfg_fh)
+
+    return {'port': config.get('ftp_port', 21),
+            'connections': config.get('ftp_connections', 4),
+            'retries': config.get('ftp_retries', 3)}
+
+
 def find_all_files(adir):
     candidates = []
     for root, dirs, files in os.walk(adir):
@@ -48,82 +78,278 @@ def find_all_files(adir):
 
 
 def find_all_folders(files):
-    folders = []
+    """ All the folders needed to hold the files, including the folders
+    that contain other folders. They're sorted, so parent folders always
+    come before the folders inside them. """
+    folders = set()
     for f in files:
         path = os.path.dirname(f)
-        if path and path not in folders:
-            folders.append(path)
-    return folders
-
-
-def make_ftp_conn(remote_host, username, password):
-    ftp = FTP(remote_host)
+        while path and path not in folders:
+            folders.add(path)
+            path = os.path.dirname(path)
+    return sorted(folders)
+
+
+def file_fingerprint(path):
+    """ The size and SHA-1 hash of a file """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(65536), b''):
+            digest.update(chunk)
+    return [os.path.getsize(path), digest.hexdigest()]
+
+
+def load_manifest(manifest_file, target):
+    """ The files last uploaded to target, e.g. "ftp.example.com/www",
+    as a dict of filename: [size, sha1] """
+    try:
+        with open(manifest_file, 'r') as fh:
+            manifest = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+    return manifest.get(target, {})
+
+
+def save_manifest(manifest_file, target, uploaded):
+    """ Save the files now on target; the manifests of other targets are
+    kept """
+    try:
+        with open(manifest_file, 'r') as fh:
+            manifest = json.load(fh)
+    except (IOError, OSError, ValueError):
+        manifest = {}
+    manifest[target] = uploaded
+
+    manifest_dir = os.path.dirname(manifest_file)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    with open(manifest_file + '.tmp', 'w') as fh:
+        json.dump(manifest, fh, indent=0, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def find_changed_files(fingerprints, uploaded):
+    """ The files whose fingerprint differs from the one last uploaded
+    (including new files) """
+    return [filename for filename in sorted(fingerprints)
+            if uploaded.get(filename) != fingerprints[filename]]
+
+
+def find_deleted_files(fingerprints, uploaded):
+    """ The files that were uploaded, but no longer exist locally """
+    return sorted(set(uploaded) - set(fingerprints))
+
+
+def make_ftp_conn(remote_host, username, password, port=21):
+    ftp = FTP()
+    ftp.connect(remote_host, port)
     ftp.login(username, password)
     return ftp
 
 
+def close_ftp_conn(ftp):
+    """ Close a connection, politely if possible """
+    try:
+        ftp.quit()
+    except ftplib.all_errors:
+        ftp.close()
+
+
+def list_remote_subfolders(ftp, remote_path):
+    """ The names of the folders inside remote_path on the target system.
+
+    Uses MLSD if the server supports it. Otherwise NLST is used, which
+    can't tell files and folders apart, so the names of files are included
+    too.
+    """
+    try:
+        return set(name for name, facts in ftp.mlsd(remote_path, ['type'])
+                   if facts.get('type') == 'dir')
+    except error_perm as exc:
+        if not str(exc).startswith(('500', '501', '502')):
+            raise
+    try:
+        return set(posixpath.basename(name.rstrip('/'))
+                   for name in ftp.nlst(remote_path))
+    except error_perm:
+        # Some servers say "550 No files found" for an empty folder
+        return set()
+
+
+def list_remote_folders(remote_dir, ftp, folders):
+    """ Which of the folders (relative to remote_dir) already exist on the
+    target system.
+
+    The remote tree is listed once, from the top down, and only the
+    folders that exist and contain some of the wanted folders are listed.
+    """
+    wanted_children = {}
+    for f in folders:
+        wanted_children.setdefault(posixpath.dirname(f), set()).add(f)
+
+    existing = set()
+    to_list = ['']
+    while to_list:
+        parent = to_list.pop()
+        if parent not in wanted_children:
+            continue
+        subfolders = list_remote_subfolders(
+            ftp, posixpath.join(remote_dir, parent))
+        for child in wanted_children[parent]:
+            if posixpath.basename(child) in subfolders:
+                existing.add(child)
+                to_list.append(child)
+    return existing
+
+
 def make_folders_on_target(remote_dir, ftp, folders):
     """ Ensure all the folders are present on the target system
     under remote_dir
 
+    folders should include the parents of any folders inside other
+    folders, as find_all_folders() gives.
     """
     debug = False
-    ftp.cwd(remote_dir)
+    existing = list_remote_folders(remote_dir, ftp, folders)
 
-    for f in folders:
+    # Sorting puts the parent folders first
+    for f in sorted(set(folders) - existing):
         if debug:
-            print("Folder %s" % f)
-        try:
-            ftp.cwd(f)
-            ftp.cwd('..')
-        except error_perm:
-            if debug:
-                print("Currently in %s Cannot cd into %s" % (ftp.pwd(), f))
-
-            parent_folder = os.path.normpath(os.path.join(f, '..'))
+            print("Making folder %s" % f)
+        ftp.mkd(posixpath.join(remote_dir, f))
 
-            if debug:
-                print("Trying to make parent folders: %s" % parent_folder)
 
-            # Recurse up the tree, trying to make parent folders
-            if parent_folder != '.':
-                make_folders_on_target('/' + remote_dir, ftp, [parent_folder])
-
-            if debug:
-                print("Finished mk-parent-dir. Try mkd on %s" % f)
-            ftp.mkd(f)
+def delete_files_on_target(remote_dir, ftp, file_list):
+    """ Delete the files in file_list from under remote_dir """
+    ftp.cwd(remote_dir)
+    for filename in file_list:
+        print("deleting %s" % filename)
+        try:
+            ftp.delete(filename)
+        except error_perm as exc:
+            # e.g. it has already been deleted
+            print("    Could not delete %s: %s" % (filename, exc))
 
 
-def ftp_files_to_target(local_dir, remote_dir, ftp, file_list):
+def ftp_files_in_parallel(local_dir, remote_dir, connections, connect,
+                          file_list, retries=3, on_uploaded=None):
     """
-    Copy the file_list to the target system.
-    Each item in file_list is a filename, potentially with path
-    prefix.
-
-    Raises an error_perm if FTP authentication fails at ftp.login()
+    Copy the file_list to the target system, sharing the files between
+    several FTP connections, each used by its own thread.
+
+    Args:
+        local_dir: the folder containing the files
+        remote_dir: the folder on the target system to copy them into
+        connections: a list of (logged in) FTP connections to use. They
+            are all closed when the files have been copied
+        connect: a function returning a new FTP connection, used if one of
+            the connections fails
+        file_list: the files to copy; each item is a filename, potentially
+            with path prefix
+        retries: the number of times to try each file
+        on_uploaded: if given, called with each filename once it has been
+            uploaded (only one call is made at a time)
+
+    Returns the list of files that could not be uploaded.
     """
-    ftp.cwd(remote_dir)
+    work = queue.Queue()
     for filename in file_list:
-        if os.path.basename(filename) in ['.DS_Store']:
-            continue
-        localfilename = os.path.join(local_dir, filename)
-        print("uploading %s" % filename)
-        with open(localfilename, "rb") as fh:
-            ftp.storbinary('STOR ' + filename, fh)
-        print("    Done")
-
-    print("Quitting FTP")
-    ftp.quit()
-
+        if os.path.basename(filename) not in ['.DS_Store']:
+            work.put((filename, 1))
+
+    lock = threading.Lock()
+    failed = []
+    totals = {'files': 0, 'bytes': 0}
+
+    def upload_worker(ftp):
+        if ftp is not None:
+            ftp.cwd(remote_dir)
+        while True:
+            try:
+                filename, attempt = work.get_nowait()
+            except queue.Empty:
+                break
+            localfilename = os.path.join(local_dir, filename)
+            try:
+                if ftp is None:
+                    ftp = connect()
+                    ftp.cwd(remote_dir)
+                with open(localfilename, "rb") as fh:
+                    ftp.storbinary('STOR ' + filename, fh)
+            except ftplib.all_errors as exc:
+                # The connection may be broken; start again with a new one
+                if ftp is not None:
+                    ftp.close()
+                ftp = None
+                if attempt < retries:
+                    print("    Retrying %s (%s)" % (filename, exc))
+                    work.put((filename, attempt + 1))
+                else:
+                    print("    FAILED to upload %s (%s)" % (filename, exc))
+                    with lock:
+                        failed.append(filename)
+                continue
+
+            print("uploaded %s" % filename)
+            with lock:
+                totals['files'] += 1
+                totals['bytes'] += os.path.getsize(localfilename)
+                if on_uploaded is not None:
+                    on_uploaded(filename)
+        if ftp is not None:
+            close_ftp_conn(ftp)
+
+    start_time = time.time()
+    threads = [threading.Thread(target=upload_worker, args=(ftp,))
+               for ftp in connections]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = max(time.time() - start_time, 0.001)
+
+    print("Uploaded %d files (%.1f kB) in %.1fs over %d connections: "
+          "%.1f files/s, %.1f kB/s" % (
+              totals['files'], totals['bytes'] / 1024.0, elapsed,
+              len(connections), totals['files'] / elapsed,
+              totals['bytes'] / 1024.0 / elapsed))
+    if failed:
+        print("%d files could not be uploaded" % len(failed))
+    return sorted(failed)
+
+
+def main_upload(full=False, delete=False):
+    """
+    Upload the new and changed files in output/ to the FTP server.
 
-def main_upload():
+    Args:
+        full: upload every file, whether or not it has changed
+        delete: delete files from the server that were uploaded before
+            but no longer exist locally
+    """
     debug = False
     cooked_dir = 'output'
     ftp_hostname, ftp_path, ftp_username, ftp_password = \
         read_from_config_file()
+    settings = read_upload_settings()
+
+    target = ftp_hostname + ftp_path
+    uploaded = load_manifest(MANIFEST_FILE, target)
+    fingerprints = {}
+    for filename in find_all_files(cooked_dir):
+        fingerprints[filename] = file_fingerprint(
+            os.path.join(cooked_dir, filename))
+
+    if full:
+        cooked_files = sorted(fingerprints)
+    else:
+        cooked_files = find_changed_files(fingerprints, uploaded)
+    deleted_files = find_deleted_files(fingerprints, uploaded) \
+        if delete else []
+    print("%d of %d files are unchanged since the last upload" % (
+        len(fingerprints) - len(cooked_files), len(fingerprints)))
 
-    cooked_files = find_all_files(cooked_dir)
-    if not cooked_files:
+    if not cooked_files and not deleted_files:
         print("Nothing to upload")
     else:
         if debug:
@@ -136,12 +362,45 @@ def main_upload():
 
         if debug:
             print("Folders: %r" % folders)
-        ftp_handle = make_ftp_conn(ftp_hostname, ftp_username,
-                                   ftp_password)
 
-        make_folders_on_target(ftp_path, ftp_handle, folders)
-        ftp_files_to_target(cooked_dir, ftp_path, ftp_handle, cooked_files)
+        def connect():
+            return make_ftp_conn(ftp_hostname, ftp_username, ftp_password,
+                                 port=settings['port'])
+
+        # Log in on all the connections first, so that we find out
+        # straight away if there's a problem.
+        num_connections = max(1, min(settings['connections'],
+                                     len(cooked_files)))
+        connections = [connect() for _ in range(num_connections)]
+
+        def record_upload(filename):
+            uploaded[filename] = fingerprints[filename]
+
+        # Save the manifest even if the upload fails part way through, so
+        # the files that did get uploaded aren't sent again.
+        try:
+            if deleted_files:
+                delete_files_on_target(ftp_path, connections[0],
+                                       deleted_files)
+                for filename in deleted_files:
+                    del uploaded[filename]
+            make_folders_on_target(ftp_path, connections[0], folders)
+            failed = ftp_files_in_parallel(
+                cooked_dir, ftp_path, connections, connect, cooked_files,
+                retries=settings['retries'], on_uploaded=record_upload)
+        finally:
+            save_manifest(MANIFEST_FILE, target, uploaded)
+        if failed:
+            raise SystemExit("Could not upload: %s" % ', '.join(failed))
 
 
 if __name__ == '__main__':
-    main_upload()
+    parser = argparse.ArgumentParser(
+        description="Upload the website in output/ to an FTP server")
+    parser.add_argument('--full', action='store_true',
+                        help="upload every file, even if it hasn't changed")
+    parser.add_argument('--delete', action='store_true',
+                        help="delete files from the server that no longer "
+                             "exist in output/")
+    args = parser.parse_args()
+    main_upload(full=args.full, delete=args.delete)
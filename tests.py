@@ -2,18 +2,37 @@
 # coding: utf-8
 # Tests for AWCM (run with pytest ./tests.py)
 
+import ftplib
+import gzip
+import importlib.util
+import json
 import os
 import random
 import shutil
 import string
+import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
+import urllib.error
+import urllib.request
+from xml.etree import ElementTree
+import zipfile
 
 import pytest
 
+from awcm import bench, serve, watch
 from awcm.awcm import get_back_path, HtmlFileReader, \
     get_template_name, get_theme_name, html_encode, \
-    fix_incomplete_html, mkdir_p, read_site_config, \
-    CONFIG, TemplateWriter
+    fix_incomplete_html, make_preview, mkdir_p, read_site_config, \
+    CONFIG, TemplateWriter, PageCache, DependencyGraph, \
+    make_pages_from_template, run_components, BuildError, SiteIndex, \
+    NavLists, get_tag_list_as_html, get_category_list_as_html, \
+    PaginatedWriter, sync_tree, copy_all_static_files, BuildProfile, \
+    profile_phase, count_bytes, start_profile, stop_profile, get_profile, \
+    main, file_stamp, precompress_files, SitemapWriter, w3c_datetime, \
+    DirectorySink, WRITE_BUFFER_SIZE, ArchiveSink
 
 
 def test_read_content():
@@ -162,6 +181,39 @@ def test_custom_theme():
     assert parts['meta']['theme'] == 'lotr'
 
 
+def test_parse_head_matches_parse_html():
+    hfr = HtmlFileReader('no_filename')
+    html_frag = """
+    <head>
+      <title>Gandalf &amp; Bilbo</title>
+      <meta name="category" content="hobbit"/>
+      <meta name="categories" content="lotr"/>
+      <meta name="tags" value="hobbit"/>
+    </head>
+    <body><p>Hi</p></body>
+    """
+    parts = hfr.parse_html(html_frag)
+    head = hfr.parse_head([html_frag[:40], html_frag[40:]])
+
+    assert 'content' not in head
+    assert head['title'] == parts['title'] == 'Gandalf & Bilbo'
+    assert head['meta']['categories'] == parts['meta']['categories']
+    assert head['meta']['categories'] == 'hobbit, lotr'
+    assert 'tags' not in head['meta']
+    assert len(head['meta']['_raw_metas']) == 3
+
+
+def test_parse_head_stops_at_body():
+    """ Nothing after the start of the <body> is parsed """
+    hfr = HtmlFileReader('no_filename')
+
+    def chunks():
+        yield '<head><title>Gandalf</title></head><body>'
+        raise AssertionError("read too far")
+
+    assert hfr.parse_head(chunks())['title'] == 'Gandalf'
+
+
 # --------------
 # get_back_path()
 # --------------
@@ -289,6 +341,32 @@ Was blind but now I see
     fixed_html = fix_incomplete_html(input_str)
     assert fixed_html == expected + missing_end
 
+
+# ----------------------------
+# make_preview
+# ----------------------------
+def test_make_preview_short_html_is_not_truncated():
+    input_str = """<div>Go to <a href="#top">Top</a> of page.<p></p></div>"""
+    assert make_preview(input_str, 100, 50) == (input_str, False)
+
+
+def test_make_preview_counts_text_not_tags():
+    input_str = """<div class="a-very-long-class-name">Gandalf</div>"""
+    assert make_preview(input_str, 7, 5) == (input_str, False)
+
+
+def test_make_preview_closes_open_tags():
+    input_str = """<div>bla bla <ul><li>item 1</li><li>item 2</li></ul>""" \
+        """<p>more</p></div>"""
+    expected = """<div>bla bla <ul><li>item 1</li><li>it</li></ul></div>"""
+    assert make_preview(input_str, 20, 16) == (expected, True)
+
+
+def test_make_preview_does_not_cut_entities():
+    input_str = """<p>Fish &amp; Chips &amp; Peas</p>"""
+    expected = """<p>Fish &amp;</p>"""
+    assert make_preview(input_str, 10, 6) == (expected, True)
+
 #
 # -------------------------------------------
 #
@@ -527,5 +605,1669 @@ def test_template_writer_validate_template_with_all_files_present():
     os.rmdir(temp_dir_name)
 
 
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_template_writer_only_validates_a_theme_once(capsys):
+    temp_dir_name = create_temporary_filename()
+    os.makedirs(os.path.join(temp_dir_name, 'themes/x/templates'))
+
+    tw = TemplateWriter(templates_dir=os.path.join(temp_dir_name, 'themes'))
+    assert tw.validate_template('x') is False
+    assert tw.validate_template('x') is False
+    assert capsys.readouterr().out.count('WARNING') == 2  # one per file
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_template_writer_caches_compiled_templates():
+    temp_dir_name = create_temporary_filename()
+    _templates_dir = os.path.join(temp_dir_name, 'themes/x/templates')
+    bytecode_dir = os.path.join(temp_dir_name, 'bytecode')
+    os.makedirs(_templates_dir)
+    with open(os.path.join(_templates_dir, 'common.thtml'), 'w') as fh:
+        fh.write("<h1>{{ title }}</h1>")
+
+    tw = TemplateWriter(templates_dir=os.path.join(temp_dir_name, 'themes'),
+                        bytecode_cache_dir=bytecode_dir)
+    tw.write(temp_dir_name, 'a.html', 'x', 'common', {'title': 'A'})
+    template = tw.read('x/templates/common.thtml')
+    assert tw.read('x/templates/common.thtml') is template
+    assert len(os.listdir(bytecode_dir)) == 1
+
+    # A new TemplateWriter can use the compiled template
+    tw = TemplateWriter(templates_dir=os.path.join(temp_dir_name, 'themes'),
+                        bytecode_cache_dir=bytecode_dir)
+    tw.write(temp_dir_name, 'b.html', 'x', 'common', {'title': 'B'})
+    with open(os.path.join(temp_dir_name, 'b.html')) as fh:
+        assert fh.read() == '<h1>B</h1>'
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_template_writer_missing_template_is_a_build_error():
+    temp_dir_name = create_temporary_filename()
+    os.makedirs(os.path.join(temp_dir_name, 'themes/x/templates'))
+
+    tw = TemplateWriter(templates_dir=os.path.join(temp_dir_name, 'themes'))
+    with pytest.raises(BuildError) as exc_info:
+        tw.write(temp_dir_name, 'a.html', 'x', 'nosuch', {'title': 'A'})
+    assert 'x/templates/nosuch.thtml' in str(exc_info.value)
+    assert not os.path.exists(os.path.join(temp_dir_name, 'a.html'))
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_template_writer_streams_the_same_page_as_render():
+    temp_dir_name = create_temporary_filename()
+    _templates_dir = os.path.join(temp_dir_name, 'themes/x/templates')
+    os.makedirs(_templates_dir)
+    with open(os.path.join(_templates_dir, 'common.thtml'), 'w') as fh:
+        fh.write("<h1>{{ title }}</h1>"
+                 "{% for i in items %}<p>{{ i }}</p>{% endfor %}"
+                 "<a href=\"{{ back_path }}\">{{ theme_path }}</a>")
+
+    tw = TemplateWriter(templates_dir=os.path.join(temp_dir_name, 'themes'))
+    tokens = {'title': 'A', 'items': list(range(1000))}
+    tw.write(os.path.join(temp_dir_name, 'out'), 'sub/a.html', 'x',
+             'common', tokens)
+    template = tw.read('x/templates/common.thtml')
+    with open(os.path.join(temp_dir_name, 'out', 'sub/a.html')) as fh:
+        assert fh.read() == template.render(tokens)
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_directory_sink_writes_pages_a_piece_at_a_time():
+    """ write_page() writes each piece as it comes, rather than joining
+    the whole page first """
+    temp_dir_name = create_temporary_filename()
+    piece_size = 2 * WRITE_BUFFER_SIZE
+    written = []
+
+    def pieces():
+        for letter in 'abc':
+            # Pieces bigger than the buffer go straight to the file, so by
+            # now the ones before must be there.
+            tmp_files = [name for name in os.listdir(temp_dir_name)
+                         if name.endswith('.tmp')]
+            assert len(tmp_files) == 1
+            assert os.path.getsize(os.path.join(
+                temp_dir_name, tmp_files[0])) == len(written) * piece_size
+            written.append(letter)
+            yield letter * piece_size
+
+    DirectorySink(temp_dir_name).write_page('a.html', pieces())
+
+    assert written == ['a', 'b', 'c']
+    assert os.listdir(temp_dir_name) == ['a.html']
+    with open(os.path.join(temp_dir_name, 'a.html')) as fh:
+        assert fh.read() == ''.join(letter * piece_size for letter in 'abc')
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+# --------------
+# PageCache
+# --------------
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_page_cache_returns_cached_page():
+    """ Once a page has been read, it comes from the cache (and so
+    doesn't get parsed again) until the file changes."""
+    temp_dir_name = create_temporary_filename()
+    os.mkdir(temp_dir_name)
+    page = os.path.join(temp_dir_name, 'page.html')
+    with open(page, 'w') as fh:
+        fh.write('<title>Gandalf</title><meta name="tags" content="a"/>'
+                 '<body><p>Hi</p></body>')
+    cache = PageCache(os.path.join(temp_dir_name, 'cache'))
+
+    first = HtmlFileReader(page, cache=cache).read()
+    assert first['title'] == 'Gandalf'
+
+    # A fresh PageCache has to get the entry from disk
+    hfr = HtmlFileReader(page, cache=PageCache(cache.cache_dir))
+    hfr.parse_html = None  # would blow up if called
+    second = hfr.read()
+    assert second['title'] == 'Gandalf'
+    assert second['content'] == first['content']
+    assert second['meta']['tags'] == 'a'
+    assert second['meta']['_raw_metas'] == ['<meta content="a" name="tags"/>']
+    assert second == first
+
+    # Changing what we're given doesn't change the cache
+    second['meta']['tags'] = 'b'
+    second['meta']['_raw_metas'].append('<meta/>')
+    first['title'] = 'Saruman'
+    for reader_cache in [cache, PageCache(cache.cache_dir)]:
+        assert HtmlFileReader(page, cache=reader_cache).read() == \
+            HtmlFileReader(page).read()
+    head = HtmlFileReader(page, cache=cache).read_meta()
+    head['meta']['tags'] = 'b'
+    assert HtmlFileReader(page, cache=cache).read_meta()['meta']['tags'] == \
+        'a'
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_read_meta_is_the_same_whether_or_not_cached():
+    """ read_meta() only looks in the <head>, even when the whole page has
+    been read (and cached) already """
+    temp_dir_name = create_temporary_filename()
+    os.mkdir(temp_dir_name)
+    page = os.path.join(temp_dir_name, 'page.html')
+    with open(page, 'w') as fh:
+        fh.write('<head><title>Gandalf</title>'
+                 '<meta name="category" content="wizard"/></head>'
+                 '<meta name="tags" content="between"/>'
+                 '<body><meta name="category" content="late"/>'
+                 '<p>Hi</p></body>')
+    cache = PageCache(os.path.join(temp_dir_name, 'cache'))
+
+    uncached = HtmlFileReader(page, cache=cache).read_meta()
+    assert uncached['meta']['categories'] == 'wizard'
+    assert 'late' in HtmlFileReader(page, cache=cache).read()['meta'][
+        'categories']
+    assert HtmlFileReader(page, cache=cache).read_meta() == uncached
+    assert HtmlFileReader(
+        page, cache=PageCache(cache.cache_dir)).read_meta() == uncached
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_page_cache_notices_changed_files():
+    temp_dir_name = create_temporary_filename()
+    os.mkdir(temp_dir_name)
+    page = os.path.join(temp_dir_name, 'page.html')
+    with open(page, 'w') as fh:
+        fh.write('<title>Gandalf</title><body><p>Hi</p></body>')
+    cache = PageCache(os.path.join(temp_dir_name, 'cache'))
+    assert HtmlFileReader(page, cache=cache).read()['title'] == 'Gandalf'
+
+    with open(page, 'w') as fh:
+        fh.write('<title>Saruman the White</title><body><p>Hi</p></body>')
+    assert cache.get(page) is None
+    title = HtmlFileReader(page, cache=cache).read()['title']
+    assert title == 'Saruman the White'
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_page_cache_extras_dont_rewrite_the_page():
+    temp_dir_name = create_temporary_filename()
+    os.mkdir(temp_dir_name)
+    page = os.path.join(temp_dir_name, 'page.html')
+    with open(page, 'w') as fh:
+        fh.write('<title>Gandalf</title><body><p>Hi</p></body>')
+    cache = PageCache(os.path.join(temp_dir_name, 'cache'))
+
+    HtmlFileReader(page, cache=cache).read()
+    assert len(os.listdir(cache.cache_dir)) == 1  # the <head> goes with it
+    entry_file = os.path.join(cache.cache_dir,
+                              os.listdir(cache.cache_dir)[0])
+    inode = os.stat(entry_file).st_ino
+
+    cache.put_extra(page, 'summary', 'Hi')
+    cache.put_extra(page, 'preview', '<p>Hi</p>')
+    assert os.stat(entry_file).st_ino == inode
+    assert len(os.listdir(cache.cache_dir)) == 2
+
+    fresh_cache = PageCache(cache.cache_dir)
+    assert fresh_cache.get_extra(page, 'summary') == 'Hi'
+    assert fresh_cache.get_extra(page, 'preview') == '<p>Hi</p>'
+    assert fresh_cache.get_extra(page, HtmlFileReader.HEAD_EXTRA)[
+        'title'] == 'Gandalf'
+
+    # A new version of the page starts again without them
+    with open(page, 'w') as fh:
+        fh.write('<title>Saruman the White</title><body><p>Hi</p></body>')
+    HtmlFileReader(page, cache=PageCache(cache.cache_dir)).read()
+    fresh_cache = PageCache(cache.cache_dir)
+    assert fresh_cache.get_extra(page, 'summary') is None
+    assert fresh_cache.get_extra(page, HtmlFileReader.HEAD_EXTRA)[
+        'title'] == 'Saruman the White'
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_site_index_remembers_extras():
+    """ Things worked out from a page are only worked out once, until
+    the page changes """
+    temp_dir_name = create_temporary_filename()
+    os.makedirs(os.path.join(temp_dir_name, 'content'))
+    meta_dir = os.path.join(temp_dir_name, '_meta')
+    page = os.path.join(temp_dir_name, 'content', 'page.html')
+    with open(page, 'w') as fh:
+        fh.write('<title>Gandalf</title><body><p>Hi</p></body>')
+    calls = []
+
+    def summarise(page_name):
+        calls.append(page_name)
+        return index.read(page_name)['title'].upper()
+
+    index = SiteIndex(os.path.join(temp_dir_name, 'content'), meta_dir)
+    assert index.extra('page.html', 'shout', summarise) == 'GANDALF'
+    assert index.extra('page.html', 'shout', summarise) == 'GANDALF'
+    assert calls == ['page.html']
+
+    # A new SiteIndex (e.g. in the next build) gets it from the cache
+    index = SiteIndex(os.path.join(temp_dir_name, 'content'), meta_dir)
+    assert index.extra('page.html', 'shout', summarise) == 'GANDALF'
+    assert calls == ['page.html']
+
+    with open(page, 'w') as fh:
+        fh.write('<title>Saruman the White</title><body><p>Hi</p></body>')
+    index = SiteIndex(os.path.join(temp_dir_name, 'content'), meta_dir)
+    assert index.extra('page.html', 'shout', summarise) == \
+        'SARUMAN THE WHITE'
+    assert calls == ['page.html', 'page.html']
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_site_index_keeps_pages_until_forgotten():
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    page = os.path.join(temp_dir_name, 'content', 'a.html')
+    index = SiteIndex(os.path.join(temp_dir_name, 'content'),
+                      os.path.join(temp_dir_name, '_meta'))
+    index.keep_pages = True
+
+    assert index.read('a.html') is index.read('a.html')
+    assert index.read_meta('a.html')['title'] == 'a.html'
+    assert len(index.filenames()) == 5
+    with open(page, 'w') as fh:
+        fh.write('<title>new</title><body><p>Hi</p></body>')
+    os.remove(os.path.join(temp_dir_name, 'content', 'b.html'))
+    assert index.read('a.html')['title'] == 'a.html'
+
+    index.forget('a.html')
+    index.forget('b.html')
+    assert index.read('a.html')['title'] == 'new'
+    assert index.read_meta('a.html')['title'] == 'new'
+    assert len(index.filenames()) == 4
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+# --------------
+# DependencyGraph
+# --------------
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_dependency_graph_detects_changes():
+    temp_dir_name = create_temporary_filename()
+    os.mkdir(temp_dir_name)
+    source = os.path.join(temp_dir_name, 'page.html')
+    template = os.path.join(temp_dir_name, 'common.thtml')
+    state_file = os.path.join(temp_dir_name, 'state.json')
+    for filename in [source, template]:
+        with open(filename, 'w') as fh:
+            fh.write('<p>')
+    with open(os.path.join(temp_dir_name, 'out.html'), 'w') as fh:
+        fh.write('<p>')
+
+    graph = DependencyGraph(state_file, settings={'theme': 'x'})
+    assert not graph.is_fresh('out.html', source, temp_dir_name)
+    graph.record('out.html', source, [template])
+    graph.save()
+
+    graph = DependencyGraph(state_file, settings={'theme': 'x'})
+    assert graph.is_fresh('out.html', source, temp_dir_name)
+    # It's not fresh if it's to be made from something else
+    assert not graph.is_fresh('out.html', template, temp_dir_name)
+
+    # Rewriting a file with the same contents isn't a change...
+    os.utime(template, ns=(0, 0))
+    graph = DependencyGraph(state_file, settings={'theme': 'x'})
+    assert graph.is_fresh('out.html', source, temp_dir_name)
+
+    # ...but new contents are
+    with open(template, 'w') as fh:
+        fh.write('<div>')
+    graph = DependencyGraph(state_file, settings={'theme': 'x'})
+    assert not graph.is_fresh('out.html', source, temp_dir_name)
+
+    # Different settings means everything is rebuilt
+    graph = DependencyGraph(state_file, settings={'theme': 'y'})
+    assert graph.outputs == {}
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_dependency_graph_forgets_deleted_sources():
+    temp_dir_name = create_temporary_filename()
+    os.mkdir(temp_dir_name)
+    state_file = os.path.join(temp_dir_name, 'state.json')
+    source = os.path.join(temp_dir_name, 'page.html')
+    with open(source, 'w') as fh:
+        fh.write('<p>')
+
+    graph = DependencyGraph(state_file, settings={})
+    graph.record('page.html', source, [])
+    graph.record('gone.html', source, [])
+    graph.save()
+
+    graph = DependencyGraph(state_file, settings={})
+    graph.record('page.html', source, [])
+    assert graph.forget_unseen() == ['gone.html']
+    assert list(graph.outputs.keys()) == ['page.html']
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+# --------------
+# NavLists
+# --------------
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_nav_lists_match_tag_and_category_lists():
+    temp_dir_name = create_temporary_filename()
+    os.makedirs(os.path.join(temp_dir_name, '_meta'))
+    os.chdir(temp_dir_name)
+    with open(os.path.join('_meta', '000_tags.json'), 'w') as fh:
+        fh.write('{"hobbit": ["a.html", "b.html"], "wizard": ["c.html"]}')
+
+    nav_lists = NavLists()
+    assert nav_lists.tags_html('../') == get_tag_list_as_html('../')
+    assert nav_lists.tags_html() == get_tag_list_as_html()
+    assert '<a href="../000_nav_tag_wizard.html">wizard</a>&nbsp;(1)' in \
+        nav_lists.tags_html('../')
+    # There's no category data
+    assert nav_lists.categories_html() == get_category_list_as_html() == ''
+
+    # The data is only read once per NavLists
+    os.remove(os.path.join('_meta', '000_tags.json'))
+    assert 'wizard' in nav_lists.tags_html('../../')
+
+    # Tidy up
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+# --------------
+# PaginatedWriter
+# --------------
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_paginated_writer_without_pagination():
+    temp_dir_name = create_temporary_filename()
+    os.mkdir(temp_dir_name)
+    writer = PaginatedWriter(os.path.join(temp_dir_name, 'index.html'), 3, 0,
+                             header=lambda n: '<title>%d</title>' % n,
+                             footer='</body>', separator='\n')
+    for entry in ['a', 'b', 'c']:
+        writer.add([entry, entry])
+    writer.close()
+
+    assert read_all_files(temp_dir_name) == {
+        'index.html': '<title>1</title>\na\na\nb\nb\nc\nc\n</body>'}
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_paginated_writer_splits_pages():
+    temp_dir_name = create_temporary_filename()
+    os.mkdir(temp_dir_name)
+    # A leftover from when there were more entries
+    with open(os.path.join(temp_dir_name, 'index_3.html'), 'w') as fh:
+        fh.write('old')
+
+    writer = PaginatedWriter(os.path.join(temp_dir_name, 'index.html'), 3, 2,
+                             header=lambda n: '<title>%d</title>' % n)
+    for entry in ['a', 'b', 'c']:
+        writer.add([entry])
+    writer.close()
+
+    assert read_all_files(temp_dir_name) == {
+        'index.html': '<title>1</title>ab<div class="awcm-pagination">'
+                      'Page 1 of 2 | <a href="index_2.html">Next &raquo;</a>'
+                      '</div>',
+        'index_2.html': '<title>2</title>c<div class="awcm-pagination">'
+                        '<a href="index.html">&laquo; Previous</a> | '
+                        'Page 2 of 2</div>'}
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+# --------------
+# SitemapWriter
+# --------------
+SITEMAP_NS = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+
+
+def read_sitemap(path):
+    """ The root element's tag, and the text of each child's elements """
+    root = ElementTree.parse(path).getroot()
+    return root.tag.replace(SITEMAP_NS, ''), [
+        {child.tag.replace(SITEMAP_NS, ''): child.text for child in element}
+        for element in root]
+
+
+def test_w3c_datetime():
+    assert w3c_datetime('2015-04-24 10:00') == '2015-04-24'
+    assert w3c_datetime('2015-04-24') == '2015-04-24'
+    assert w3c_datetime('2016-01-02T03:04:05+01:00') == \
+        '2016-01-02T03:04:05+01:00'
+    assert w3c_datetime('last Tuesday') is None
+    assert w3c_datetime(None) is None
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_sitemap_writer():
+    temp_dir_name = create_temporary_filename()
+    os.mkdir(temp_dir_name)
+    sitemap = os.path.join(temp_dir_name, 'sitemap.xml')
+
+    writer = SitemapWriter(sitemap, 'https://example.com')
+    writer.add('a.html', '2015-04-24')
+    writer.add(os.path.join('sub', 'b & c.html'))
+    assert writer.close() == 1
+
+    assert read_sitemap(sitemap) == ('urlset', [
+        {'loc': 'https://example.com/a.html', 'lastmod': '2015-04-24'},
+        {'loc': 'https://example.com/sub/b%20%26%20c.html'}])
+    assert os.listdir(temp_dir_name) == ['sitemap.xml']
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+@pytest.mark.parametrize('limits', [{'max_urls': 2},
+                                    {'max_bytes': 250}])
+def test_sitemap_writer_splits_files(limits):
+    temp_dir_name = create_temporary_filename()
+    os.mkdir(temp_dir_name)
+    sitemap = os.path.join(temp_dir_name, 'sitemap.xml')
+    # A leftover from when there were more pages
+    with open(os.path.join(temp_dir_name, 'sitemap-4.xml'), 'w') as fh:
+        fh.write('old')
+
+    writer = SitemapWriter(sitemap, 'https://example.com/', **limits)
+    for page in ['a.html', 'b.html', 'c.html', 'd.html', 'e.html']:
+        writer.add(page)
+    assert writer.close() == 3
+
+    assert read_sitemap(sitemap) == ('sitemapindex', [
+        {'loc': 'https://example.com/sitemap-%d.xml' % number}
+        for number in [1, 2, 3]])
+    assert read_sitemap(os.path.join(temp_dir_name, 'sitemap-3.xml')) == (
+        'urlset', [{'loc': 'https://example.com/e.html'}])
+    for number in [1, 2, 3]:
+        assert os.path.getsize(os.path.join(
+            temp_dir_name, 'sitemap-%d.xml' % number)) <= 250
+
+    # Fewer pages, so no need for an index any more
+    writer = SitemapWriter(sitemap, 'https://example.com/', **limits)
+    writer.add('a.html')
+    assert writer.close() == 1
+    assert read_sitemap(sitemap) == ('urlset', [
+        {'loc': 'https://example.com/a.html'}])
+    assert os.listdir(temp_dir_name) == ['sitemap.xml']
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+# --------------
+# sync_tree()
+# --------------
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_sync_tree():
+    """ Folders are copied too; unchanged files aren't copied again, and
+    files that have gone from the source are removed """
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    source_dir = os.path.join(temp_dir_name, 'content')
+    destination_dir = os.path.join(temp_dir_name, 'output', 'static')
+
+    assert sync_tree(source_dir, destination_dir) == (5, 0)
+    assert read_all_files(destination_dir) == read_all_files(source_dir)
+    assert sync_tree(source_dir, destination_dir) == (0, 0)
+
+    # Touching a file without changing it doesn't count
+    os.utime(os.path.join(source_dir, 'a.html'), ns=(0, 0))
+    with open(os.path.join(source_dir, 'b.html'), 'w') as fh:
+        fh.write('changed')
+    shutil.rmtree(os.path.join(source_dir, 'sub'))
+    assert sync_tree(source_dir, destination_dir) == (1, 3)
+    assert read_all_files(destination_dir) == read_all_files(source_dir)
+    assert not os.path.exists(os.path.join(destination_dir, 'sub'))
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_sync_tree_with_hard_links():
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    source_dir = os.path.join(temp_dir_name, 'content')
+    destination_dir = os.path.join(temp_dir_name, 'output', 'static')
+
+    assert sync_tree(source_dir, destination_dir, link_mode='hardlink') == \
+        (5, 0)
+    assert os.path.samefile(os.path.join(source_dir, 'sub', 'c.html'),
+                            os.path.join(destination_dir, 'sub', 'c.html'))
+
+    # Going back to copies doesn't write through the link into the source
+    with open(os.path.join(source_dir, 'a.html'), 'w') as fh:
+        fh.write('new')
+    assert sync_tree(source_dir, destination_dir) == (0, 0)
+    os.remove(os.path.join(destination_dir, 'b.html'))
+    assert sync_tree(source_dir, destination_dir) == (1, 0)
+    assert not os.path.samefile(os.path.join(source_dir, 'b.html'),
+                                os.path.join(destination_dir, 'b.html'))
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+# --------------
+# make_pages_from_template()
+# --------------
+def create_sample_site(site_dir):
+    """ A tiny website with a theme, a few pages and an image """
+    templates_dir = os.path.join(site_dir, 'themes', 'x', 'templates')
+    os.makedirs(templates_dir)
+    os.makedirs(os.path.join(site_dir, 'themes', 'x', 'static'))
+    os.makedirs(os.path.join(site_dir, 'content', 'sub'))
+    os.makedirs(os.path.join(site_dir, '_meta'))
+    os.makedirs(os.path.join(site_dir, 'output'))
+    for tmpl in ['common.thtml', 'navigation.thtml']:
+        with open(os.path.join(templates_dir, tmpl), 'w') as fh:
+            fh.write('<h1>{{ title }}</h1>{{ article }}{{ back_path }}')
+    for page in ['a.html', 'b.html', 'sub/c.html', 'sub/d.html']:
+        with open(os.path.join(site_dir, 'content', page), 'w') as fh:
+            fh.write('<title>%s</title><body><p>Hi</p></body>' % page)
+    with open(os.path.join(site_dir, 'content', 'sub', 'e.png'), 'w') as fh:
+        fh.write('not really a picture')
+
+
+def read_all_files(root_dir):
+    contents = {}
+    for root, _dirs, files in os.walk(root_dir):
+        for filename in files:
+            with open(os.path.join(root, filename)) as fh:
+                contents[os.path.relpath(os.path.join(root, filename),
+                                         root_dir)] = fh.read()
+    return contents
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_make_pages_in_parallel_matches_sequential():
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+    CONFIG.update({'theme': 'x', 'default_template': 'common.thtml',
+                   'debug': False})
+
+    make_pages_from_template('themes', 'output', jobs=1)
+    sequential = read_all_files('output')
+    shutil.rmtree('output')
+    os.mkdir('output')
+    make_pages_from_template('themes', 'output', jobs=2)
+    parallel = read_all_files('output')
+
+    assert sequential['sub/c.html'] == '<h1>sub/c.html</h1><p>Hi</p>../'
+    assert 'sub/e.png' in sequential
+    assert parallel == sequential
+
+    # Tidy up
+    CONFIG.update(saved_config)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_make_pages_passes_other_files_through():
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+    CONFIG.update({'theme': 'x', 'default_template': 'common.thtml',
+                   'debug': False, 'content_link_mode': 'copy'})
+    # A folder with no HTML files in it
+    os.makedirs(os.path.join('content', 'downloads'))
+    with open(os.path.join('content', 'downloads', 'f.pdf'), 'w') as fh:
+        fh.write('not really a PDF')
+
+    make_pages_from_template('themes', 'output')
+    assert read_all_files('output')['downloads/f.pdf'] == 'not really a PDF'
+    # Unchanged files aren't copied again
+    inode = os.stat(os.path.join('output', 'sub', 'e.png')).st_ino
+    make_pages_from_template('themes', 'output')
+    assert os.stat(os.path.join('output', 'sub', 'e.png')).st_ino == inode
+
+    CONFIG['content_link_mode'] = 'hardlink'
+    shutil.rmtree('output')
+    os.mkdir('output')
+    make_pages_from_template('themes', 'output')
+    assert os.path.samefile(os.path.join('content', 'downloads', 'f.pdf'),
+                            os.path.join('output', 'downloads', 'f.pdf'))
+
+    # Tidy up
+    CONFIG.update(saved_config)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_failed_pages_keep_their_last_output(jobs):
+    """ In an incremental build, a page that can't be rendered is reported,
+    its last good output is kept, and it's tried again next time """
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+    CONFIG.update({'theme': 'x', 'default_template': 'common.thtml',
+                   'debug': False})
+    make_pages_from_template('themes', 'output', incremental=True, jobs=jobs)
+
+    with open(os.path.join('themes', 'x', 'templates', 'bad.thtml'),
+              'w') as fh:
+        fh.write('{{ missing.x.y }}')
+    for page in ['a.html', 'b.html']:
+        with open(os.path.join('content', page), 'w') as fh:
+            fh.write('<meta name="template" content="bad">'
+                     '<title>new %s</title><body><p>Hi</p></body>' % page)
+    for attempt in range(2):
+        with pytest.raises(BuildError) as exc_info:
+            make_pages_from_template('themes', 'output', incremental=True,
+                                     jobs=jobs)
+        assert '2 page(s): a.html, b.html' in str(exc_info.value)
+        outputs = read_all_files('output')
+        assert outputs['a.html'] == '<h1>a.html</h1><p>Hi</p>'
+        assert outputs['b.html'] == '<h1>b.html</h1><p>Hi</p>'
+    with open(os.path.join('_meta', '_cache', 'build_state.json')) as fh:
+        assert 'a.html' in json.load(fh)['outputs']
+
+    # A template that's missing altogether is reported in the same way
+    with open(os.path.join('content', 'sub', 'c.html'), 'w') as fh:
+        fh.write('<meta name="template" content="missing">'
+                 '<title>c</title><body><p>Hi</p></body>')
+    with pytest.raises(BuildError):
+        make_pages_from_template('themes', 'output', incremental=True,
+                                 jobs=jobs)
+
+    with open(os.path.join('themes', 'x', 'templates', 'bad.thtml'),
+              'w') as fh:
+        fh.write('<h2>{{ title }}</h2>')
+    os.remove(os.path.join('content', 'sub', 'c.html'))
+    make_pages_from_template('themes', 'output', incremental=True, jobs=jobs)
+    assert read_all_files('output')['a.html'] == '<h2>new a.html</h2>'
+
+    # Tidy up
+    CONFIG.update(saved_config)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_make_pages_collects_the_themes_used():
+    """ Including those of pages skipped by an incremental build """
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+    CONFIG.update({'theme': 'x', 'default_template': 'common.thtml',
+                   'debug': False})
+    shutil.copytree(os.path.join('themes', 'x'), os.path.join('themes', 'y'))
+    with open(os.path.join('themes', 'y', 'static', 'y.css'), 'w') as fh:
+        fh.write('p {}')
+    with open(os.path.join('content', 'sub', 'd.html'), 'w') as fh:
+        fh.write('<meta name="theme" content="y"><title>d</title>'
+                 '<body><p>Hi</p></body>')
+
+    assert make_pages_from_template('themes', 'output',
+                                    incremental=True) == {'x', 'y'}
+    assert make_pages_from_template('themes', 'output',
+                                    incremental=True) == {'x', 'y'}
+
+    copy_all_static_files('themes', {'x', 'y'}, 'output')
+    assert read_all_files(os.path.join('output', 'themes')) == \
+        {os.path.join('y', 'y.css'): 'p {}'}
+
+    # Tidy up
+    CONFIG.update(saved_config)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_incremental_build_notices_new_meta_copies():
+    """ A file that turns up in _meta/ replaces the one in the content
+    folder, even though the content folder's one hasn't changed """
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+    CONFIG.update({'theme': 'x', 'default_template': 'common.thtml',
+                   'debug': False, 'content_link_mode': 'copy'})
+    make_pages_from_template('themes', 'output', incremental=True)
+    assert read_all_files('output')['a.html'] == '<h1>a.html</h1><p>Hi</p>'
+
+    os.makedirs(os.path.join('_meta', 'sub'))
+    with open(os.path.join('_meta', 'a.html'), 'w') as fh:
+        fh.write('<title>meta</title><body><p>Hi</p></body>')
+    with open(os.path.join('_meta', 'sub', 'e.png'), 'w') as fh:
+        fh.write('a made picture')
+    for attempt in range(2):
+        make_pages_from_template('themes', 'output', incremental=True)
+        outputs = read_all_files('output')
+        assert outputs['a.html'] == '<h1>meta</h1><p>Hi</p>'
+        assert outputs['sub/e.png'] == 'a made picture'
+
+    # Without the _meta/ copies, we're back to the content folder's files
+    shutil.rmtree('_meta')
+    make_pages_from_template('themes', 'output', incremental=True)
+    outputs = read_all_files('output')
+    assert outputs['a.html'] == '<h1>a.html</h1><p>Hi</p>'
+    assert outputs['sub/e.png'] == 'not really a picture'
+
+    # Tidy up
+    CONFIG.update(saved_config)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+
+def read_archive(archive_path):
+    """ The names of the files in a tar or zip file, in order, and their
+    contents """
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            return [(name, archive.read(name).decode('utf-8'))
+                    for name in archive.namelist()]
+    with tarfile.open(archive_path) as archive:
+        return [(member.name,
+                 archive.extractfile(member).read().decode('utf-8'))
+                for member in archive.getmembers()]
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+@pytest.mark.parametrize('archive_name,jobs', [('site.tar.gz', 1),
+                                               ('site.zip', 2)])
+def test_build_into_an_archive(archive_name, jobs):
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    with open(os.path.join(temp_dir_name, 'themes', 'x', 'static',
+                           'x.css'), 'w') as fh:
+        fh.write('p {}')
+    with open(os.path.join(temp_dir_name, 'config.json'), 'w') as fh:
+        fh.write('{"theme": "x", "default_template": "common.thtml"}')
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+    saved_epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    os.environ['SOURCE_DATE_EPOCH'] = '1700000000'
+
+    main(jobs=jobs)
+    in_folder = read_all_files('output')
+    main(jobs=jobs, output_path=os.path.join('dist', archive_name))
+    with open(os.path.join('dist', archive_name), 'rb') as fh:
+        first_build = fh.read()
+
+    # Everything is there, in a fixed order, and nothing else was written
+    files = read_archive(os.path.join('dist', archive_name))
+    assert [name for name, _contents in files] == [
+        'a.html', 'b.html', 'sub/c.html', 'sub/d.html', 'sub/e.png',
+        'themes/x/x.css']
+    assert {name.replace('/', os.sep): contents
+            for name, contents in files} == in_folder
+    assert os.listdir('dist') == [archive_name]
+
+    # The same website makes the same archive
+    main(jobs=3 - jobs, output_path=os.path.join('dist', archive_name))
+    with open(os.path.join('dist', archive_name), 'rb') as fh:
+        assert fh.read() == first_build
+
+    # Tidy up
+    if saved_epoch is None:
+        del os.environ['SOURCE_DATE_EPOCH']
+    else:
+        os.environ['SOURCE_DATE_EPOCH'] = saved_epoch
+    CONFIG.update(saved_config)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_zip_archives_can_hold_large_files(monkeypatch):
+    """ Files too big for a plain zip entry (over 2 GiB, here made
+    smaller) are added with zip64 """
+    temp_dir_name = create_temporary_filename()
+    os.mkdir(temp_dir_name)
+    big_file = os.path.join(temp_dir_name, 'video.mp4')
+    with open(big_file, 'w') as fh:
+        fh.write('x' * 5000)
+    monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 1000)
+
+    sink = ArchiveSink(os.path.join(temp_dir_name, 'site.zip'))
+    sink.copy_files([('video.mp4', big_file)])
+    sink.add_page('a.html', 'y' * 5000)
+    sink.close()
+    assert read_archive(os.path.join(temp_dir_name, 'site.zip')) == [
+        ('video.mp4', 'x' * 5000), ('a.html', 'y' * 5000)]
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_precompressed_static_files_are_kept(capsys):
+    """ Copying the static files doesn't remove their compressed copies,
+    so they aren't compressed again on every build """
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    with open(os.path.join(temp_dir_name, 'themes', 'x', 'static',
+                           'x.css'), 'w') as fh:
+        fh.write('p { color: red; }\n' * 100)
+    with open(os.path.join(temp_dir_name, 'config.json'), 'w') as fh:
+        fh.write('{"theme": "x", "default_template": "common.thtml", '
+                 '"precompress": true}')
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+    compressed_css = os.path.join('output', 'themes', 'x', 'x.css.gz')
+
+    main()
+    assert 'Precompressed 1 files, removed 0' in capsys.readouterr().out
+    inode = os.stat(compressed_css).st_ino
+    main()
+    out = capsys.readouterr().out
+    assert 'Theme x: 0 static files copied, 0 removed' in out
+    assert 'Precompressed 0 files, removed 0' in out
+    assert os.stat(compressed_css).st_ino == inode
+
+    # Tidy up
+    CONFIG.update(saved_config)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_failed_build_leaves_the_archive_alone():
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    with open(os.path.join(temp_dir_name, 'config.json'), 'w') as fh:
+        fh.write('{"theme": "x", "default_template": "common.thtml"}')
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+
+    main(output_path='site.tar')
+    with open(os.path.join('content', 'b.html'), 'w') as fh:
+        fh.write('<meta name="template" content="missing">'
+                 '<title>b</title><body><p>Hi</p></body>')
+    with pytest.raises(BuildError):
+        main(jobs=2, output_path='site.tar')
+    assert dict(read_archive('site.tar'))['b.html'] == \
+        '<h1>b.html</h1><p>Hi</p>'
+    assert sorted(os.listdir('.')) == sorted([
+        '_meta', 'config.json', 'content', 'output', 'site.tar', 'themes'])
+
+    # Tidy up
+    CONFIG.update(saved_config)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_precompress_files(jobs):
+    temp_dir_name = create_temporary_filename()
+    os.makedirs(os.path.join(temp_dir_name, 'output', 'sub'))
+    os.chdir(temp_dir_name)
+    files = {'a.html': '<p>Hello</p>' * 100,
+             os.path.join('sub', 'b.js'): 'var x = 1;\n' * 100,
+             'small.css': 'p {}',
+             'c.png': 'x' * 1000}
+    for filename, contents in files.items():
+        with open(os.path.join('output', filename), 'w') as fh:
+            fh.write(contents)
+
+    assert precompress_files('output', min_size=100, jobs=jobs) == (2, 0)
+    with gzip.open(os.path.join('output', 'a.html.gz'), 'rt') as fh:
+        assert fh.read() == files['a.html']
+    assert not os.path.exists(os.path.join('output', 'small.css.gz'))
+    assert not os.path.exists(os.path.join('output', 'c.png.gz'))
+
+    # Only files that have changed are compressed again
+    assert precompress_files('output', min_size=100, jobs=jobs) == (0, 0)
+    stat = os.stat(os.path.join('output', 'a.html'))
+    os.utime(os.path.join('output', 'a.html'),
+             ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert precompress_files('output', min_size=100, jobs=jobs) == (1, 0)
+    # ...including going back to an older version
+    os.utime(os.path.join('output', 'a.html'),
+             ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert precompress_files('output', min_size=100, jobs=jobs) == (1, 0)
+
+    # Compressed copies of files that have gone are removed
+    os.remove(os.path.join('output', 'sub', 'b.js'))
+    assert precompress_files('output', min_size=100, jobs=jobs) == (0, 1)
+    assert not os.path.exists(os.path.join('output', 'sub', 'b.js.gz'))
+
+    # Tidy up
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+
+
+def test_run_micro_benchmarks():
+    results = bench.run_micro_benchmarks(repeat=1,
+                                         names=['html_encode'])
+    assert list(results) == ['html_encode']
+    assert results['html_encode']['seconds'] > 0
+    assert results['html_encode']['number'] >= 1
+
+
+def test_compare_micro_benchmarks():
+    baseline = {'a': {'seconds': 1.0}, 'b': {'seconds': 2.0},
+                'gone': {'seconds': 1.0}}
+    results = {'a': {'seconds': 1.1}, 'b': {'seconds': 3.0},
+               'new': {'seconds': 1.0}}
+    comparison, regressions = bench.compare_micro_benchmarks(
+        baseline, results, threshold=0.2)
+    assert [(name, before, after) for name, before, after, _ in
+            comparison] == [('a', 1.0, 1.1), ('b', 2.0, 3.0)]
+    assert comparison[1][3] == pytest.approx(0.5)
+    assert regressions == ['b']
+
+# --------------
+# BuildProfile
+# --------------
+def test_build_profile_phases():
+    profile = start_profile()
+    try:
+        with profile_phase('outer'):
+            count_bytes(read=10)
+            with profile_phase('inner'):
+                count_bytes(written=5)
+        with profile_phase('outer'):
+            pass
+        profile.add_page('a.html', 0.5)
+        profile.add_page('b.html', 2.0)
+        profile.add_page('c.html', 1.0)
+    finally:
+        stop_profile()
+    assert get_profile() is None
+
+    assert profile.phases['outer']['calls'] == 2
+    assert profile.phases['outer']['bytes_read'] == 10
+    assert profile.phases['outer']['bytes_written'] == 0
+    assert profile.phases['inner']['bytes_written'] == 5
+    assert profile.phases['outer']['wall'] >= \
+        profile.phases['inner']['wall']
+    assert profile.report(slowest=2)['slowest_pages'] == [
+        {'page': 'b.html', 'seconds': 2.0},
+        {'page': 'c.html', 'seconds': 1.0}]
+
+    # The profile of a worker process is added to the main one
+    merged = BuildProfile()
+    merged.add_page('a.html', 1.0)
+    merged.merge(profile.take())
+    assert profile.phases == {}
+    assert merged.phases['outer']['calls'] == 2
+    assert merged.pages['a.html'] == 1.5
+    assert 'Slowest pages:' in merged.summary()
+
+
+def test_build_profile_nested_phases():
+    """ Bytes are counted in the right phase once a nested one has ended,
+    even if nothing had been counted in either of them """
+    profile = start_profile()
+    try:
+        with profile_phase('outer'):
+            with profile_phase('inner'):
+                pass
+            count_bytes(read=3)
+            with profile_phase('inner'):
+                count_bytes(written=2)
+    finally:
+        stop_profile()
+
+    assert profile.phases['outer']['bytes_read'] == 3
+    assert profile.phases['outer']['bytes_written'] == 0
+    assert profile.phases['inner']['calls'] == 2
+    assert profile.phases['inner']['bytes_read'] == 0
+    assert profile.phases['inner']['bytes_written'] == 2
+
+
+def test_profile_phase_does_nothing_when_not_profiling():
+    with profile_phase('anything'):
+        count_bytes(read=10)
+    assert get_profile() is None
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_make_pages_with_profiling(jobs):
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+    CONFIG.update({'theme': 'x', 'default_template': 'common.thtml',
+                   'debug': False})
+
+    profile = start_profile()
+    try:
+        make_pages_from_template('themes', 'output', jobs=jobs)
+    finally:
+        stop_profile()
+    profiled = read_all_files('output')
+    shutil.rmtree('output')
+    os.mkdir('output')
+    make_pages_from_template('themes', 'output', jobs=jobs)
+
+    assert read_all_files('output') == profiled
+    for phase in ['discovery', 'parse', 'token build', 'render', 'write']:
+        assert phase in profile.phases
+    assert profile.phases['write']['calls'] == 4
+    assert profile.phases['write']['bytes_written'] == sum(
+        len(text) for name, text in profiled.items() if name.endswith('.html'))
+    assert profile.phases['content copy']['bytes_written'] == len(
+        'not really a picture')
+    assert sorted(profile.pages) == ['content/a.html', 'content/b.html',
+                                     'content/sub/c.html',
+                                     'content/sub/d.html']
+
+    # Tidy up
+    CONFIG.update(saved_config)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+# --------------
+# run_components()
+# --------------
+def create_component(components_dir, name, script, executable=True):
+    path = os.path.join(components_dir, name)
+    with open(path, 'w') as fh:
+        fh.write(script)
+    if executable:
+        os.chmod(path, 0o755)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_run_components():
+    """ Python components share one SiteIndex; other programs are run
+    separately; things that aren't executable are ignored. """
+    temp_dir_name = create_temporary_filename()
+    components_dir = os.path.join(temp_dir_name, 'components')
+    os.makedirs(components_dir)
+    python_script = (
+        '#!/usr/bin/env python\n'
+        'from awcm import awcm\n'
+        'index = awcm.get_site_index("../content", "../_meta")\n'
+        'with open("%s.txt", "w") as fh:\n'
+        '    fh.write(str(id(index)))\n')
+    create_component(components_dir, '001_one.py', python_script % 'one')
+    create_component(components_dir, '002-two', python_script % 'two')
+    create_component(components_dir, '003_three.sh',
+                     '#!/bin/sh\necho three > three.txt\n')
+    create_component(components_dir, '004_four.py', python_script % 'four',
+                     executable=False)
+    create_component(components_dir, 'helper.py', python_script % 'help')
+
+    run_components(components_dir)
+
+    created = read_all_files(components_dir)
+    assert created['one.txt'] == created['two.txt']
+    assert created['three.txt'] == 'three\n'
+    assert 'four.txt' not in created
+    assert 'help.txt' not in created
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_run_components_reports_failures():
+    temp_dir_name = create_temporary_filename()
+    os.makedirs(temp_dir_name)
+    create_component(temp_dir_name, '001_fails.py', 'exit(1)\n')
+    create_component(temp_dir_name, '002_raises.py', 'raise ValueError\n')
+    create_component(temp_dir_name, '003_works.sh',
+                     '#!/bin/sh\necho ok > ok.txt\n')
+
+    with pytest.raises(BuildError) as exc_info:
+        run_components(temp_dir_name)
+    assert '001_fails.py, 002_raises.py' in str(exc_info.value)
+    assert os.path.exists(os.path.join(temp_dir_name, 'ok.txt'))
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_profile_report_includes_components():
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    os.makedirs(os.path.join(temp_dir_name, 'components'))
+    create_component(os.path.join(temp_dir_name, 'components'), '001_x.py',
+                     'from awcm import awcm\n'
+                     'with awcm.profile_phase("my phase"):\n'
+                     '    awcm.count_bytes(written=3)\n')
+    with open(os.path.join(temp_dir_name, 'config.json'), 'w') as fh:
+        fh.write('{"theme": "x", "default_template": "common.thtml"}')
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+
+    run_components('components', profile=True)
+    main(profile=True, slowest=2)
+
+    with open(os.path.join('_meta', '_cache', 'profile.json')) as fh:
+        report = json.load(fh)
+    assert report['phases']['component 001_x.py']['calls'] == 1
+    assert report['phases']['my phase']['bytes_written'] == 3
+    assert report['phases']['static copy']['calls'] == 1
+    assert len(report['slowest_pages']) == 2
+    assert len(report['pages']) == 4
+    assert get_profile() is None
+
+    # Tidy up
+    CONFIG.update(saved_config)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_run_components_from_a_given_component():
+    temp_dir_name = create_temporary_filename()
+    os.makedirs(temp_dir_name)
+    for name in ['001_a.sh', '002_b.sh', '003_c.sh']:
+        create_component(temp_dir_name, name,
+                         '#!/bin/sh\necho %s >> ran.txt\n' % name)
+
+    run_components(temp_dir_name, start_at='002_b.sh')
+
+    with open(os.path.join(temp_dir_name, 'ran.txt')) as fh:
+        assert fh.read() == '002_b.sh\n003_c.sh\n'
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+# --------------
+# watch
+# --------------
+@pytest.mark.filterwarnings('ignore: tempnam')
+@pytest.mark.parametrize('use_inotify', [False, True])
+def test_watchers_notice_changes(use_inotify):
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    with open(os.path.join(temp_dir_name, 'config.json'), 'w') as fh:
+        fh.write('{"theme": "x"}')
+    os.chdir(temp_dir_name)
+    try:
+        if use_inotify:
+            try:
+                watcher = watch.InotifyWatcher(['content', 'config.json'])
+            except OSError:
+                pytest.skip("inotify isn't available")
+        else:
+            watcher = watch.PollingWatcher(['content', 'config.json'],
+                                           interval=0.01)
+        assert watcher.wait(timeout=0.05) == set()
+
+        with open(os.path.join('content', 'a.html'), 'a') as fh:
+            fh.write('more')
+        os.remove(os.path.join('content', 'sub', 'c.html'))
+        os.makedirs(os.path.join('content', 'new'))
+        with open(os.path.join('content', 'new', 'f.html'), 'w') as fh:
+            fh.write('new')
+        with open(os.path.join('content', '.a.html.swp'), 'w') as fh:
+            fh.write('ignore me')
+        with open('other.txt', 'w') as fh:
+            fh.write('not watched')
+        assert watcher.wait(timeout=1) == {
+            os.path.join('content', 'a.html'),
+            os.path.join('content', 'sub', 'c.html'),
+            os.path.join('content', 'new', 'f.html')}
+
+        with open('config.json', 'w') as fh:
+            fh.write('{"theme": "y"}')
+        assert watcher.wait(timeout=1) == {'config.json'}
+        watcher.close()
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_site_builder_only_rebuilds_what_has_changed():
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    with open(os.path.join(temp_dir_name, 'config.json'), 'w') as fh:
+        fh.write('{"theme": "x", "default_template": "common.thtml"}')
+    components_dir = os.path.join(temp_dir_name, 'components')
+    os.makedirs(os.path.join(components_dir, 'count'))
+    create_component(components_dir, '001_count.py',
+                     'from awcm import awcm\n'
+                     'index = awcm.get_site_index("../content", "../_meta")\n'
+                     'with open("../_meta/count.html", "w") as fh:\n'
+                     '    fh.write("<title>%d</title><body><p>%s</p></body>"'
+                     ' % (len(index.filenames()), id(index)))\n')
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+    try:
+        builder = watch.SiteBuilder()
+        builder.build()
+        with open(os.path.join('output', 'count.html')) as fh:
+            assert fh.read().startswith('<h1>5</h1>')
+
+        def output_stamps():
+            return {name: file_stamp(os.path.join('output', name))
+                    for name in read_all_files('output')}
+        before = output_stamps()
+
+        # A new page: the component runs again, and only the new page and
+        # the component's page are rendered
+        with open(os.path.join('content', 'new.html'), 'w') as fh:
+            fh.write('<title>new</title><body><p>Hi</p></body>')
+        builder.build({os.path.join('content', 'new.html')})
+        after = output_stamps()
+        assert sorted(name for name in after
+                      if after[name] != before.get(name)) == \
+            ['count.html', 'new.html']
+        with open(os.path.join('output', 'count.html')) as fh:
+            assert fh.read().startswith('<h1>6</h1>')
+
+        # A static file is just copied
+        with open(os.path.join('themes', 'x', 'static', 's.css'), 'w') as fh:
+            fh.write('p {}')
+        builder.build({os.path.join('themes', 'x', 'static', 's.css')})
+        assert output_stamps().keys() - after.keys() == {'themes/x/s.css'}
+
+        # A template change re-renders the pages
+        with open(os.path.join('themes', 'x', 'templates', 'common.thtml'),
+                  'w') as fh:
+            fh.write('<h2>{{ title }}</h2>{{ article }}')
+        builder.build({os.path.join('themes', 'x', 'templates',
+                                    'common.thtml')})
+        with open(os.path.join('output', 'a.html')) as fh:
+            assert fh.read() == '<h2>a.html</h2><p>Hi</p>'
+
+        # The component's data folder is watched along with it
+        assert builder.first_component_affected(
+            {os.path.join('components', 'count', 'data.txt')}) == \
+            '001_count.py'
+    finally:
+        CONFIG.update(saved_config)
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(temp_dir_name)
+
+
+# --------------
+# serve
+# --------------
+def test_url_to_path():
+    assert serve.url_to_path('/') == 'index.html'
+    assert serve.url_to_path('/sub/') == os.path.join('sub', 'index.html')
+    assert serve.url_to_path('/a%20b.html?x=1#top') == 'a b.html'
+    assert serve.url_to_path('/../config.json') is None
+    assert serve.url_to_path('/sub/../../x') is None
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_preview_site_renders_pages_when_asked():
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    with open(os.path.join(temp_dir_name, 'config.json'), 'w') as fh:
+        fh.write('{"theme": "x", "default_template": "common.thtml"}')
+    with open(os.path.join(temp_dir_name, 'themes', 'x', 'static', 's.css'),
+              'w') as fh:
+        fh.write('p {}')
+    with open(os.path.join(temp_dir_name, '_meta', 'b.html'), 'w') as fh:
+        fh.write('<title>meta b</title><body><p>Hi</p></body>')
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+    try:
+        site = serve.PreviewSite()
+        assert site.pages == {}
+        page = site.get(os.path.join('sub', 'c.html'))
+        assert page == b'<h1>sub/c.html</h1><p>Hi</p>../'
+        assert list(site.pages) == [os.path.join('sub', 'c.html')]
+        assert site.get(os.path.join('sub', 'c.html')) is page
+
+        # The page is rendered again when it changes
+        with open(os.path.join('content', 'sub', 'c.html'), 'w') as fh:
+            fh.write('<title>changed</title><body><p>Hi</p></body>')
+        assert site.get(os.path.join('sub', 'c.html')) == \
+            b'<h1>changed</h1><p>Hi</p>../'
+
+        # ... or when its template changes
+        with open(os.path.join('themes', 'x', 'templates', 'common.thtml'),
+                  'w') as fh:
+            fh.write('<h2>{{ title }}</h2>')
+        assert site.get(os.path.join('sub', 'c.html')) == b'<h2>changed</h2>'
+
+        assert site.get('b.html') == b'<h2>meta b</h2>'
+        assert site.get(os.path.join('sub', 'e.png')) == \
+            b'not really a picture'
+        assert site.get(os.path.join('themes', 'x', 's.css')) == b'p {}'
+        assert site.get('missing.html') is None
+        assert not os.listdir('output')
+
+        assert site.render_all() == []
+        assert len(site.pages) == 4
+    finally:
+        CONFIG.update(saved_config)
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_preview_server():
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    with open(os.path.join(temp_dir_name, 'config.json'), 'w') as fh:
+        fh.write('{"theme": "x", "default_template": "common.thtml"}')
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+    server = serve.make_server(port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        with urllib.request.urlopen(url + 'a.html') as response:
+            assert response.headers['Content-Type'] == \
+                'text/html; charset=utf-8'
+            assert response.read() == b'<h1>a.html</h1><p>Hi</p>'
+        with urllib.request.urlopen(url + 'sub/e.png') as response:
+            assert response.headers['Content-Type'] == 'image/png'
+        with pytest.raises(urllib.error.HTTPError) as exc_info:
+            urllib.request.urlopen(url + 'missing.html')
+        assert exc_info.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        CONFIG.update(saved_config)
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(temp_dir_name)
+
+# --------------
+# bits_box/upload.py
+# --------------
+def load_upload_module():
+    """ upload.py isn't part of the awcm package, so load it by path """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'bits_box', 'upload.py')
+    spec = importlib.util.spec_from_file_location('upload', path)
+    upload = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(upload)
+    return upload
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_upload_manifest_finds_changed_and_deleted_files():
+    upload = load_upload_module()
+    temp_dir_name = create_temporary_filename()
+    manifest_file = os.path.join(temp_dir_name, '_cache', 'manifest.json')
+
+    assert upload.load_manifest(manifest_file, 'ftp.example.com/www') == {}
+    upload.save_manifest(manifest_file, 'ftp.example.com/www',
+                         {'a.html': [1, 'aaa'], 'b.html': [2, 'bbb'],
+                          'c.html': [3, 'ccc']})
+    upload.save_manifest(manifest_file, 'ftp.example.com/test', {})
+    uploaded = upload.load_manifest(manifest_file, 'ftp.example.com/www')
+
+    fingerprints = {'a.html': [1, 'aaa'], 'b.html': [2, 'xxx'],
+                    'd.html': [4, 'ddd']}
+    assert upload.find_changed_files(fingerprints, uploaded) == \
+        ['b.html', 'd.html']
+    assert upload.find_deleted_files(fingerprints, uploaded) == ['c.html']
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+FTP_SERVER_SCRIPT = """
+import logging, sys
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+logging.disable(logging.CRITICAL)
+authorizer = DummyAuthorizer()
+authorizer.add_user('user', 'password', sys.argv[1], perm='elradfmwMT')
+FTPHandler.authorizer = authorizer
+server = FTPServer(('127.0.0.1', 0), FTPHandler)
+print(server.address[1], flush=True)
+server.serve_forever()
+"""
+
+
+@pytest.fixture
+def ftp_server():
+    """ A local FTP server to upload to. Yields a function that makes
+    logged in connections to it, and the folder it serves.
+
+    The server runs in its own process, as pyftpdlib changes the current
+    directory as it goes. """
+    pytest.importorskip('pyftpdlib')
+    remote_root = create_temporary_filename()
+    os.makedirs(os.path.join(remote_root, 'www'))
+    server = subprocess.Popen([sys.executable, '-c', FTP_SERVER_SCRIPT,
+                               remote_root], stdout=subprocess.PIPE)
+    port = int(server.stdout.readline())
+
+    def connect():
+        upload = load_upload_module()
+        return upload.make_ftp_conn('127.0.0.1', 'user', 'password',
+                                    port=port)
+
+    yield connect, remote_root
+
+    server.terminate()
+    server.wait()
+    server.stdout.close()
+    shutil.rmtree(remote_root)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_upload_in_parallel(ftp_server):
+    connect, remote_root = ftp_server
+    upload = load_upload_module()
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    os.chdir(temp_dir_name)
+    local_dir = 'content'
+    files = sorted(upload.find_all_files(local_dir))
+    assert 'sub/c.html' in files
+
+    connections = [connect() for _ in range(3)]
+    upload.make_folders_on_target('/www', connections[0],
+                                  upload.find_all_folders(files))
+    uploaded = []
+    failed = upload.ftp_files_in_parallel(
+        local_dir, '/www', connections, connect, files,
+        on_uploaded=uploaded.append)
+
+    assert failed == []
+    assert sorted(uploaded) == files
+    assert read_all_files(os.path.join(remote_root, 'www')) == \
+        read_all_files(local_dir)
+
+    # Tidy up
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_upload_in_parallel_retries_failures(ftp_server):
+    connect, remote_root = ftp_server
+    upload = load_upload_module()
+    temp_dir_name = create_temporary_filename()
+    create_sample_site(temp_dir_name)
+    local_dir = os.path.join(temp_dir_name, 'content')
+    attempts = {'a.html': 0, 'b.html': 0}
+
+    def flaky_connect():
+        """ a connection that can't upload a.html at the first attempt,
+        and can never upload b.html """
+        ftp = connect()
+        storbinary = ftp.storbinary
+
+        def flaky_storbinary(cmd, fh):
+            filename = cmd.split(' ', 1)[1]
+            if filename in attempts:
+                attempts[filename] += 1
+                if filename == 'b.html' or attempts[filename] == 1:
+                    raise ftplib.error_temp('451 Try again')
+            return storbinary(cmd, fh)
+        ftp.storbinary = flaky_storbinary
+        return ftp
+
+    failed = upload.ftp_files_in_parallel(
+        local_dir, '/www', [flaky_connect(), flaky_connect()], flaky_connect,
+        ['a.html', 'b.html'], retries=3)
+
+    assert failed == ['b.html']
+    assert attempts == {'a.html': 2, 'b.html': 3}
+    assert os.listdir(os.path.join(remote_root, 'www')) == ['a.html']
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+def test_upload_find_all_folders():
+    upload = load_upload_module()
+    files = ['a/b/c/1.html', 'a/2.html', 'a-z/3.html', '4.html', 'a/b/5.html']
+    assert upload.find_all_folders(files) == \
+        ['a', 'a-z', 'a/b', 'a/b/c']
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_upload_make_folders_on_target(ftp_server):
+    """ Only the missing folders are made, and the remote tree is only
+    listed where it's needed """
+    connect, remote_root = ftp_server
+    upload = load_upload_module()
+    os.makedirs(os.path.join(remote_root, 'www', 'a', 'old'))
+    os.makedirs(os.path.join(remote_root, 'www', 'unrelated', 'x'))
+
+    ftp = connect()
+    listed = []
+    mlsd = ftp.mlsd
+
+    def counting_mlsd(path, facts):
+        listed.append(path)
+        return mlsd(path, facts)
+    ftp.mlsd = counting_mlsd
+
+    upload.make_folders_on_target('/www', ftp, upload.find_all_folders(
+        ['a/b/c/1.html', 'a/2.html', 'd/3.html']))
+    ftp.quit()
+
+    assert sorted(listed) == ['/www/', '/www/a']
+    made = sorted(os.path.relpath(os.path.join(root, d), remote_root)
+                  for root, dirs, _files in os.walk(remote_root)
+                  for d in dirs)
+    assert made == ['www', 'www/a', 'www/a/b', 'www/a/b/c', 'www/a/old',
+                    'www/d', 'www/unrelated', 'www/unrelated/x']
+
+
+
+# --------------
+# bench
+# --------------
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_make_corpus_is_deterministic():
+    temp_dir_name = create_temporary_filename()
+    pages = bench.make_corpus(os.path.join(temp_dir_name, 'a'), pages=30,
+                              depth=3, media=2, media_kb=1, seed=5)
+    bench.make_corpus(os.path.join(temp_dir_name, 'b'), pages=30, depth=3,
+                      media=2, media_kb=1, seed=5)
+
+    assert len(pages) == 30
+    assert any(page.count('/') == 3 for page in pages)
+    media = []
+    for site in ['a', 'b']:
+        media_dir = os.path.join(temp_dir_name, site, 'content', 'media')
+        with open(os.path.join(media_dir, 'm00001.jpg'), 'rb') as fh:
+            media.append(fh.read())
+        shutil.rmtree(media_dir)
+    assert len(media[0]) == 1024
+    assert media[0] == media[1]
+    assert read_all_files(os.path.join(temp_dir_name, 'a', 'content')) == \
+        read_all_files(os.path.join(temp_dir_name, 'b', 'content'))
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_sitemap_components():
+    """ 999_mksitemap.py makes the sitemaps from the data collected by
+    000_collect_data.py """
+    temp_dir_name = create_temporary_filename()
+    pages = bench.make_corpus(temp_dir_name, pages=5, body_kb=1)
+    config_file = os.path.join(temp_dir_name, 'config.json')
+    with open(config_file) as fh:
+        config = json.load(fh)
+    config['site_url'] = 'https://example.com/'
+    with open(config_file, 'w') as fh:
+        json.dump(config, fh)
+    os.chdir(temp_dir_name)
+    saved_config = dict(CONFIG)
+
+    run_components('components')
+
+    with open(os.path.join('_meta', '000_sitemap.json')) as fh:
+        sitemap_data = json.load(fh)
+    assert sorted(entry['url'] for entry in sitemap_data) == sorted(pages)
+    with open(os.path.join('_meta', '000_nav_all_files.html')) as fh:
+        sitemap_html = fh.read()
+    for entry in sitemap_data:
+        assert '<a href="%s">%s</a>' % (entry['url'], entry['title']) in \
+            sitemap_html
+    assert read_sitemap(os.path.join('_meta', 'sitemap.xml')) == (
+        'urlset', [{'loc': 'https://example.com/' + entry['url'],
+                    'lastmod': entry['date'][:10]}
+                   for entry in sitemap_data])
+
+    # Tidy up
+    CONFIG.update(saved_config)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(temp_dir_name)
+
+
+@pytest.mark.filterwarnings('ignore: tempnam')
+def test_run_benchmark():
+    temp_dir_name = create_temporary_filename()
+    pages = bench.make_corpus(temp_dir_name, pages=5, body_kb=1)
+
+    report = bench.run_benchmark(temp_dir_name, len(pages))
+
+    assert [step['name'] for step in report] == [
+        '000_collect_data.py', '001_make_homepage.py', '999_mksitemap.py',
+        'components', 'build']
+    assert all(step['seconds'] > 0 for step in report)
+    assert os.path.exists(os.path.join(temp_dir_name, 'output', 'index.html'))
+    assert os.path.exists(os.path.join(temp_dir_name, 'output',
+                                       pages[0]))
+
+    # Tidy up
+    shutil.rmtree(temp_dir_name)
+
 if __name__ == '__main__':
     print("You should be using pytest!")